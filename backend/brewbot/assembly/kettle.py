@@ -1,12 +1,13 @@
 from brewbot.can.node_state import NodeState, ThermometerNodeState, RelayNodeState
-from brewbot.config import NodeConfig, AssemblyConfig, ControllerConfig, DataCollectConfig
+from brewbot.config import NodeConfig, AssemblyConfig, ControllerConfig, DataCollectConfig, FusionConfig
 from brewbot.assembly.assembly import Assembly
-from brewbot.data.df import WindowedDataFrame
+from brewbot.can.event_bus import EventBus, MsgEvent
+from brewbot.data.series import WindowedSeries
+from brewbot.data.kalman import TempKalman
 from brewbot.util import parse_on_off, async_infinite_loop, avg_dict
 from brewbot.data.pid import calculate_pd_error, duty_cycle
-from typing import Any, Coroutine
-import asyncio
-import time
+from brewbot.clock import Clock, SYSTEM_CLOCK
+from typing import Any, Callable, Coroutine, Optional
 import numpy as np
 import logging
 from cysystemd import journal
@@ -26,7 +27,7 @@ class KettleAssembly(Assembly):
     tpe_name: str
     key: str
 
-    def __init__(self, key: str, thermometers: list[ThermometerNodeState], steering: RelayNodeState, heat_plate: RelayNodeState, volume: float, controller_conf: ControllerConfig, data_collect_conf: DataCollectConfig):
+    def __init__(self, key: str, thermometers: list[ThermometerNodeState], steering: RelayNodeState, heat_plate: RelayNodeState, volume: float, controller_conf: ControllerConfig, data_collect_conf: DataCollectConfig, clock: Clock = SYSTEM_CLOCK, fusion_conf: Optional[FusionConfig] = None):
         self.tpe_name = "kettle"
         self.key = key
         self.thermometers = thermometers
@@ -35,24 +36,80 @@ class KettleAssembly(Assembly):
         self.volume = volume
         self.controller_conf = controller_conf
         self.data_collect_conf = data_collect_conf
+        self.fusion_conf = fusion_conf
+        self.clock = clock
 
         self.heat_plate_setpoint = None
-        self.temp_df = WindowedDataFrame(data_collect_conf.window, columns=["t", "y"], index_column="t")
+        self.temp_series = WindowedSeries(data_collect_conf.window, fit=True)
+
+        # with fusion all thermometer samples update a common temperature / rate estimate (see `subscribe`)
+        self.estimator = TempKalman(fusion_conf.process_noise) if fusion_conf is not None else None
+        self._sample_handlers = []
+
+        self._therm_state_key = None
+        self._therm_state = None
+
+    def subscribe(self, event_bus: EventBus) -> None:
+        if self.estimator is None:
+            return
+
+        for thermometer in self.thermometers:
+            handler = self.gen_therm_sample_handler(thermometer)
+            event_bus.subscribe(handler, thermometer.node_conf.key, "therm_state")
+            self._sample_handlers.append(handler)
+
+    def unsubscribe(self, event_bus: EventBus) -> None:
+        for handler in self._sample_handlers:
+            event_bus.unsubscribe(handler)
+
+        self._sample_handlers = []
+
+    def gen_therm_sample_handler(self, thermometer: ThermometerNodeState) -> Callable[[MsgEvent], None]:
+        variance = self.fusion_conf.sensor_variance(thermometer.node_conf.key)
+
+        def therm_sample_handler(event: MsgEvent):
+            # samples rejected by the outlier filter of the thermometer are not published
+            self.estimator.update(event.t, event.msg['temp_c'], variance)
+
+        return therm_sample_handler
 
     @property
     def therm_state(self) -> dict[str, float]:
-        return avg_dict([t.therm_state() for t in self.thermometers])
+        # cached as long as no thermometer state changed (see `ThermometerNodeState.state_key`)
+        key = tuple(t.state_key() for t in self.thermometers)
+        if key != self._therm_state_key:
+            self._therm_state = self.calc_therm_state()
+            self._therm_state_key = key
+
+        return self._therm_state
+
+    def calc_therm_state(self) -> dict[str, float]:
+        if self.estimator is None:
+            return avg_dict([t.therm_state() for t in self.thermometers])
+
+        # thermometers that went silent have no state anymore (see `NodeState.mark_stale`)
+        samples = [t.rx_message_state["therm_state"] for t in self.thermometers if t.rx_message_state["therm_state"] is not None]
+        if len(samples) == 0:
+            # don't extrapolate over the gap, the next sample starts a new estimate
+            self.estimator.reset()
+
+        state = self.estimator.state(self.clock.time())
+        if state is None:
+            return {"temp_c": None, "temp_c_rate": None, "temp_v": None}
+
+        temp_c, temp_c_rate = state
+        return {"temp_c": temp_c, "temp_c_rate": temp_c_rate, "temp_v": sum(s['temp_v'] for s in samples) / len(samples)}
 
     @property
     def heat_plate_state(self):
-        return self.heat_plate.rx_message_state
+        return self.heat_plate.rx_state_dict()
 
     def set_heat_plate(self, on_off: Any):
         self.heat_plate.cmd_state = parse_on_off(on_off)
 
     @property
     def steering_state(self):
-        return self.steering.rx_message_state
+        return self.steering.rx_state_dict()
 
     def set_steering(self, on_off: Any):
         self.steering.cmd_state = parse_on_off(on_off)
@@ -64,9 +121,9 @@ class KettleAssembly(Assembly):
     async def collect_data(self):
         temp_c = self.therm_state.get("temp_c")
         if temp_c is not None:
-            self.temp_df.append({"t": [time.time()], "y": [temp_c]})
+            self.temp_series.append(self.clock.time(), temp_c)
 
-        await asyncio.sleep(1.0 / self.data_collect_conf.collect_interval)
+        await self.clock.sleep(1.0 / self.data_collect_conf.collect_interval)
 
     @async_infinite_loop
     async def control_heat_plate(self):
@@ -76,6 +133,10 @@ class KettleAssembly(Assembly):
         temp_setpoint = self.heat_plate_setpoint
         if temp_setpoint is None:
             dc = float("nan")
+        elif self.therm_state.get("temp_c") is None:
+            # all thermometers silent -> don't control on outdated data, keep the heat plate off
+            logger.warning("no temperature available -> set heat plate off")
+            dc = 0.0
         else:
             dc = self.calc_duty_cycle(temp_setpoint)
 
@@ -85,32 +146,38 @@ class KettleAssembly(Assembly):
         eps = 1e-6
         if np.isnan(dc):
             logger.info("nan dc -> don't control")
-            await asyncio.sleep(interval_time)
+            await self.clock.sleep(interval_time)
         elif dc < (low_jump_thres - eps):
             logger.info("dc < low_jump_tres -> set heat plate off")
             self.set_heat_plate("off")
-            await asyncio.sleep(interval_time)
+            await self.clock.sleep(interval_time)
         elif (low_jump_thres - eps) <= dc <= (high_jump_thres + eps):
             logger.info(f"dc in pwm range -> on: {interval_time * dc} - off: {interval_time * (1.0 - dc)}")
             self.set_heat_plate("on")
-            await asyncio.sleep(interval_time * dc)
+            await self.clock.sleep(interval_time * dc)
             self.set_heat_plate("off")
-            await asyncio.sleep(interval_time * (1.0 - dc))
+            await self.clock.sleep(interval_time * (1.0 - dc))
         elif dc > (high_jump_thres + eps):
             logger.info("dc > high_jump_thres -> set heat plate on")
             self.set_heat_plate("on")
-            await asyncio.sleep(interval_time)
+            await self.clock.sleep(interval_time)
         else:
             raise ValueError("invalid value for duty cycle")
 
     def calc_duty_cycle(self, temp_setpoint: float) -> float:
-        window = self.data_collect_conf.window
-        p, d = calculate_pd_error(temp_setpoint, self.temp_df.df, time.time(), window)
+        if self.estimator is not None:
+            # P and D inputs directly from the fused temperature and rate
+            temp_c, temp_c_rate = self.estimator.state(self.clock.time())
+            p, d = temp_setpoint - temp_c, -temp_c_rate
+        else:
+            window = self.data_collect_conf.window
+            p, d = calculate_pd_error(temp_setpoint, self.temp_series, self.clock.time(), window)
         p_gain = self.controller_conf.p_gain
         d_gain = self.controller_conf.d_gain
         cs = p * p_gain + d * d_gain
 
-        logger.info(f"temp: {self.therm_state.get("temp_c"):4.2f}")
+        temp_c = self.therm_state.get("temp_c")
+        logger.info(f"temp: {temp_c if temp_c is not None else float('nan'):4.2f}")
         logger.info(f"p-comp: {p * p_gain: 4.2f}  ==  d-comp: {d * d_gain: 4.2f}  ==  cs: {cs: 4.2f}")
 
         max_cs = self.controller_conf.max_cs
@@ -123,7 +190,7 @@ class KettleAssembly(Assembly):
         return [self.collect_data(), self.control_heat_plate()]
 
     @classmethod
-    def from_config(cls, conf: AssemblyConfig, node_states: dict[str, NodeState]):
+    def from_config(cls, conf: AssemblyConfig, node_states: dict[str, NodeState], clock: Clock = SYSTEM_CLOCK):
         thermometers = []
         for temp_node in conf.nodes["thermometer"]:
             if isinstance(temp_node, NodeConfig):
@@ -159,4 +226,8 @@ class KettleAssembly(Assembly):
         if not isinstance(data_collect_conf, DataCollectConfig):
             raise ValueError("kettle data collect config must be a `DataCollectConfig`")
 
-        return KettleAssembly(conf.key, thermometers, motor, heat_plate, volume, controller_conf, data_collect_conf)
+        fusion_conf = conf.parsed_param.get('fusion')
+        if fusion_conf is not None and not isinstance(fusion_conf, FusionConfig):
+            raise ValueError("kettle fusion config must be a `FusionConfig`")
+
+        return KettleAssembly(conf.key, thermometers, motor, heat_plate, volume, controller_conf, data_collect_conf, clock, fusion_conf)
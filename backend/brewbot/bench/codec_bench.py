@@ -0,0 +1,70 @@
+import random
+import time
+from brewbot.config import load_config, MsgTypeConfig
+from cantools.database import Database
+
+# python -m brewbot.bench.codec_bench
+
+
+def random_payloads(msg_type: MsgTypeConfig, dbc: Database, n: int, seed: int = 0) -> list[bytes]:
+    rnd = random.Random(seed)
+    dbc_msg = dbc.get_message_by_name(msg_type.dbc_name)
+
+    payloads = []
+    for _ in range(n):
+        data = bytes(rnd.randrange(0x100) for _ in range(8))
+        # round trip through cantools to clear bits that are not covered by any signal
+        payloads.append(dbc_msg.encode(dbc_msg.decode(data, decode_choices=False), strict=False))
+
+    return payloads
+
+
+def check_equivalence(msg_type: MsgTypeConfig, dbc: Database, payloads: list[bytes]) -> None:
+    # cantools is the reference implementation for the generated codec
+    dbc_msg = dbc.get_message_by_name(msg_type.dbc_name)
+
+    for data in payloads:
+        expected = msg_type.decode(dbc_msg.decode(data))
+        actual = msg_type.decode_data(data)
+        if expected != actual:
+            raise ValueError(f"{msg_type.key}: decode mismatch for {data.hex()}: {expected} != {actual}")
+
+        expected_data = dbc_msg.encode(msg_type.encode(actual))
+        actual_data = msg_type.encode_data(actual)
+        if expected_data != actual_data:
+            raise ValueError(f"{msg_type.key}: encode mismatch for {actual}: {expected_data.hex()} != {actual_data.hex()}")
+
+
+def ops_per_second(fun, args: list, repeat: int = 5) -> float:
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for arg in args:
+            fun(arg)
+        best = min(best, time.perf_counter() - start)
+
+    return len(args) / best
+
+
+def main():
+    conf = load_config()
+
+    for msg_type in conf.message_types:
+        dbc_msg = conf.dbc.get_message_by_name(msg_type.dbc_name)
+        payloads = random_payloads(msg_type, conf.dbc, 10000)
+        check_equivalence(msg_type, conf.dbc, payloads)
+
+        msgs = [msg_type.decode_data(data) for data in payloads]
+
+        cantools_decode = ops_per_second(lambda data: msg_type.decode(dbc_msg.decode(data)), payloads)
+        codec_decode = ops_per_second(msg_type.decode_data, payloads)
+        cantools_encode = ops_per_second(lambda msg: dbc_msg.encode(msg_type.encode(msg)), msgs)
+        codec_encode = ops_per_second(msg_type.encode_data, msgs)
+
+        print(f"{msg_type.key}")
+        print(f"  decode: cantools {cantools_decode:12,.0f}/s  codec {codec_decode:12,.0f}/s  ({codec_decode / cantools_decode:.1f}x)")
+        print(f"  encode: cantools {cantools_encode:12,.0f}/s  codec {codec_encode:12,.0f}/s  ({codec_encode / cantools_encode:.1f}x)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,119 @@
+import can
+import numpy as np
+import random
+import time
+from brewbot.can.msg_registry import MsgRegistry
+from brewbot.can.util import can_id_to_pgn, pgn_to_can_id
+from brewbot.config import load_config, CanEnvConfig
+
+# python -m brewbot.bench.decode_bench
+
+
+def legacy_decode(msg_reg: MsgRegistry, msg: can.Message):
+    # decode path before the dispatch table: pgn lookup, candidate scan and message lookup by name for every frame
+    pgn, priority, msg_src_addr, msg_dest_addr = can_id_to_pgn(msg.arbitration_id)
+    msg_def_candidates = msg_reg.msg_by_pgn.get(pgn)
+
+    if msg_def_candidates is None:
+        return None
+    else:
+        for node, msg_def in msg_def_candidates:
+            if (node.node_addr is None or msg_dest_addr == 0xFF or msg_dest_addr == node.node_addr) \
+                    and (node.node_addr is None or msg_src_addr == node.node_addr):
+                return node, msg_def, msg_def.decode(msg_def.dbc_msg.decode(msg.data))
+
+    return None
+
+
+def gen_frames(conf: CanEnvConfig, n: int, unknown_ratio: float = 0.2, seed: int = 0) -> list[can.Message]:
+    rnd = random.Random(seed)
+
+    templates = []
+    for node in conf.nodes:
+        for msg_def in node.messages:
+            if msg_def.direction == "rx":
+                arbitration_id = pgn_to_can_id(msg_def.dbc_msg.frame_id, msg_def.priority, node.node_addr, 0xFF)
+                templates.append((arbitration_id, msg_def))
+
+    frames = []
+    for _ in range(n):
+        if rnd.random() < unknown_ratio:
+            # traffic of other J1939 equipment on the same bus
+            arbitration_id = pgn_to_can_id(0xFE00 | rnd.randrange(0x100), 6, rnd.randrange(0x20, 0x40), 0xFF)
+            data = bytes(rnd.randrange(0x100) for _ in range(8))
+        else:
+            arbitration_id, msg_def = rnd.choice(templates)
+            data = bytes(rnd.randrange(0x100) for _ in range(8))
+            # keep flag signals in their valid range
+            data = msg_def.dbc_msg.encode(msg_def.dbc_msg.decode(data, decode_choices=False), strict=False)
+
+        frames.append(can.Message(arbitration_id=arbitration_id, data=data, is_extended_id=True))
+
+    return frames
+
+
+def frames_per_second(decode, frames: list[can.Message], repeat: int = 5) -> float:
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for frame in frames:
+            decode(frame)
+        best = min(best, time.perf_counter() - start)
+
+    return len(frames) / best
+
+
+def check_batch_equivalence(msg_reg: MsgRegistry, frames: list[can.Message]) -> None:
+    decoded = msg_reg.decode_batch([(frame.timestamp, frame.arbitration_id, frame.data) for frame in frames])
+
+    expected = {}
+    for frame in frames:
+        node_msg = msg_reg.decode(frame)
+        if node_msg is not None:
+            node, msg_def, msg = node_msg
+            expected.setdefault((node.key, msg_def.key), []).append(msg)
+
+    if expected.keys() != decoded.keys():
+        raise ValueError(f"batch decode mismatch: {expected.keys()} != {decoded.keys()}")
+
+    for key, msgs in expected.items():
+        arr = decoded[key]
+        for field in arr.dtype.names[1:]:
+            if not np.allclose(arr[field], [msg[field] for msg in msgs], rtol=0, atol=1e-9):
+                raise ValueError(f"batch decode mismatch for {key}.{field}")
+
+
+def main():
+    conf = load_config()
+    msg_reg = MsgRegistry(conf.nodes)
+    frames = gen_frames(conf, 20000)
+
+    for frame in frames:
+        expected = legacy_decode(msg_reg, frame)
+        actual = msg_reg.decode(frame)
+        if expected != actual:
+            raise ValueError(f"decode mismatch for frame {frame}: {expected} != {actual}")
+
+    legacy_fps = frames_per_second(lambda frame: legacy_decode(msg_reg, frame), frames)
+    dispatch_fps = frames_per_second(msg_reg.decode, frames)
+
+    print(f"legacy decode:   {legacy_fps:12,.0f} frames/s")
+    print(f"dispatch decode: {dispatch_fps:12,.0f} frames/s  ({dispatch_fps / legacy_fps:.2f}x)")
+
+    check_batch_equivalence(msg_reg, frames)
+
+    frame_tuples = [(frame.timestamp, frame.arbitration_id, frame.data) for frame in frames]
+    frame_arr = np.zeros(len(frames), dtype=[("timestamp", np.float64), ("arbitration_id", np.uint32), ("data", np.uint8, 8)])
+    frame_arr["timestamp"] = [frame.timestamp for frame in frames]
+    frame_arr["arbitration_id"] = [frame.arbitration_id for frame in frames]
+    frame_arr["data"] = [list(frame.data) for frame in frames]
+
+    tuple_fps = frames_per_second(lambda batch: msg_reg.decode_batch(batch), [frame_tuples]) * len(frames)
+    array_fps = frames_per_second(lambda batch: msg_reg.decode_batch(batch), [frame_arr]) * len(frames)
+
+    print(f"batch decode (tuples): {tuple_fps:12,.0f} frames/s")
+    print(f"batch decode (array):  {array_fps:12,.0f} frames/s")
+
+
+if __name__ == "__main__":
+    main()
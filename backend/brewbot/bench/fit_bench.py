@@ -0,0 +1,74 @@
+import random
+import time
+import numpy as np
+from brewbot.data.series import WindowedSeries
+
+# python -m brewbot.bench.fit_bench
+
+
+def polyfit_line(series: WindowedSeries, current_time: float) -> tuple[np.ndarray, np.ndarray]:
+    # reference: fit over the selected samples with `np.polyfit`. Times are centred on `current_time`, the uncentred
+    # fit of the former implementation is itself off by ~1e-8 with epoch timestamps.
+    t, values = series.between(current_time - series.window, current_time)
+    poly = np.polyfit(t - current_time, values, 1)
+    return poly[1], poly[0]
+
+
+def check_equivalence(window: float, rate: float, t_start: float, n: int, seed: int = 0) -> float:
+    # the running fit must match polyfit after every sample, returns the largest relative deviation of the values
+    rnd = random.Random(seed)
+    series = WindowedSeries(window, columns=["temp_c", "temp_v"], capacity=int(window * rate * 1.5), fit=True)
+    max_dev = 0.0
+
+    t = t_start
+    for i in range(n):
+        t += rnd.uniform(0.5, 1.5) / rate
+        temp_c = 20.0 + 0.01 * i + rnd.gauss(0.0, 0.1)
+        series.append(t, (temp_c, temp_c / 19.0))
+
+        if len(series) < 2:
+            continue
+
+        current_time = t + rnd.uniform(0.0, 0.5 / rate)
+        reference_value, reference_slope = polyfit_line(series, current_time)
+        value, slope = series.linear_fit(current_time)
+
+        if not np.allclose(value, reference_value, rtol=1e-9, atol=1e-9) or not np.allclose(slope, reference_slope, rtol=1e-6, atol=1e-9):
+            raise ValueError(f"fit mismatch at sample {i}: {value}, {slope} != {reference_value}, {reference_slope}")
+
+        max_dev = max(max_dev, float(np.max(np.abs(value - reference_value) / np.abs(reference_value))))
+
+    return max_dev
+
+
+def bench_query(window: float, rate: float, n: int = 10000) -> tuple[float, float]:
+    series = WindowedSeries(window, capacity=int(window * rate * 1.5), fit=True)
+    for i in range(int(window * rate * 2)):
+        series.append(1.7e9 + i / rate, 20.0 + 0.01 * i)
+
+    current_time = series.last_t
+
+    start = time.perf_counter()
+    for _ in range(n):
+        polyfit_line(series, current_time)
+    polyfit_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for _ in range(n):
+        series.linear_fit(current_time)
+    fit_time = time.perf_counter() - start
+
+    return n / polyfit_time, n / fit_time
+
+
+def main():
+    for window, rate, t_start in [(10.0, 10.0, 0.0), (10.0, 10.0, 1.7e9), (30.0, 2.0, 1.7e9), (60.0, 100.0, 1.7e9)]:
+        max_dev = check_equivalence(window, rate, t_start, int(window * rate * 10))
+        polyfit_query, fit_query = bench_query(window, rate)
+
+        print(f"window {window:.0f} s @ {rate:.0f} Hz, t0 = {t_start:.1e} (max. deviation from polyfit {max_dev:.1e})")
+        print(f"  query: polyfit {polyfit_query:12,.0f}/s  running fit {fit_query:12,.0f}/s  ({fit_query / polyfit_query:.1f}x)")
+
+
+if __name__ == "__main__":
+    main()
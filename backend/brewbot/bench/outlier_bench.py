@@ -0,0 +1,72 @@
+import random
+import time
+import numpy as np
+from brewbot.data.outlier import HampelFilter, MAD_SCALE
+
+# python -m brewbot.bench.outlier_bench
+
+
+def reference_outlier(window: list[float], value: float, n_sigmas: float, min_deviation: float, min_samples: int) -> bool:
+    # reference: median and MAD of the window computed with numpy
+    if len(window) < min_samples:
+        return False
+
+    median = np.median(window)
+    mad = np.median(np.abs(np.array(window) - median))
+    return bool(abs(value - median) > n_sigmas * max(MAD_SCALE * mad, min_deviation))
+
+
+def check_equivalence(size: int, n: int, quantum: float, seed: int = 0) -> int:
+    # the filter must decide like the reference for every sample, returns the number of rejected samples
+    rnd = random.Random(seed)
+    hampel = HampelFilter(size, 3.0, 0.01)
+    window = []
+
+    for i in range(n):
+        value = 20.0 + 0.01 * i + rnd.gauss(0.0, 0.1)
+        if rnd.random() < 0.02:
+            value += rnd.choice([-1.0, 1.0]) * rnd.uniform(1.0, 50.0)
+        # ADC readings are quantized -> many equal values in the window
+        value = round(value / quantum) * quantum
+
+        expected = reference_outlier(window, value, hampel.n_sigmas, hampel.min_deviation, hampel.min_samples)
+        if hampel.is_outlier(value) != expected:
+            raise ValueError(f"decision mismatch at sample {i}: median {hampel.median()} mad {hampel.mad()}")
+
+        mad = hampel.mad()
+        if mad is not None and abs(mad - np.median(np.abs(np.array(window) - np.median(window)))) > 1e-9:
+            raise ValueError(f"mad mismatch at sample {i}")
+
+        hampel.accept(value)
+        window.append(value)
+        if len(window) > size:
+            window.pop(0)
+
+    return hampel.rejected
+
+
+def bench_filter(size: int, n: int = 100000) -> float:
+    rnd = random.Random(1)
+    values = [20.0 + rnd.gauss(0.0, 0.1) for _ in range(n)]
+    hampel = HampelFilter(size, 3.0, 0.05)
+
+    start = time.perf_counter()
+    for value in values:
+        hampel.accept(value)
+    return n / (time.perf_counter() - start)
+
+
+def main():
+    for size in [5, 15, 16, 101]:
+        for quantum in [0.001, 0.05]:
+            rejected = check_equivalence(size, 5000, quantum)
+            print(f"size {size:3d}, quantum {quantum}: decisions equal to numpy median / MAD ({rejected} of 5000 rejected)")
+
+    # the shift of the sorted list (O(n)) only shows for windows far beyond the configured sizes
+    for size in [15, 101, 1001, 10001]:
+        rate = bench_filter(size)
+        print(f"size {size:4d}: {rate:12,.0f} samples/s")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,95 @@
+import time
+import tracemalloc
+from brewbot.bench.codec_bench import random_payloads
+from brewbot.can.codec import _compile
+from brewbot.config import load_config, MsgTypeConfig
+from typing import Callable
+
+# python -m brewbot.bench.record_bench
+
+
+def compile_dict_decoder(msg_type: MsgTypeConfig) -> Callable[[bytes], dict]:
+    # reference: the generated decoder returning a dict literal, as messages were decoded before. The record stores
+    # `record.<key> = <value>` of the generated source become the items of the literal.
+    decoder = msg_type.data_decoder
+    lines, items = [], []
+    for line in decoder.__source__.splitlines():
+        if line.startswith("    record."):
+            key, value_expr = line[len("    record."):].split(" = ", 1)
+            items.append(f"{key!r}: {value_expr}")
+        elif line != "    record = _record_class()" and line != "    return record":
+            lines.append(line)
+
+    lines.append(f"    return {{{', '.join(items)}}}")
+    return _compile(decoder.__name__, "\n".join(lines) + "\n", dict(decoder.__globals__))
+
+
+def interleaved_ops_per_second(funs: list[Callable], args: list, repeat: int = 50) -> list[float]:
+    # best of many short runs, alternating between the functions so that load changes of the machine hit all of them
+    best = [float("inf")] * len(funs)
+    for _ in range(repeat):
+        for i, fun in enumerate(funs):
+            start = time.perf_counter()
+            for arg in args:
+                fun(arg)
+            best[i] = min(best[i], time.perf_counter() - start)
+
+    return [len(args) / b for b in best]
+
+
+def retained_bytes(decode: Callable, payloads: list[bytes]) -> float:
+    # memory held per decoded message while the messages are kept (e.g. as received state or in queues)
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    msgs = [decode(data) for data in payloads]
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+
+    # minus the list holding the messages
+    return (after - before) / len(msgs) - 8
+
+
+def access_per_second(msgs: list, key: str, n: int = 5) -> float:
+    best = float("inf")
+    for _ in range(n):
+        start = time.perf_counter()
+        for msg in msgs:
+            msg[key]
+        best = min(best, time.perf_counter() - start)
+
+    return len(msgs) / best
+
+
+def main():
+    conf = load_config()
+
+    for msg_type in conf.message_types:
+        payloads = random_payloads(msg_type, conf.dbc, 5000)
+        decode_dict = compile_dict_decoder(msg_type)
+        # the decoder as used by the dispatch table, `decode_data` adds the attribute lookup on the pydantic model
+        decode_record = msg_type.data_decoder
+
+        for data in payloads:
+            record, d = decode_record(data), decode_dict(data)
+            if record != d or d != record or dict(record) != d or list(record.items()) != list(d.items()):
+                raise ValueError(f"{msg_type.key}: record mismatch for {data.hex()}: {record} != {d}")
+
+        dict_decode, record_decode = interleaved_ops_per_second([decode_dict, decode_record], payloads)
+        dict_bytes = retained_bytes(decode_dict, payloads)
+        record_bytes = retained_bytes(decode_record, payloads)
+
+        dict_msgs = [decode_dict(data) for data in payloads]
+        record_msgs = [decode_record(data) for data in payloads]
+
+        print(f"{msg_type.key} ({len(msg_type.signals)} signals)")
+        print(f"  decode: dict {dict_decode:12,.0f}/s  record {record_decode:12,.0f}/s  ({record_decode / dict_decode:.2f}x)")
+        print(f"  memory: dict {dict_bytes:8.0f} B/msg  record {record_bytes:8.0f} B/msg  ({record_bytes / dict_bytes:.2f}x)")
+        # first and last signal: the record lookup doesn't depend on the position of the signal
+        for key in dict.fromkeys([msg_type.signals[0].key, msg_type.signals[-1].key]):
+            dict_access = access_per_second(dict_msgs, key)
+            record_access = access_per_second(record_msgs, key)
+            print(f"  msg[{key!r}]: dict {dict_access:12,.0f}/s  record {record_access:12,.0f}/s")
+
+
+if __name__ == "__main__":
+    main()
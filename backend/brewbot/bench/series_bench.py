@@ -0,0 +1,86 @@
+import math
+import random
+import time
+import numpy as np
+from brewbot.data.df import WindowedDataFrame
+from brewbot.data.series import WindowedSeries
+
+# python -m brewbot.bench.series_bench
+
+
+def gen_samples(n: int, rate: float, seed: int = 0) -> list[tuple[float, float]]:
+    # temperature readings at `rate` Hz with some timing jitter
+    rnd = random.Random(seed)
+    return [(i / rate + rnd.uniform(0.0, 0.2 / rate), 20.0 + 0.01 * i + rnd.gauss(0.0, 0.1)) for i in range(n)]
+
+
+def fit_df(frame: WindowedDataFrame, current_time: float, window: float) -> float:
+    # the former `ThermometerNodeState.interp`
+    filtered_data = frame.df.loc[(current_time - window):current_time]
+    poly = np.polyfit(filtered_data.index.to_numpy(), filtered_data['y'].to_numpy(), 1)
+    return float(np.polyval(poly, current_time))
+
+
+def fit_series(series: WindowedSeries, current_time: float, window: float) -> float:
+    t, values = series.between(current_time - window, current_time)
+    poly = np.polyfit(t, values[:, 0], 1)
+    return float(np.polyval(poly, current_time))
+
+
+def bench_append(samples: list[tuple[float, float]], window: float, capacity: int) -> tuple[float, float]:
+    frame = WindowedDataFrame(window, columns=["t", "y"], index_column="t")
+    start = time.perf_counter()
+    for t, y in samples:
+        frame.append({"t": [t], "y": [y]})
+    df_time = time.perf_counter() - start
+
+    series = WindowedSeries(window, capacity=capacity)
+    start = time.perf_counter()
+    for t, y in samples:
+        series.append(t, y)
+    series_time = time.perf_counter() - start
+
+    if not np.allclose(frame.df.index.to_numpy(), series.t) or not np.allclose(frame.df["y"].to_numpy(), series.column("y")):
+        raise ValueError("windows differ")
+
+    return len(samples) / df_time, len(samples) / series_time
+
+
+def bench_fit(samples: list[tuple[float, float]], window: float, capacity: int, n: int = 1000) -> tuple[float, float]:
+    frame = WindowedDataFrame(window, columns=["t", "y"], index_column="t")
+    series = WindowedSeries(window, capacity=capacity)
+    for t, y in samples:
+        frame.append({"t": [t], "y": [y]})
+        series.append(t, y)
+
+    current_time = samples[-1][0]
+    if not math.isclose(fit_df(frame, current_time, window), fit_series(series, current_time, window), rel_tol=1e-9):
+        raise ValueError("fits differ")
+
+    start = time.perf_counter()
+    for _ in range(n):
+        fit_df(frame, current_time, window)
+    df_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for _ in range(n):
+        fit_series(series, current_time, window)
+    series_time = time.perf_counter() - start
+
+    return n / df_time, n / series_time
+
+
+def main():
+    for window, rate in [(10.0, 10.0), (30.0, 2.0), (60.0, 100.0)]:
+        samples = gen_samples(int(window * rate * 5), rate)
+        capacity = int(window * rate * 1.5)
+        df_append, series_append = bench_append(samples, window, capacity)
+        df_fit, series_fit = bench_fit(samples, window, capacity)
+
+        print(f"window {window:.0f} s @ {rate:.0f} Hz ({int(window * rate)} samples)")
+        print(f"  append: DataFrame {df_append:12,.0f}/s  series {series_append:12,.0f}/s  ({series_append / df_append:.1f}x)")
+        print(f"  fit:    DataFrame {df_fit:12,.0f}/s  series {series_fit:12,.0f}/s  ({series_fit / df_fit:.1f}x)")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,17 +1,31 @@
-from typing import Tuple, Coroutine, Optional
+from typing import Callable, Coroutine, Optional
 import asyncio
+import can
+import functools
 import logging
 from asyncio.tasks import Task
 from brewbot.can.mock import MockNode, MockState, gen_mock_nodes
 from brewbot.can.node_state import NodeState, gen_node_states
-from brewbot.config import CanEnvConfig, NodeConfig, NodeMessageConfig
+from brewbot.config import CanEnvConfig, NodeConfig, NodeMessageConfig, MsgTypeConfig
 from brewbot.assembly.assembly import Assembly, gen_assemblies
 from brewbot.util import async_infinite_loop, log_exceptions, collect_tasks
 from brewbot.can.can_port import CanPort
+from brewbot.can.send_queue import SendQueue
+from brewbot.can.recorder import FrameRecorder, DIRECTION_RX, DIRECTION_TX
+from brewbot.can.transport import Transport, is_transport_frame, EXPIRY_INTERVAL
+from brewbot.can.node_registry import NodeRegistry, NodeInfo
+from brewbot.can.event_bus import EventBus, MsgEvent, Subscription, POLICY_BLOCK, EVENT_REJECTED, EVENT_REPEATED
+from brewbot.can.util import pgn_to_can_id, MAX_TIMESTAMP_SKEW
 from cysystemd import journal
-from brewbot.can.msg_registry import MsgRegistry
+from brewbot.can.msg_registry import MsgRegistry, J1939_PGN_MASK, J1939_SRC_ADDR_MASK
+from brewbot.clock import Clock, SYSTEM_CLOCK
+from brewbot.data.rollup import RollupStore
+from brewbot.data.store import SignalStore
 
 
+# message broadcast by all nodes with type, firmware version and uptime
+NODE_INFO_MSG_KEY = "node_info"
+
 logger = logging.getLogger("brewbot.can.can_env")
 logger.setLevel(logging.INFO)
 
@@ -24,60 +38,135 @@ if not logger.hasHandlers():  # Prevent duplicate logs if already configured
 
 class CanEnv:
     conf: CanEnvConfig
-    can_port: CanPort
-    send_queue: list[Tuple[NodeConfig, NodeMessageConfig, dict]]
+    clock: Clock
+    can_ports: dict[str, CanPort]
+    connected_buses: set[str]
+    transports: dict[str, Transport]
+    last_rx_data: dict[str, dict[int, bytes]]
+    send_queue: SendQueue
+    recorder: Optional[FrameRecorder]
+    rollups: Optional[RollupStore]
+    store: Optional[SignalStore]
+    event_bus: EventBus
 
     msg_reg: MsgRegistry
+    node_registry: NodeRegistry
+    node_info_type: Optional[MsgTypeConfig]
+    node_info_id: Optional[int]
     node_states: dict[str, NodeState]
     assemblies: dict[str, Assembly]
 
     mock_nodes: dict[str, MockNode]
     mock_state: MockState
-    mock_msg_queue: list[Tuple[NodeConfig, NodeMessageConfig, dict]]
 
     main_queue: list[Coroutine]
     main_task: Optional[Task]
-    connect_can_task: Optional[Task]
+    connect_can_tasks: dict[str, Task]
     tasks: dict
 
-    def __init__(self, conf: CanEnvConfig):
+    def __init__(self, conf: CanEnvConfig, can_ports: Optional[dict[str, CanPort]] = None, clock: Clock = SYSTEM_CLOCK):
         self.conf = conf
+        self.clock = clock
 
         self.msg_reg = MsgRegistry(conf.nodes)
-        self.can_port = CanPort(conf.port)
-        self.can_port.event_handlers.append(self.can_port_event_handler)
+        self.node_registry = NodeRegistry(conf.nodes, clock)
+        self.node_registry.event_handlers.append(self.node_event_handler)
+
+        # node_info broadcasts are also accepted from addresses that are not configured (discovery)
+        self.node_info_type = next((msg_type for msg_type in conf.message_types if msg_type.key == NODE_INFO_MSG_KEY), None)
+        self.node_info_id = pgn_to_can_id(self.node_info_type.pgn, 0, 0, 0) & J1939_PGN_MASK if self.node_info_type is not None else None
+
+        # one port per configured bus, each with its own receive task feeding the shared dispatch
+        if can_ports is not None:
+            self.can_ports = can_ports
+        else:
+            self.can_ports = {bus_conf.key: CanPort(conf.port, conf.bus_config(bus_conf.key), clock) for bus_conf in conf.port.buses}
+
+        for bus_key, can_port in self.can_ports.items():
+            can_port.event_handlers.append(self.gen_can_port_event_handler(bus_key))
+
+        master_addr = conf.node('master').node_addr
+        self.transports = {
+            bus_key: Transport(master_addr, functools.partial(self.send_frame, bus_key), clock)
+            for bus_key in self.can_ports
+        }
+
+        self.set_filters()
+        self.msg_reg.change_handlers.append(self.msg_registry_change_handler)
+
+        self.send_queue = SendQueue(conf.port.send_queue_size)
+        self.recorder = FrameRecorder(conf.recorder, list(self.can_ports)) if conf.recorder is not None else None
+        # the history outlives reconnects of the buses
+        self.rollups = RollupStore([(r.interval, r.capacity) for r in conf.rollup.resolutions]) if conf.rollup is not None else None
+        self.store = SignalStore(conf.store) if conf.store is not None else None
+        # subscriptions (API clients, analytics, ...) outlive reconnects as well
+        self.event_bus = EventBus(clock)
+
+        self.mock_nodes = {}
+        self.node_states = {}
+        self.assemblies = {}
 
         self.main_queue = []
         self.main_task = None
-        self.connect_can_task = None
+        self.connect_can_tasks = {}
 
         self.reset_state()
 
     def reset_state(self):
+        self.connected_buses = set()
+        self.last_rx_data = {bus_key: {} for bus_key in self.can_ports}
+        self.unsubscribe_states()
         self.assemblies = {}
-        self.send_queue = []
+        self.send_queue.clear()
         self.node_states = {}
-        self.mock_msg_queue = []
+        self.shutdown_mock_nodes()
 
         self.tasks = {
             "mock_sources": {},
             "queue_tasks": {},
             "assemblies": {},
-            "handle_node_messages": None,
+            "handle_node_messages": {},
+            "history": {},
+            "node_liveness": None,
+            "store_flush": None,
+            "transport_expiry": None,
             "process_send_queue": None
         }
 
     def setup_nodes(self):
-        self.send_queue = []
-        self.node_states = gen_node_states(self.conf)
+        self.send_queue.clear()
+        self.node_registry.reset()
+        self.unsubscribe_states()
+        self.node_states = gen_node_states(self.conf, self.clock)
+        self.last_rx_data = {bus_key: {} for bus_key in self.can_ports}
+
+        for node_state in self.node_states.values():
+            node_state.subscribe(self.event_bus)
 
     def setup_mock_state(self):
-        self.mock_msg_queue = []
+        self.shutdown_mock_nodes()
         self.mock_state = MockState(self.conf, self.node_states)
-        self.mock_nodes = gen_mock_nodes(self.conf, self.mock_msg_queue, self.mock_state)
+        self.mock_nodes = gen_mock_nodes(self.conf, self.msg_reg, self.mock_state)
+
+    def shutdown_mock_nodes(self):
+        for mock_node in self.mock_nodes.values():
+            mock_node.shutdown()
+
+        self.mock_nodes = {}
 
     def setup_assemblies(self):
-        self.assemblies = gen_assemblies(self.conf.assemblies, self.node_states)
+        self.assemblies = gen_assemblies(self.conf.assemblies, self.node_states, self.clock)
+
+        for assembly in self.assemblies.values():
+            assembly.subscribe(self.event_bus)
+
+    def unsubscribe_states(self):
+        # the event bus outlives node states and assemblies, which are recreated on every startup
+        for assembly in self.assemblies.values():
+            assembly.unsubscribe(self.event_bus)
+
+        for node_state in self.node_states.values():
+            node_state.unsubscribe(self.event_bus)
 
     async def cancel_tasks(self):
         task_list = collect_tasks(self.tasks)
@@ -85,8 +174,10 @@ class CanEnv:
         for task in task_list:
             task.cancel()
 
-        for task in task_list:
-            await task
+        # `asyncio.wait` instead of awaiting the tasks directly: a cancellation of the calling task must not be passed
+        # on to (and swallowed by) the already cancelled tasks
+        if len(task_list) != 0:
+            await asyncio.wait(task_list)
 
         if all([task.done() for task in self.tasks.get('mock_sources', {}).values()]):
             self.tasks['mock_sources'] = {}
@@ -103,7 +194,17 @@ class CanEnv:
         else:
             raise ValueError("Error during task reset: awaited task not done")
 
-        for key in ["handle_node_messages", "process_send_queue"]:
+        if all([task.done() for task in self.tasks.get('handle_node_messages', {}).values()]):
+            self.tasks['handle_node_messages'] = {}
+        else:
+            raise ValueError("Error during task reset: awaited task not done")
+
+        if all([task.done() for task in self.tasks.get('history', {}).values()]):
+            self.tasks['history'] = {}
+        else:
+            raise ValueError("Error during task reset: awaited task not done")
+
+        for key in ["process_send_queue", "node_liveness", "store_flush", "transport_expiry"]:
             if key not in self.tasks or self.tasks[key] is None:
                 pass
             elif self.tasks[key].done():
@@ -112,6 +213,12 @@ class CanEnv:
                 raise ValueError("Error during task reset: awaited task not done")
 
     async def startup_coro(self):
+        if self.recorder is not None:
+            self.recorder.open()
+
+        if self.store is not None:
+            self.store.open()
+
         self.setup_nodes()
         self.setup_mock_state()
         self.setup_assemblies()
@@ -121,53 +228,239 @@ class CanEnv:
         await self.cancel_tasks()
         self.reset_state()
 
-    def can_port_event_handler(self, evt: str):
-        # evt is either 'connected' when a new can bus connection was established and 'shutdown' when the connection was shut down
+        if self.recorder is not None:
+            self.recorder.close()
+
+        if self.store is not None:
+            self.store.close()
+
+    async def bus_connected_coro(self, bus_key: str):
+        # nodes, assemblies etc. are started with the first connected bus
+        if len(self.connected_buses) == 0:
+            await self.startup_coro()
 
-        if evt == 'connected':
-            self.main_queue.append(self.startup_coro())
-        elif evt == 'shutdown':
-            self.main_queue.append(self.shutdown_coro())
+        self.connected_buses.add(bus_key)
+        self.create_receive_task(bus_key)
 
-    def receive_node_message(self):
-        msg = self.can_port.recv()
-        if msg is None:
-            return None
+    async def bus_shutdown_coro(self, bus_key: str):
+        if bus_key not in self.connected_buses:
+            return
 
-        return self.msg_reg.decode(msg)
+        self.connected_buses.remove(bus_key)
+
+        self.transports[bus_key].reset()
+        self.last_rx_data[bus_key] = {}
+
+        if len(self.connected_buses) == 0:
+            await self.shutdown_coro()
+        else:
+            task = self.tasks["handle_node_messages"].pop(bus_key, None)
+            if task is not None:
+                task.cancel()
+                await asyncio.wait([task])
+
+    def gen_can_port_event_handler(self, bus_key: str) -> Callable[[str], None]:
+        def can_port_event_handler(evt: str):
+            # evt is either 'connected' when a new can bus connection was established and 'shutdown' when the connection was shut down
+
+            if evt == 'connected':
+                self.main_queue.append(self.bus_connected_coro(bus_key))
+            elif evt == 'shutdown':
+                self.main_queue.append(self.bus_shutdown_coro(bus_key))
+
+        return can_port_event_handler
+
+    def set_filters(self):
+        for bus_key, can_port in self.can_ports.items():
+            can_filters = self.msg_reg.can_filters(bus_key)
+            if self.node_info_id is not None:
+                can_filters.append({"can_id": self.node_info_id, "can_mask": J1939_PGN_MASK, "extended": True})
+            can_port.set_filters(can_filters)
+
+    def msg_registry_change_handler(self):
+        self.set_filters()
+
+    def node_event_handler(self, info: NodeInfo, evt: str):
+        node_name = info.node_key if info.node_key is not None else f"{info.node_addr:#04x} on bus {info.bus}"
+
+        if evt == 'offline':
+            logger.warning(f"Node {node_name} went silent -> mark state stale")
+            node_state = self.node_states.get(info.node_key)
+            if node_state is not None:
+                node_state.mark_stale()
+
+            # the first frame after the node is back must be dispatched even if it repeats the last payload
+            last_rx_data = self.last_rx_data.get(info.bus, {})
+            for arbitration_id in [i for i in last_rx_data if i & J1939_SRC_ADDR_MASK == info.node_addr]:
+                del last_rx_data[arbitration_id]
+        elif evt == 'reboot':
+            logger.warning(f"Node {node_name} rebooted")
+        elif evt == 'discovered':
+            logger.info(f"Discovered unknown node {node_name}")
+
+    def handle_message(self, node: NodeConfig, msg_def: NodeMessageConfig, msg: dict, t: Optional[float] = None) -> None:
+        t = self.clock.time() if t is None else t
+
+        if msg_def.key == NODE_INFO_MSG_KEY:
+            self.node_registry.update_node_info(node.bus, node.node_addr, msg, t)
+        else:
+            self.node_registry.seen(node.bus, node.node_addr, t)
 
-    def handle_message(self, node: NodeConfig, msg_def: NodeMessageConfig, msg: dict) -> None:
         node_state = self.node_states.get(node.key)
 
-        if node_state is not None:
-            node_state.update_rx_state(msg_def, msg)
+        if node_state is not None and not node_state.update_rx_state(msg_def, msg, t):
+            # rejected by the node state (e.g. outlier), only the raw history keeps it
+            self.event_bus.publish(node.key, msg_def.key, msg, t, EVENT_REJECTED)
+            return
+
+        self.event_bus.publish(node.key, msg_def.key, msg, t)
+
+    def record_rollups(self, event: MsgEvent) -> None:
+        if event.kind == EVENT_REPEATED:
+            # the repeated value still counts as sample of the history (e.g. for the duty cycle of a relay)
+            self.rollups.repeat_message(event.node_key, event.msg_key, event.t)
+        else:
+            self.rollups.record_message(event.node_key, event.msg_key, event.msg, event.t)
+
+    def record_store(self, event: MsgEvent) -> None:
+        if event.kind != EVENT_REPEATED:
+            self.store.append_message(event.node_key, event.msg_key, event.msg, event.t)
+
+    def frame_time(self, msg: can.Message) -> float:
+        # receive time of the frame as stamped by the kernel (or the replayed log), so that queueing delays until
+        # dispatch don't show up in the measurements
+        now = self.clock.time()
+
+        if msg.timestamp <= 0.0 or abs(now - msg.timestamp) > MAX_TIMESTAMP_SKEW:
+            return now
+        else:
+            return min(msg.timestamp, now)
 
     def send_message(self, node: NodeConfig, msg_def: NodeMessageConfig, msg: dict) -> None:
-        msg_def = node.message(msg_def.key)
+        if node.bus not in self.can_ports:
+            return
 
-        if node.debug.get('mock', False):
-            self.mock_nodes[node.key].handle_message(msg_def, msg)
+        encoded_message = self.msg_reg.encode(node.key, msg_def.key, msg)
+
+        if msg_def.msg_type.is_multi_frame:
+            self.transports[node.bus].send_message(encoded_message)
         else:
-            encoded_message = self.msg_reg.encode(node.key, msg_def.key, msg)
-            self.can_port.send(encoded_message)
+            self.send_frame(node.bus, encoded_message)
+
+    def send_frame(self, bus_key: str, frame: can.Message) -> None:
+        self.can_ports[bus_key].send(frame)
+
+        if self.recorder is not None:
+            self.recorder.record(frame, DIRECTION_TX, bus_key)
+
+    def signal_keys(self) -> set[str]:
+        # keys of the signals of all received messages, as used by the rollups and the signal store
+        return {
+            f"{node.key}.{msg_def.key}.{signal.key}"
+            for node in self.msg_reg.nodes
+            for msg_def in node.messages if msg_def.direction == "rx"
+            for signal in msg_def.msg_type.signals
+        }
+
+    def stats(self) -> dict:
+        now = self.clock.time()
+        return {
+            "buses": {
+                bus_key: {
+                    **can_port.stats.to_dict(now),
+                    "nodes": self.msg_reg.node_stats(can_port.stats, now, bus_key),
+                    "unknown_ids": self.msg_reg.unknown_id_stats(now, bus_key)
+                }
+                for bus_key, can_port in self.can_ports.items()
+            },
+            "unknown_frames": self.msg_reg.unknown_frames,
+            "decode_failures": sum(self.msg_reg.decode_failures.values()),
+            "outliers": {
+                node_key: node_state.outlier_filter.stats()
+                for node_key, node_state in self.node_states.items()
+                if getattr(node_state, "outlier_filter", None) is not None
+            },
+            "event_bus": self.event_bus.stats()
+        }
 
     @async_infinite_loop
-    async def handle_node_messages_coro(self):
-        node_msg = self.receive_node_message()
+    async def handle_node_messages_coro(self, bus_key: str):
+        can_port = self.can_ports[bus_key]
+        transport = self.transports[bus_key]
+
+        for msg in await can_port.recv_batch():
+            if self.recorder is not None:
+                self.recorder.record(msg, DIRECTION_RX, bus_key)
+
+            if is_transport_frame(msg.arbitration_id):
+                # multi frame message -> continue with the reassembled message once complete
+                msg = transport.feed(msg)
+                if msg is None:
+                    continue
+
+            t = self.frame_time(msg)
+
+            if self.is_repeated(bus_key, msg, t):
+                continue
+
+            node_msg = self.msg_reg.decode(msg, bus_key, t)
+
+            if node_msg is not None:
+                self.handle_message(*node_msg, t)
+            elif msg.arbitration_id & J1939_PGN_MASK == self.node_info_id:
+                self.node_registry.update_node_info(bus_key, msg.arbitration_id & J1939_SRC_ADDR_MASK, self.node_info_type.decode_data(msg.data), t)
 
-        if node_msg  is not None:
-            self.handle_message(*node_msg)
-        elif len(self.mock_msg_queue) != 0:
-            self.handle_message(*self.mock_msg_queue.pop(0))
+        if self.event_bus.blocked:
+            # backpressure of `block` subscriptions: receive the next batch once they caught up
+            await self.event_bus.wait_blocked()
 
-        await asyncio.sleep(self.conf.port.process_interval)
+    def is_repeated(self, bus_key: str, msg: can.Message, t: Optional[float] = None) -> bool:
+        # frames of `dedup` message types that repeat the last payload of their arbitration id are neither decoded nor
+        # dispatched, they only refresh the liveness of the sender
+        entry = self.msg_reg.lookup(msg.arbitration_id, bus_key)
+        if entry is None or not entry.dedup:
+            return False
+
+        last_rx_data = self.last_rx_data[bus_key]
+        data = bytes(msg.data)
+
+        if last_rx_data.get(msg.arbitration_id) == data:
+            self.node_registry.seen(entry.node.bus, entry.node.node_addr, t)
+            self.event_bus.publish(entry.node.key, entry.msg_def.key, None, self.clock.time() if t is None else t, EVENT_REPEATED)
+            return True
+
+        last_rx_data[msg.arbitration_id] = data
+        return False
+
+    async def history_coro(self, subscription: Subscription, record: Callable[[MsgEvent], None]):
+        # events still pending on cancellation are recorded as well, e.g. before the store is closed on shutdown
+        try:
+            async for event in subscription:
+                record(event)
+        finally:
+            self.event_bus.unsubscribe_queue(subscription)
+            while (event := subscription.get_nowait()) is not None:
+                record(event)
+
+    def create_history_task(self, name: str, record: Callable[[MsgEvent], None]):
+        # `block`: the history doesn't lose samples, if it falls behind the reception pauses instead
+        subscription = self.event_bus.subscribe_queue(f"history.{name}", policy=POLICY_BLOCK, raw=True)
+        self.tasks["history"][name] = log_exceptions(asyncio.create_task(self.history_coro(subscription, record)), f"history.{name}")
 
     @async_infinite_loop
-    async def process_send_queue_coro(self):
-        if len(self.send_queue) != 0:
-            self.send_message(*self.send_queue.pop(0))
+    async def transport_expiry_coro(self):
+        await self.clock.sleep(EXPIRY_INTERVAL)
+        now = self.clock.time()
+
+        for bus_key in self.connected_buses:
+            transport = self.transports[bus_key]
+            if len(transport.rx_sessions) != 0:
+                transport.expire(now)
 
-        await asyncio.sleep(self.conf.port.process_interval)
+    @async_infinite_loop
+    async def process_send_queue_coro(self):
+        for node, msg_def, msg in await self.send_queue.wait_batch():
+            self.send_message(node, msg_def, msg)
 
     async def process_main_queue_coro(self):
         async def process_main_queue():
@@ -183,31 +476,53 @@ class CanEnv:
             await self.cancel_tasks()
             self.reset_state()
 
+            if self.recorder is not None:
+                self.recorder.close()
+
+            if self.store is not None:
+                self.store.close()
 
     def create_background_tasks(self):
         for node_key, node_mock in  self.mock_nodes.items():
             self.tasks["mock_sources"][node_key] = log_exceptions(asyncio.create_task(node_mock.queue_messages_coro()), f"mock_sources.{node_key}")
 
+        self.tasks["node_liveness"] = log_exceptions(asyncio.create_task(self.node_registry.liveness_coro()), "node_liveness")
+        self.tasks["transport_expiry"] = log_exceptions(asyncio.create_task(self.transport_expiry_coro()), "transport_expiry")
+
+        if self.rollups is not None:
+            self.create_history_task("rollups", self.record_rollups)
+
+        if self.store is not None:
+            self.create_history_task("store", self.record_store)
+            self.tasks["store_flush"] = log_exceptions(asyncio.create_task(async_infinite_loop(self.store.flush_coro)()), "store_flush")
+
         for node_key, node_state in self.node_states.items():
             self.tasks["queue_tasks"][node_key] = [log_exceptions(asyncio.create_task(coro()), f"queue_tasks.node_key[{i}]") for i, coro in enumerate(node_state.queue_coros(self.send_queue))]
 
-        self.tasks["handle_node_messages"] = log_exceptions(asyncio.create_task(self.handle_node_messages_coro()), "handle_node_messages")
         self.tasks["process_send_queue"] = log_exceptions(asyncio.create_task(self.process_send_queue_coro()), "process_send_queue")
         # app_state.tasks["simulate_mock_state"] = log_exceptions(asyncio.create_task(app_state.can_port.mock_state.simulation_task()), "simulate_mock_state")
         self.tasks["assemblies"] = {key: [log_exceptions(asyncio.create_task(coro), f"assemblies.{key}[{i}]") for i, coro in enumerate(assembly.coros())] for key, assembly in self.assemblies.items()}
 
+    def create_receive_task(self, bus_key: str):
+        if bus_key not in self.tasks["handle_node_messages"]:
+            self.tasks["handle_node_messages"][bus_key] = log_exceptions(asyncio.create_task(self.handle_node_messages_coro(bus_key)), f"handle_node_messages.{bus_key}")
+
     def run(self):
         if self.main_task is None:
             self.main_task = log_exceptions(asyncio.create_task(self.process_main_queue_coro()))
 
-        if self.connect_can_task is None:
-            self.connect_can_task = log_exceptions(asyncio.create_task(self.can_port.connect_can_coro()))
+        for bus_key, can_port in self.can_ports.items():
+            if bus_key not in self.connect_can_tasks:
+                self.connect_can_tasks[bus_key] = log_exceptions(asyncio.create_task(can_port.connect_can_coro()), f"connect_can.{bus_key}")
 
     async def stop(self):
-        if self.connect_can_task is not None:
-            self.connect_can_task.cancel()
-            await self.connect_can_task
-            self.connect_can_task = None
+        for task in self.connect_can_tasks.values():
+            task.cancel()
+
+        for task in self.connect_can_tasks.values():
+            await task
+
+        self.connect_can_tasks = {}
 
         if self.main_task is not None:
             self.main_task.cancel()
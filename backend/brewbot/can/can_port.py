@@ -1,13 +1,26 @@
 import can
 import asyncio
+import errno
 import logging
+import threading
+from collections import deque
 
-from brewbot.config import CanPortConfig
+from brewbot.config import CanPortConfig, CanBusConfig
+from brewbot.can.link_monitor import LinkMonitor
+from brewbot.can.stats import BusStats
+from brewbot.clock import Clock, SYSTEM_CLOCK
 from brewbot.util import  suppress_stderr
 from cysystemd import journal
-from typing import Callable
+from typing import Callable, Optional
 
 
+# receive timeout of the reader thread for interfaces without file descriptor. Only bounds the time the thread needs to
+# notice a shutdown, frames are passed on as soon as they arrive.
+READER_THREAD_TIMEOUT = 0.1
+
+# errors of socket operations that mean the can device is gone or its link is down
+DEVICE_LOST_ERRNOS = {errno.ENODEV, errno.ENETDOWN, errno.ENXIO}
+
 logger = logging.getLogger("brewbot.can.can_port")
 logger.setLevel(logging.INFO)
 
@@ -20,22 +33,56 @@ if not logger.hasHandlers():  # Prevent duplicate logs if already configured
 
 class CanPort:
     conf: CanPortConfig
+    bus_conf: Optional[CanBusConfig]
     bus: can.Bus
     event_handlers: list[Callable[[str], None]]
+    can_filters: Optional[list[dict]]
+    stats: BusStats
+    clock: Clock
 
-    def __init__(self, conf: CanPortConfig):
+    _rx_fd: Optional[int]
+    _rx_loop: Optional[asyncio.AbstractEventLoop]
+    _rx_buffer: deque[can.Message]
+    _rx_ready: asyncio.Event
+    _rx_paused: bool
+    _rx_thread_stop: Optional[threading.Event]
+    _link_monitor: Optional[LinkMonitor]
+    _connect_wakeup: asyncio.Event
+
+    def __init__(self, conf: CanPortConfig, bus_conf: Optional[CanBusConfig] = None, clock: Clock = SYSTEM_CLOCK):
         self.bus = None
+        self.clock = clock
         self.conf = conf
+        self.bus_conf = bus_conf if bus_conf is not None else conf.bus
         self.event_handlers = []
+        self.can_filters = None
+        self.stats = BusStats(self.bus_conf.bitrate if self.bus_conf is not None else 125000)
+
+        self._rx_fd = None
+        self._rx_loop = None
+        self._rx_buffer = deque(maxlen=conf.rx_buffer_size)
+        self._rx_ready = asyncio.Event()
+        self._rx_paused = False
+        self._rx_thread_stop = None
+        self._link_monitor = None
+        self._connect_wakeup = asyncio.Event()
 
         self.shutdown()
 
+    @property
+    def event_driven(self) -> bool:
+        return self._rx_fd is not None or self._rx_thread_stop is not None
+
     def shutdown(self) -> None:
+        self._remove_reader()
+
         if self.bus is not None:
             self.bus.shutdown()
 
         self.bus = None
         self.notify('shutdown')
+        # let the connect loop try to reconnect
+        self._connect_wakeup.set()
 
     def add_event_handler(self, event_handler: Callable[[str], None]) -> None:
         self.event_handlers.append(event_handler)
@@ -44,51 +91,169 @@ class CanPort:
         for event_handler in self.event_handlers:
             event_handler(evt)
 
+    def set_filters(self, can_filters: Optional[list[dict]]) -> None:
+        # `None` disables filtering; an empty list lets no frame pass
+        self.can_filters = can_filters
+
+        if self.bus is not None:
+            self.bus.set_filters(can_filters)
+
     def connect_can_device(self) -> None:
         if self.bus is not None:
             # can device already connected
             return
 
-        if self.conf.bus is None:
+        if self.bus_conf is None:
             raise ValueError("Cannot connect to can device: Can bus config is empty")
 
         try:
             with suppress_stderr():
                 self.bus = can.interface.Bus(
-                    self.conf.bus.channel,
-                    interface=self.conf.bus.interface
+                    self.bus_conf.channel,
+                    interface=self.bus_conf.interface,
+                    can_filters=self.can_filters
                 )
+                if self.bus_conf.receive_mode == "event":
+                    self._add_reader()
                 self.notify('connected')
-                print("Connection established to can device")
+                logger.info(f"Connection established to can device {self.bus_conf.channel}")
         except OSError as e:
-            if "[Errno 19]" in str(e):  # no such device error -> can device is not plugged in -> default error case
+            if e.errno in DEVICE_LOST_ERRNOS:  # can device is not plugged in or down -> default error case
                 pass
             else:
                 raise e
-        except can.exceptions.CanOperationError:
-            print("can error")
+        except can.exceptions.CanOperationError as e:
+            logger.warning(f"Cannot connect to can device {self.bus_conf.channel}: {e}")
+
+    def _add_reader(self) -> None:
+        try:
+            fd = self.bus.fileno()
+        except NotImplementedError:
+            fd = -1
+
+        self._rx_loop = asyncio.get_running_loop()
+
+        if fd < 0:
+            # nothing to register with the event loop (e.g. virtual interface) -> blocking receive in a thread
+            self._rx_thread_stop = threading.Event()
+            threading.Thread(
+                target=self._rx_thread,
+                args=(self.bus, self._rx_thread_stop),
+                name=f"can-rx-{self.bus_conf.channel}",
+                daemon=True
+            ).start()
+        else:
+            self._rx_loop.add_reader(fd, self._on_readable)
+            self._rx_fd = fd
+
+    def _remove_reader(self) -> None:
+        if self._rx_fd is not None and not self._rx_paused:
+            self._rx_loop.remove_reader(self._rx_fd)
+
+        if self._rx_thread_stop is not None:
+            self._rx_thread_stop.set()
+
+        self._rx_fd = None
+        self._rx_paused = False
+        self._rx_thread_stop = None
+        self._rx_loop = None
+        # frames of the old connection must not be returned after a reconnect
+        self._rx_buffer.clear()
+        # wake up a pending `recv_batch` so that it can fall back to polling
+        self._rx_ready.set()
+
+    def _on_readable(self) -> None:
+        # called by the event loop when the bus socket has pending frames -> drain them without blocking. If the
+        # receive loop falls behind (e.g. backpressure of the event bus) and the buffer is full, reading pauses until
+        # the next `recv_batch`, further frames wait in the socket buffer of the kernel.
+        while self.bus is not None:
+            if len(self._rx_buffer) == self._rx_buffer.maxlen:
+                self._rx_loop.remove_reader(self._rx_fd)
+                self._rx_paused = True
+                break
+
+            msg = self.recv(timeout=0.0)
+            if msg is None:
+                break
+            self._rx_buffer.append(msg)
+
+        if len(self._rx_buffer) != 0:
+            self._rx_ready.set()
+
+    def _rx_thread(self, bus: can.BusABC, stop: threading.Event) -> None:
+        loop = self._rx_loop
+
+        try:
+            while not stop.is_set():
+                msg = bus.recv(timeout=READER_THREAD_TIMEOUT)
+                if msg is None:
+                    continue
+
+                msgs = [msg]
+                while (msg := bus.recv(timeout=0.0)) is not None:
+                    msgs.append(msg)
+
+                loop.call_soon_threadsafe(self._on_thread_frames, msgs, stop)
+        except (OSError, can.exceptions.CanOperationError):
+            if not stop.is_set():
+                loop.call_soon_threadsafe(self._on_thread_error, stop)
+        except RuntimeError:
+            # event loop closed
             pass
 
+    def _on_thread_frames(self, msgs: list[can.Message], stop: threading.Event) -> None:
+        if not stop.is_set():
+            # the reader thread can't be paused -> the oldest frames are dropped if the buffer is full
+            self.stats.dropped_frames += max(len(self._rx_buffer) + len(msgs) - self._rx_buffer.maxlen, 0)
+            self._rx_buffer.extend(msgs)
+            self._rx_ready.set()
+
+    def _on_thread_error(self, stop: threading.Event) -> None:
+        if not stop.is_set():
+            logger.warning("Connection to can device lost -> shutdown")
+            self.shutdown()
+
+    async def recv_batch(self) -> list[can.Message]:
+        if not self.event_driven:
+            msg = self.recv()
+            await asyncio.sleep(self.conf.process_interval)
+            msgs = [msg] if msg is not None else []
+        else:
+            await self._rx_ready.wait()
+            self._rx_ready.clear()
+
+            msgs = list(self._rx_buffer)
+            self._rx_buffer.clear()
+
+            if self._rx_paused:
+                self._rx_loop.add_reader(self._rx_fd, self._on_readable)
+                self._rx_paused = False
+
+        for msg in msgs:
+            self.stats.record(msg)
+
+        return msgs
+
     def recv(self, *args, **kwargs):
         if self.bus is None:
             return None
 
         if 'timeout' not in kwargs:
-            kwargs['timeout'] = self.conf.bus.receive_timeout
+            kwargs['timeout'] = self.bus_conf.receive_timeout
 
         try:
             return self.bus.recv(*args, **kwargs)
         except OSError as e:
-            if "[Errno 19]" in str(e):
-                # no such device error -> can device was plugged out -> shutdown
-                print("Connection to can device lost -> shutdown")
+            if e.errno in DEVICE_LOST_ERRNOS:
+                # can device was plugged out -> shutdown
+                logger.warning("Connection to can device lost -> shutdown")
                 self.shutdown()
                 return None
             else:
                 raise e
         except can.exceptions.CanOperationError:
             # no such device error -> can device was plugged out -> shutdown
-            print("Connection to can device lost -> shutdown")
+            logger.warning("Connection to can device lost -> shutdown")
             self.shutdown()
             return None
 
@@ -98,9 +263,10 @@ class CanPort:
 
         try:
             self.bus.send(*args, **kwargs)
+            self.stats.record_tx(args[0] if len(args) != 0 else kwargs['msg'], self.clock.time())
         except OSError as e:
-            if "[Errno 19]" in str(e):
-                # no such device error -> can device was plugged out -> shutdown
+            if e.errno in DEVICE_LOST_ERRNOS:
+                # can device was plugged out -> shutdown
                 logger.warning("Connection to can device lost -> shutdown")
                 self.shutdown()
             else:
@@ -110,10 +276,56 @@ class CanPort:
             logger.warning("Connection to can device lost -> shutdown")
             self.shutdown()
 
+    def _start_link_monitor(self) -> None:
+        if self.bus_conf is None or self.bus_conf.interface != "socketcan":
+            return
+
+        monitor = LinkMonitor(self.bus_conf.channel, self._on_link_change)
+        try:
+            monitor.start()
+            self._link_monitor = monitor
+        except OSError as e:
+            logger.warning(f"Cannot monitor link state of {self.bus_conf.channel} ({e}) -> fall back to reconnect polling")
+
+    def _stop_link_monitor(self) -> None:
+        if self._link_monitor is not None:
+            self._link_monitor.stop()
+
+        self._link_monitor = None
+
+    def _on_link_change(self, is_up: bool) -> None:
+        logger.info(f"Link {self.bus_conf.channel} is {'up' if is_up else 'down'}")
+
+        if not is_up and self.bus is not None:
+            logger.warning("Connection to can device lost -> shutdown")
+            self.shutdown()
+
+        self._connect_wakeup.set()
+
     async def connect_can_coro(self):
+        # Connect attempts are triggered by link state changes (if the link can be monitored) and by a lost connection.
+        # Failed attempts are retried with exponential backoff as a fallback.
+        self._start_link_monitor()
+        interval = self.conf.device_connect_interval
+
         try:
             while True:
-                self.connect_can_device()
-                await asyncio.sleep(self.conf.device_connect_interval)
+                if self._link_monitor is None or self._link_monitor.is_up:
+                    self.connect_can_device()
+
+                if self.bus is not None:
+                    timeout = None
+                else:
+                    timeout = interval
+                    interval = min(interval * 2, self.conf.device_connect_max_interval)
+
+                self._connect_wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._connect_wakeup.wait(), timeout)
+                    interval = self.conf.device_connect_interval
+                except asyncio.TimeoutError:
+                    if self._link_monitor is not None:
+                        self._link_monitor.refresh()
         except asyncio.CancelledError:
+            self._stop_link_monitor()
             self.shutdown()
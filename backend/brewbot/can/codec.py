@@ -0,0 +1,235 @@
+import keyword
+import operator
+import numpy as np
+from collections.abc import Mapping
+from typing import Callable, Optional, Protocol
+
+# python types whose signal encoder / decoder is the identity and can be skipped in generated code
+IDENTITY_PY_TYPES = {"int", "float"}
+
+
+class SignalDef(Protocol):
+    key: str
+    start_bit: int
+    signal_size: int
+    signed: bool
+    value_scale: float
+    value_offset: float
+    value_min: float
+    value_max: float
+    py_type: str
+    encode_signal: Callable
+    decode_signal: Callable
+    np_dtype: np.dtype
+
+
+def _is_integer(v: float) -> bool:
+    return abs(v - int(v)) < 1e-12
+
+
+def _raw_to_scaled_expr(signal: SignalDef, raw_expr: str) -> str:
+    # same arithmetic as cantools' identity, linear integer and linear conversions so results are identical
+    if signal.value_scale == 1 and signal.value_offset == 0:
+        return raw_expr
+    elif _is_integer(signal.value_scale) and _is_integer(signal.value_offset):
+        return f"({raw_expr} * {int(signal.value_scale)} + {int(signal.value_offset)})"
+    elif signal.value_offset == 0:
+        return f"{raw_expr} * {signal.value_scale!r}"
+    else:
+        return f"({raw_expr} * {signal.value_scale!r} + {signal.value_offset!r})"
+
+
+def _scaled_to_raw_expr(signal: SignalDef, scaled_expr: str) -> str:
+    if signal.value_scale == 1 and signal.value_offset == 0:
+        return f"round({scaled_expr})"
+    elif _is_integer(signal.value_scale) and _is_integer(signal.value_offset):
+        return f"_scaled_to_raw_int({scaled_expr}, {int(signal.value_scale)}, {int(signal.value_offset)})"
+    elif signal.value_offset == 0:
+        return f"round({scaled_expr} / {signal.value_scale!r})"
+    else:
+        return f"round(({scaled_expr} - {signal.value_offset!r}) / {signal.value_scale!r})"
+
+
+def _scaled_to_raw_int(scaled_value, scale: int, offset: int) -> int:
+    # avoid a loss of precision when the value is a multiple of the scale (mirrors cantools)
+    raw = scaled_value - offset
+    quotient, remainder = divmod(raw, scale)
+    if remainder == 0:
+        return round(quotient)
+    else:
+        return round(raw / scale)
+
+
+def _compile(name: str, src: str, namespace: dict) -> Callable:
+    code = compile(src, f"<brewbot.can.codec {name}>", "exec")
+    exec(code, namespace)
+    fun = namespace[name]
+    fun.__source__ = src
+    return fun
+
+
+class MsgRecord(Mapping):
+    """
+    Base of the decoded message records generated by `compile_record_class`. The signal values are slots of the record,
+    the read-only mapping interface (`msg['temp_c']`, `get`, `items`, comparison with dicts, ...) keeps the records
+    interchangeable with the dicts messages used to be.
+
+    Records have no `__init__` (calling a class without it is considerably cheaper), `make` creates a record from the
+    signal values in signal order.
+    """
+    __slots__ = ()
+
+    _fields: tuple[str, ...] = ()
+
+    @classmethod
+    def make(cls) -> "MsgRecord":
+        return cls()
+
+    def __getitem__(self, key: str):
+        raise KeyError(key)
+
+    def __iter__(self):
+        return iter(self._fields)
+
+    def __len__(self) -> int:
+        return len(self._fields)
+
+    def __contains__(self, key) -> bool:
+        return key in self._fields
+
+    def keys(self) -> tuple[str, ...]:
+        return self._fields
+
+    def values(self) -> tuple:
+        return ()
+
+    def items(self) -> tuple[tuple[str, object], ...]:
+        return ()
+
+    def to_dict(self) -> dict:
+        return dict(self.items())
+
+    def __repr__(self) -> str:
+        return f"{type(self).__name__}({', '.join(f'{k}={v!r}' for k, v in self.items())})"
+
+
+def compile_record_class(msg_key: str, signals: list[SignalDef]) -> type[MsgRecord]:
+    """
+    Generates a `MsgRecord` subclass with one slot per signal, in signal order. `__getitem__` looks the key up in a
+    table of attribute getters, constant time for any number of signals. `values` and `items` are generated.
+    """
+    fields = tuple(signal.key for signal in signals)
+    for field in fields:
+        if not field.isidentifier() or keyword.iskeyword(field) or field.startswith("_") or hasattr(MsgRecord, field):
+            raise ValueError(f"Signal key {field!r} of message {msg_key} can not be used as record field")
+
+    name = "".join(part.capitalize() for part in msg_key.split("_")) + "Msg"
+    lines = [f"class {name}(MsgRecord):", f"    __slots__ = {fields!r}", f"    _fields = {fields!r}"]
+
+    lines.append("    @classmethod")
+    lines.append(f"    def make(cls, {', '.join(fields)}):" if len(fields) != 0 else "    def make(cls):")
+    lines.append("        record = cls()")
+    lines.extend(f"        record.{field} = {field}" for field in fields)
+    lines.append("        return record")
+
+    # `_getters` is a global of the generated code: faster than a class attribute, and unknown keys raise KeyError
+    lines.append("    def __getitem__(self, key):")
+    lines.append("        return _getters[key](self)")
+
+    lines.append("    def values(self):")
+    lines.append(f"        return ({''.join(f'self.{field}, ' for field in fields)})")
+    lines.append("    def items(self):")
+    lines.append(f"        return ({''.join(f'({field!r}, self.{field}), ' for field in fields)})")
+
+    getters = {field: operator.attrgetter(field) for field in fields}
+    return _compile(name, "\n".join(lines) + "\n", {"MsgRecord": MsgRecord, "_getters": getters})
+
+
+def compile_decoder(msg_key: str, signals: list[SignalDef], record_class: Optional[type[MsgRecord]] = None) -> Callable[[bytes], MsgRecord]:
+    """
+    Generates a decoder function `data -> record` for little endian signals that extracts all signal values from the
+    payload with shifts and masks and stores them in a record of the message (see `compile_record_class`).
+    """
+    name = f"decode_{msg_key}"
+    record_class = compile_record_class(msg_key, signals) if record_class is None else record_class
+    namespace = {"_record_class": record_class}
+    lines = [f"def {name}(data):", "    raw = int.from_bytes(data, 'little')"]
+    items = []
+
+    for i, signal in enumerate(signals):
+        mask = (1 << signal.signal_size) - 1
+        shifted = f"(raw >> {signal.start_bit})" if signal.start_bit != 0 else "raw"
+        lines.append(f"    v{i} = {shifted} & {hex(mask)}")
+
+        if signal.signed:
+            lines.append(f"    if v{i} & {hex(1 << (signal.signal_size - 1))}:")
+            lines.append(f"        v{i} -= {hex(1 << signal.signal_size)}")
+
+        value_expr = _raw_to_scaled_expr(signal, f"v{i}")
+        if signal.py_type not in IDENTITY_PY_TYPES:
+            namespace[f"_decode_{i}"] = signal.decode_signal
+            value_expr = f"_decode_{i}({value_expr})"
+
+        items.append(value_expr)
+
+    lines.append("    record = _record_class()")
+    lines.extend(f"    record.{signal.key} = {value_expr}" for signal, value_expr in zip(signals, items))
+    lines.append("    return record")
+    return _compile(name, "\n".join(lines) + "\n", namespace)
+
+
+def compile_encoder(msg_key: str, signals: list[SignalDef], length: int) -> Callable[[dict], bytes]:
+    """
+    Generates an encoder function `{signal key: value} -> data` that is the inverse of `compile_decoder`. Values are
+    range checked against the signal's min / max like cantools' strict encoding.
+    """
+    name = f"encode_{msg_key}"
+    namespace = {"_scaled_to_raw_int": _scaled_to_raw_int}
+    lines = [f"def {name}(d):", "    raw = 0"]
+
+    for i, signal in enumerate(signals):
+        mask = (1 << signal.signal_size) - 1
+        tolerance = abs(signal.value_scale) * 1e-6
+
+        if signal.py_type not in IDENTITY_PY_TYPES:
+            namespace[f"_encode_{i}"] = signal.encode_signal
+            lines.append(f"    v{i} = _encode_{i}(d[{signal.key!r}])")
+        else:
+            lines.append(f"    v{i} = d[{signal.key!r}]")
+
+        lines.append(f"    if not ({signal.value_min - tolerance!r} <= v{i} <= {signal.value_max + tolerance!r}):")
+        lines.append(f"        raise ValueError(f'value of signal {signal.key} out of range [{signal.value_min}, {signal.value_max}]: {{v{i}}}')")
+
+        shift = f" << {signal.start_bit}" if signal.start_bit != 0 else ""
+        lines.append(f"    raw |= ({_scaled_to_raw_expr(signal, f'v{i}')} & {hex(mask)}){shift}")
+
+    lines.append(f"    return raw.to_bytes({length}, 'little')")
+    return _compile(name, "\n".join(lines) + "\n", namespace)
+
+
+def decode_array(signals: list[SignalDef], raw: np.ndarray, out: np.ndarray) -> None:
+    """
+    Vectorized counterpart of `compile_decoder`: decodes the little endian payloads `raw` (one uint64 per frame) into
+    the fields of the structured array `out`.
+    """
+    for signal in signals:
+        v = (raw >> np.uint64(signal.start_bit)) & np.uint64((1 << signal.signal_size) - 1)
+
+        if signal.signed:
+            # move the sign bit to bit 63 and shift back arithmetically to sign extend
+            unused_bits = np.int64(64 - signal.signal_size)
+            v = (v.view(np.int64) << unused_bits) >> unused_bits
+        else:
+            v = v.astype(np.int64) if signal.signal_size < 64 else v
+
+        if signal.py_type == "flag":
+            out[signal.key] = v != 0
+        elif signal.py_type in IDENTITY_PY_TYPES:
+            if signal.value_scale == 1 and signal.value_offset == 0:
+                out[signal.key] = v
+            elif _is_integer(signal.value_scale) and _is_integer(signal.value_offset):
+                out[signal.key] = v * int(signal.value_scale) + int(signal.value_offset)
+            else:
+                out[signal.key] = v * signal.value_scale + signal.value_offset
+        else:
+            raise ValueError(f"Unsupported signal type for array decoding: {signal.py_type}")
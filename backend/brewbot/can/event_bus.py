@@ -0,0 +1,314 @@
+import asyncio
+from collections import deque
+from brewbot.clock import Clock, SYSTEM_CLOCK
+from typing import Callable, Optional, Tuple
+
+# delivery policies of queued subscriptions when the consumer falls behind
+POLICY_DROP_OLDEST = "drop_oldest"  # bounded queue, the oldest pending event is dropped for a new one
+POLICY_LATEST_ONLY = "latest_only"  # only the latest pending event per (node, message) is kept
+POLICY_BLOCK = "block"  # the receive loop waits for the consumer (backpressure), may exceed the size by one batch
+POLICIES = (POLICY_DROP_OLDEST, POLICY_LATEST_ONLY, POLICY_BLOCK)
+
+DEFAULT_QUEUE_SIZE = 1024
+
+# kinds of events. Messages rejected by their node state (e.g. outliers) and frames repeating the last payload of a
+# `dedup` message (not decoded, `msg` is `None`) are only delivered to raw subscriptions, i.e. the history.
+EVENT_MESSAGE = "message"
+EVENT_REJECTED = "rejected"
+EVENT_REPEATED = "repeated"
+
+
+class MsgEvent:
+    __slots__ = ("node_key", "msg_key", "msg", "t", "kind")
+
+    node_key: str
+    msg_key: str
+    msg: Optional[dict]
+    t: float  # receive time of the frame
+    kind: str
+
+    def __init__(self, node_key: str, msg_key: str, msg: Optional[dict], t: float, kind: str = EVENT_MESSAGE):
+        self.node_key = node_key
+        self.msg_key = msg_key
+        self.msg = msg
+        self.t = t
+        self.kind = kind
+
+    @property
+    def topic(self) -> Tuple[str, str]:
+        return self.node_key, self.msg_key
+
+    def to_dict(self) -> dict:
+        return {"node_key": self.node_key, "msg_key": self.msg_key, "msg": dict(self.msg), "t": self.t}
+
+
+class Subscription:
+    """
+    Queue of the events of an async consumer, read with `get` or `async for`. The queue is filled by the publisher
+    without waiting, `policy` decides what happens when the consumer falls behind (see `POLICIES`). Counters and the
+    lag (age of the oldest pending event) tell how far behind it is.
+    """
+    name: str
+    node_key: Optional[str]  # `None` matches all nodes
+    msg_key: Optional[str]  # `None` matches all messages
+    policy: str
+    raw: bool  # also receives rejected and repeated events
+    max_size: int
+    clock: Clock
+    closed: bool
+
+    received: int
+    delivered: int
+    dropped: int
+    max_pending: int
+    last_latency: Optional[float]  # time from the reception of the latest delivered event until its delivery
+    max_latency: float
+
+    _queue: deque[MsgEvent]
+    _latest: dict[Tuple[str, str], MsgEvent]
+    _ready: asyncio.Event
+    _space: asyncio.Event
+
+    def __init__(self, name: str, node_key: Optional[str] = None, msg_key: Optional[str] = None, policy: str = POLICY_DROP_OLDEST, max_size: int = DEFAULT_QUEUE_SIZE, raw: bool = False, clock: Clock = SYSTEM_CLOCK):
+        if policy not in POLICIES:
+            raise ValueError(f"Invalid subscription policy `{policy}`, expected one of {', '.join(POLICIES)}")
+        if max_size < 1:
+            raise ValueError("Subscription queue size must be >= 1")
+
+        self.name = name
+        self.node_key = node_key
+        self.msg_key = msg_key
+        self.policy = policy
+        self.raw = raw
+        self.max_size = max_size
+        self.clock = clock
+        self.closed = False
+
+        self.received = 0
+        self.delivered = 0
+        self.dropped = 0
+        self.max_pending = 0
+        self.last_latency = None
+        self.max_latency = 0.0
+
+        self._queue = deque(maxlen=max_size if policy == POLICY_DROP_OLDEST else None)
+        self._latest = {}
+        self._ready = asyncio.Event()
+        self._space = asyncio.Event()
+
+    def matches(self, node_key: str, msg_key: str) -> bool:
+        return (self.node_key is None or self.node_key == node_key) and (self.msg_key is None or self.msg_key == msg_key)
+
+    def __len__(self) -> int:
+        return len(self._latest) if self.policy == POLICY_LATEST_ONLY else len(self._queue)
+
+    @property
+    def is_full(self) -> bool:
+        return len(self) >= self.max_size
+
+    def put(self, event: MsgEvent) -> None:
+        self.received += 1
+
+        if self.policy == POLICY_LATEST_ONLY:
+            # re-insert to keep the pending topics in the order of their latest event
+            if self._latest.pop(event.topic, None) is not None:
+                self.dropped += 1
+            self._latest[event.topic] = event
+        else:
+            if self.policy == POLICY_DROP_OLDEST and len(self._queue) == self.max_size:
+                self.dropped += 1
+            self._queue.append(event)
+
+        self.max_pending = max(self.max_pending, len(self))
+        self._ready.set()
+
+    def get_nowait(self) -> Optional[MsgEvent]:
+        if self.policy == POLICY_LATEST_ONLY:
+            if len(self._latest) == 0:
+                return None
+            event = self._latest.pop(next(iter(self._latest)))
+        else:
+            if len(self._queue) == 0:
+                return None
+            event = self._queue.popleft()
+
+            if self.policy == POLICY_BLOCK and len(self._queue) < self.max_size:
+                self._space.set()
+
+        self.delivered += 1
+        self.last_latency = self.clock.time() - event.t
+        self.max_latency = max(self.max_latency, self.last_latency)
+        return event
+
+    async def get(self) -> MsgEvent:
+        while True:
+            event = self.get_nowait()
+            if event is not None:
+                return event
+            elif self.closed:
+                raise ValueError(f"Subscription {self.name} is closed")
+
+            self._ready.clear()
+            await self._ready.wait()
+
+    async def wait_space(self) -> None:
+        while self.is_full and not self.closed:
+            self._space.clear()
+            await self._space.wait()
+
+    def close(self) -> None:
+        # pending events can still be read, waiting consumers and publishers are released
+        self.closed = True
+        self._ready.set()
+        self._space.set()
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self) -> MsgEvent:
+        if self.closed and len(self) == 0:
+            raise StopAsyncIteration
+
+        try:
+            return await self.get()
+        except ValueError:
+            raise StopAsyncIteration
+
+    def lag(self) -> float:
+        # age of the oldest pending event
+        if len(self) == 0:
+            return 0.0
+
+        oldest = next(iter(self._latest.values())) if self.policy == POLICY_LATEST_ONLY else self._queue[0]
+        return self.clock.time() - oldest.t
+
+    def stats(self) -> dict:
+        return {
+            "node_key": self.node_key,
+            "msg_key": self.msg_key,
+            "policy": self.policy,
+            "raw": self.raw,
+            "max_size": self.max_size,
+            "pending": len(self),
+            "max_pending": self.max_pending,
+            "received": self.received,
+            "delivered": self.delivered,
+            "dropped": self.dropped,
+            "lag": self.lag(),
+            "last_latency": self.last_latency,
+            "max_latency": self.max_latency
+        }
+
+
+class EventBus:
+    """
+    Publishes the decoded node messages to subscribers. Callbacks (`subscribe`) are called synchronously within the
+    receive loop and must be fast, they are reserved for the state the control loops act on (node states, sensor
+    fusion). Everything else (history, API clients, ...) consumes a `Subscription` queue (`subscribe_queue`) in its own
+    task.
+    Publishing never waits: subscriptions with the `block` policy that are full are only waited for by `wait_blocked`,
+    which the receive loop calls after each batch of frames, so backpressure pauses the reception instead of the
+    dispatch of the current batch. Meanwhile frames collect in the bounded receive buffer of the port (see
+    `CanPortConfig.rx_buffer_size`): a full buffer stops reading from the socket, so further frames queue in the kernel
+    (which drops them once its socket buffer is full), or with the reader thread the oldest frames are dropped and
+    counted in `BusStats.dropped_frames`.
+
+    The subscribers of a (node, message) are resolved once and cached until the subscriptions change.
+    """
+    clock: Clock
+    callbacks: list[Tuple[Optional[str], Optional[str], Callable[[MsgEvent], None]]]
+    subscriptions: dict[str, Subscription]
+
+    published: int
+    blocked_time: float  # total time the receive loop waited for `block` subscriptions
+
+    _targets: dict[Tuple[str, str], Tuple[list[Callable[[MsgEvent], None]], list[Subscription]]]
+    _blocking: list[Subscription]
+
+    def __init__(self, clock: Clock = SYSTEM_CLOCK):
+        self.clock = clock
+        self.callbacks = []
+        self.subscriptions = {}
+
+        self.published = 0
+        self.blocked_time = 0.0
+
+        self._targets = {}
+        self._blocking = []
+
+    def subscribe(self, callback: Callable[[MsgEvent], None], node_key: Optional[str] = None, msg_key: Optional[str] = None) -> None:
+        self.callbacks.append((node_key, msg_key, callback))
+        self._targets = {}
+
+    def unsubscribe(self, callback: Callable[[MsgEvent], None]) -> None:
+        self.callbacks = [entry for entry in self.callbacks if entry[2] != callback]
+        self._targets = {}
+
+    def subscribe_queue(self, name: str, node_key: Optional[str] = None, msg_key: Optional[str] = None, policy: str = POLICY_DROP_OLDEST, max_size: int = DEFAULT_QUEUE_SIZE, raw: bool = False) -> Subscription:
+        if name in self.subscriptions:
+            raise ValueError(f"Subscription {name} already exists")
+
+        subscription = Subscription(name, node_key, msg_key, policy, max_size, raw, self.clock)
+        self.subscriptions[name] = subscription
+        self._update_subscriptions()
+        return subscription
+
+    def unsubscribe_queue(self, subscription: Subscription) -> None:
+        if self.subscriptions.get(subscription.name) is subscription:
+            del self.subscriptions[subscription.name]
+            self._update_subscriptions()
+
+        subscription.close()
+
+    def _update_subscriptions(self) -> None:
+        self._targets = {}
+        self._blocking = [s for s in self.subscriptions.values() if s.policy == POLICY_BLOCK]
+
+    def _resolve(self, node_key: str, msg_key: str) -> Tuple[list[Callable[[MsgEvent], None]], list[Subscription]]:
+        targets = (
+            [callback for n, m, callback in self.callbacks if (n is None or n == node_key) and (m is None or m == msg_key)],
+            [s for s in self.subscriptions.values() if s.matches(node_key, msg_key)]
+        )
+        self._targets[(node_key, msg_key)] = targets
+        return targets
+
+    def publish(self, node_key: str, msg_key: str, msg: Optional[dict], t: float, kind: str = EVENT_MESSAGE) -> None:
+        targets = self._targets.get((node_key, msg_key))
+        if targets is None:
+            targets = self._resolve(node_key, msg_key)
+
+        callbacks, subscriptions = targets
+        if len(callbacks) == 0 and len(subscriptions) == 0:
+            return
+
+        event = MsgEvent(node_key, msg_key, msg, t, kind)
+        self.published += 1
+
+        if kind == EVENT_MESSAGE:
+            for callback in callbacks:
+                callback(event)
+
+            for subscription in subscriptions:
+                subscription.put(event)
+        else:
+            for subscription in subscriptions:
+                if subscription.raw:
+                    subscription.put(event)
+
+    @property
+    def blocked(self) -> bool:
+        return any(s.is_full for s in self._blocking)
+
+    async def wait_blocked(self) -> None:
+        start = self.clock.time()
+        for subscription in self._blocking:
+            await subscription.wait_space()
+        self.blocked_time += self.clock.time() - start
+
+    def stats(self) -> dict:
+        return {
+            "published": self.published,
+            "callbacks": len(self.callbacks),
+            "blocked_time": self.blocked_time,
+            "subscriptions": {name: s.stats() for name, s in self.subscriptions.items()}
+        }
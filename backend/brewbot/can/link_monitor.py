@@ -0,0 +1,140 @@
+import asyncio
+import socket
+import struct
+from typing import Callable, Optional
+
+# rtnetlink constants (linux/rtnetlink.h, linux/if_link.h, linux/if.h)
+RTMGRP_LINK = 0x1
+RTM_NEWLINK = 16
+RTM_DELLINK = 17
+IFLA_IFNAME = 3
+IFF_UP = 0x1
+
+NLMSG_HEADER = struct.Struct("=IHHII")  # length, type, flags, seq, pid
+IFINFO_MSG = struct.Struct("=BxHiII")  # family, device type, index, flags, change
+RT_ATTR = struct.Struct("=HH")  # length, type
+
+RECV_BUFFER_SIZE = 65536
+
+
+def _align(length: int) -> int:
+    return (length + 3) & ~3
+
+
+def read_link_state(ifname: str) -> Optional[bool]:
+    """
+    Current state of the network interface from sysfs: `True` if up, `False` if down and `None` if the interface
+    does not exist.
+    """
+    try:
+        with open(f"/sys/class/net/{ifname}/flags") as f:
+            return int(f.read().strip(), 16) & IFF_UP != 0
+    except (FileNotFoundError, ValueError):
+        return None
+
+
+def parse_link_messages(data: bytes) -> list[tuple[str, bool]]:
+    # (interface name, is up) for every link message in a netlink datagram
+    links = []
+    offset = 0
+
+    while offset + NLMSG_HEADER.size <= len(data):
+        msg_len, msg_type, _, _, _ = NLMSG_HEADER.unpack_from(data, offset)
+        if msg_len < NLMSG_HEADER.size:
+            break
+
+        if msg_type in (RTM_NEWLINK, RTM_DELLINK):
+            _, _, _, flags, _ = IFINFO_MSG.unpack_from(data, offset + NLMSG_HEADER.size)
+
+            attr_offset = offset + NLMSG_HEADER.size + IFINFO_MSG.size
+            while attr_offset + RT_ATTR.size <= offset + msg_len:
+                attr_len, attr_type = RT_ATTR.unpack_from(data, attr_offset)
+                if attr_len < RT_ATTR.size:
+                    break
+
+                if attr_type == IFLA_IFNAME:
+                    ifname = data[attr_offset + RT_ATTR.size:attr_offset + attr_len].split(b"\0", 1)[0].decode()
+                    links.append((ifname, msg_type == RTM_NEWLINK and flags & IFF_UP != 0))
+                    break
+
+                attr_offset += _align(attr_len)
+
+        offset += _align(msg_len)
+
+    return links
+
+
+class LinkMonitor:
+    """
+    Watches the link state of a network interface through rtnetlink link notifications. `on_change` is called on the
+    event loop whenever the interface goes up or down (including removal of the device).
+    """
+    ifname: str
+    on_change: Callable[[bool], None]
+    is_up: Optional[bool]
+
+    _sock: Optional[socket.socket]
+    _loop: Optional[asyncio.AbstractEventLoop]
+
+    def __init__(self, ifname: str, on_change: Callable[[bool], None]):
+        self.ifname = ifname
+        self.on_change = on_change
+        self.is_up = None
+
+        self._sock = None
+        self._loop = None
+
+    @property
+    def running(self) -> bool:
+        return self._sock is not None
+
+    def start(self) -> None:
+        if self._sock is not None:
+            return
+
+        sock = socket.socket(socket.AF_NETLINK, socket.SOCK_RAW, socket.NETLINK_ROUTE)
+        try:
+            sock.bind((0, RTMGRP_LINK))
+            sock.setblocking(False)
+            self._loop = asyncio.get_running_loop()
+            self._loop.add_reader(sock.fileno(), self._on_readable)
+        except OSError:
+            sock.close()
+            raise
+
+        self._sock = sock
+        # subscribe first, then read the initial state so that no transition gets lost in between
+        self.is_up = read_link_state(self.ifname) or False
+
+    def stop(self) -> None:
+        if self._sock is not None:
+            self._loop.remove_reader(self._sock.fileno())
+            self._sock.close()
+
+        self._sock = None
+        self._loop = None
+
+    def refresh(self) -> bool:
+        # re-read the state from sysfs, e.g. after the socket buffer overflowed and notifications were lost
+        self._set_state(read_link_state(self.ifname) or False)
+        return self.is_up
+
+    def _on_readable(self) -> None:
+        while self._sock is not None:
+            try:
+                data = self._sock.recv(RECV_BUFFER_SIZE)
+            except BlockingIOError:
+                break
+            except OSError:
+                # ENOBUFS: notifications were dropped -> fall back to the current state
+                self.refresh()
+                break
+
+            for ifname, is_up in parse_link_messages(data):
+                if ifname == self.ifname:
+                    self._set_state(is_up)
+
+    def _set_state(self, is_up: bool) -> None:
+        if is_up != self.is_up:
+            self.is_up = is_up
+            self.on_change(is_up)
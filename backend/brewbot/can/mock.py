@@ -1,38 +1,138 @@
 import asyncio
-from brewbot.util import load_object
-from brewbot.config import CanEnvConfig, NodeConfig, NodeMessageConfig
+import can
+import logging
+from brewbot.util import load_object, suppress_stderr
+from brewbot.config import CanEnvConfig, CanBusConfig, NodeConfig, NodeMessageConfig
+from brewbot.can.can_port import DEVICE_LOST_ERRNOS
+from brewbot.can.msg_registry import MsgRegistry
 from brewbot.can.node_state import NodeState
+from brewbot.can.util import can_id_to_pgn
+from cysystemd import journal
 import random
-from typing import Protocol, Tuple
+from typing import Protocol, Optional
+
+logger = logging.getLogger("brewbot.can.mock")
+logger.setLevel(logging.INFO)
+
+if not logger.hasHandlers():  # Prevent duplicate logs if already configured
+    handler = journal.JournaldLogHandler()
+    formatter = logging.Formatter("[%(levelname)s] %(asctime)s %(name)s: %(message)s")
+    handler.setFormatter(formatter)
+    logger.addHandler(handler)
 
 
 class MockNode(Protocol):
     async def queue_messages_coro(self) -> None:
         ...
 
-    def handle_message(self, msg_def: NodeMessageConfig, msg: dict) -> None:
+    def shutdown(self) -> None:
         ...
 
 
-class MockThermometer(MockNode):
+class MockBusNode(MockNode):
+    """
+    Mock node with its own endpoint on the can bus. Messages are encoded into frames and sent over the bus, frames
+    addressed to the node are read back from it, so that mock runs go through the same encode / decode path as real
+    nodes. The endpoint is opened on the mock channel of the node's bus (see `CanBusConfig.mock_config`), which is
+    virtual: with `interface: "virtual"` all endpoints in the process share the channel without any hardware, with
+    socketcan a vcan device is used. The endpoint connects in the message task and reconnects if the channel is lost.
+    """
     conf: CanEnvConfig
     node_conf: NodeConfig
-    msg_queue: list[Tuple[NodeConfig, NodeMessageConfig, dict]]
+    bus_conf: CanBusConfig
+    msg_reg: MsgRegistry
     mock_state: "MockState"
     msg_interval: float
+    bus: Optional[can.BusABC]
+
+    def __init__(self, conf: CanEnvConfig, node_conf: NodeConfig, msg_reg: MsgRegistry, mock_state: "MockState"):
+        self.conf = conf
+        self.node_conf = node_conf
+        self.bus_conf = conf.port.bus_config(node_conf.bus).mock_config()
+        self.msg_reg = msg_reg
+        self.mock_state = mock_state
+        self.msg_interval = 0.1
+        self.bus = None
+
+    def connect(self) -> None:
+        if self.bus is not None:
+            return
+
+        try:
+            with suppress_stderr():
+                self.bus = can.interface.Bus(self.bus_conf.channel, interface=self.bus_conf.interface)
+            logger.info(f"Mock node {self.node_conf.key} connected to {self.bus_conf.channel}")
+        except OSError as e:
+            if e.errno not in DEVICE_LOST_ERRNOS:  # device not present or down -> retried silently
+                logger.warning(f"Cannot connect mock node {self.node_conf.key} to {self.bus_conf.channel}: {e}")
+        except can.exceptions.CanOperationError as e:
+            logger.warning(f"Cannot connect mock node {self.node_conf.key} to {self.bus_conf.channel}: {e}")
+
+    def shutdown(self) -> None:
+        if self.bus is not None:
+            self.bus.shutdown()
+
+        self.bus = None
+
+    def send(self, msg_key: str, msg: dict) -> None:
+        if self.bus is None:
+            return
+
+        try:
+            self.bus.send(self.msg_reg.encode_node_message(self.node_conf.key, msg_key, msg))
+        except (OSError, can.exceptions.CanOperationError):
+            logger.warning(f"Mock node {self.node_conf.key} lost {self.bus_conf.channel} -> reconnect")
+            self.shutdown()
+
+    def handle_message(self, msg_def: NodeMessageConfig, msg: dict) -> None:
+        pass
+
+    def recv(self) -> Optional[can.Message]:
+        if self.bus is None:
+            return None
+
+        try:
+            return self.bus.recv(timeout=0.0)
+        except (OSError, can.exceptions.CanOperationError):
+            logger.warning(f"Mock node {self.node_conf.key} lost {self.bus_conf.channel} -> reconnect")
+            self.shutdown()
+            return None
+
+    def handle_frames(self) -> None:
+        # drain all pending frames (the endpoint receives the whole bus traffic) and handle the ones addressed to the node
+        while (frame := self.recv()) is not None:
+            pgn, _, _, dest_addr = can_id_to_pgn(frame.arbitration_id)
 
+            if dest_addr != 0xFF and dest_addr != self.node_conf.node_addr:
+                continue
+
+            for msg_def in self.node_conf.messages:
+                if msg_def.direction == "tx" and msg_def.dbc_msg.frame_id == pgn:
+                    self.handle_message(msg_def, msg_def.decode_data(frame.data))
+
+    async def queue_messages_coro(self):
+        while True:
+            try:
+                self.connect()
+                self.handle_frames()
+                self.queue_messages()
+                await asyncio.sleep(self.msg_interval)
+            except asyncio.CancelledError:
+                break
+
+    def queue_messages(self) -> None:
+        ...
+
+
+class MockThermometer(MockBusNode):
     error_mu: float
     error_sigma: float
 
     v_to_temp_m: float
     v_to_temp_b: float
 
-    def __init__(self, conf: CanEnvConfig, node_conf: NodeConfig, msg_queue: list[Tuple[NodeConfig, NodeMessageConfig, dict]], mock_state: "MockState"):
-        self.conf = conf
-        self.node_conf = node_conf
-        self.msg_queue = msg_queue
-        self.mock_state = mock_state
-        self.msg_interval = 0.1
+    def __init__(self, conf: CanEnvConfig, node_conf: NodeConfig, msg_reg: MsgRegistry, mock_state: "MockState"):
+        super().__init__(conf, node_conf, msg_reg, mock_state)
 
         self.error_mu = 0.0
         self.error_sigma = 0.2
@@ -43,38 +143,18 @@ class MockThermometer(MockNode):
     def measure_error(self) -> float:
         return random.gauss(self.error_mu, self.error_sigma)
 
-    def handle_message(self, msg_def: NodeMessageConfig, msg: dict) -> None:
-        raise ValueError("invalid message")
+    def queue_messages(self) -> None:
+        temp_c = self.mock_state.temp + self.measure_error()
+        temp_v = (temp_c - self.v_to_temp_b) / self.v_to_temp_m
 
-    async def queue_messages_coro(self):
-        while True:
-            try:
-                temp_c = self.mock_state.temp + self.measure_error()
-                temp_v = (temp_c - self.v_to_temp_b) / self.v_to_temp_m
+        self.send('therm_state', {'temp_v': temp_v, 'temp_c': temp_c})
 
-                msg_def = self.node_conf.message('therm_state')
-                msg = {'temp_v': temp_v, 'temp_c': temp_c}
-                self.msg_queue.append((self.node_conf, msg_def, msg))
 
-                await asyncio.sleep(self.msg_interval)
-            except asyncio.CancelledError:
-                break
-
-
-class MockRelay(MockNode):
-    conf: CanEnvConfig
-    node_conf: NodeConfig
-    msg_queue: list[Tuple[NodeConfig, NodeMessageConfig, dict]]
-    mock_state: "MockState"
-    msg_interval: float
+class MockRelay(MockBusNode):
     relay_state: dict
 
-    def __init__(self, conf: CanEnvConfig, node_conf: NodeConfig, msg_queue: list[Tuple[NodeConfig, NodeMessageConfig, dict]], mock_state: "MockState"):
-        self.conf = conf
-        self.node_conf = node_conf
-        self.msg_queue = msg_queue
-        self.mock_state = mock_state
-        self.msg_interval = 0.1
+    def __init__(self, conf: CanEnvConfig, node_conf: NodeConfig, msg_reg: MsgRegistry, mock_state: "MockState"):
+        super().__init__(conf, node_conf, msg_reg, mock_state)
 
         self.relay_state = {'on': False}
 
@@ -84,14 +164,8 @@ class MockRelay(MockNode):
         else:
             raise ValueError("invalid message")
 
-    async def queue_messages_coro(self):
-        while True:
-            try:
-                msg_def = self.node_conf.message('relay_state')
-                self.msg_queue.append((self.node_conf, msg_def, self.relay_state))
-                await asyncio.sleep(self.msg_interval)
-            except asyncio.CancelledError:
-                break
+    def queue_messages(self) -> None:
+        self.send('relay_state', self.relay_state)
 
 
 class MockState:
@@ -131,11 +205,11 @@ class MockState:
                 break
 
 
-def gen_mock_nodes(conf: CanEnvConfig, msg_queue: list[Tuple[NodeConfig, NodeMessageConfig, dict]], mock_state: MockState) -> dict[str, MockNode]:
+def gen_mock_nodes(conf: CanEnvConfig, msg_reg: MsgRegistry, mock_state: MockState) -> dict[str, MockNode]:
     mock_nodes = {}
     for node in conf.nodes:
         if node.debug.get('mock', False):
             mock_class = load_object(node.mock_class)
-            mock_nodes[node.key] = mock_class(conf, node, msg_queue, mock_state)
+            mock_nodes[node.key] = mock_class(conf, node, msg_reg, mock_state)
 
     return mock_nodes
@@ -1,16 +1,58 @@
 import can
-from brewbot.can.util import pgn_to_can_id, can_id_to_pgn
+import numpy as np
+from brewbot.can.util import pgn_to_can_id, can_id_to_pgn, is_pdu_format_1
+from brewbot.can.stats import BusStats, IdStats, frame_bits
+from brewbot.can.transport import PGN_TP_CM, PGN_TP_DT
+from brewbot.can.codec import MsgRecord
 from brewbot.config import NodeConfig, NodeMessageConfig
-from typing import Optional, Tuple
+from typing import Optional, Tuple, Callable, Sequence
+
+# upper bound for the negative cache of arbitration ids that don't resolve to a known message and for the ids with
+# statistics of their frames
+MAX_UNKNOWN_IDS = 4096
+
+# J1939 ID bits without priority: extended data page, data page, PDU format, PDU specific and source address
+J1939_PGN_MASK = 0x03FFFF00
+J1939_PF_MASK = 0x03FF0000
+J1939_SRC_ADDR_MASK = 0x000000FF
+
+
+class DispatchEntry:
+    __slots__ = ("node", "msg_def", "decode", "dedup")
+
+    node: NodeConfig
+    msg_def: NodeMessageConfig
+    decode: Callable[[bytes], MsgRecord]
+    dedup: bool
+
+    def __init__(self, node: NodeConfig, msg_def: NodeMessageConfig):
+        self.node = node
+        self.msg_def = msg_def
+
+        self.decode = msg_def.msg_type.data_decoder
+        self.dedup = msg_def.msg_type.dedup
 
 
 class MsgRegistry:
     msg_by_pgn: dict[int, list[Tuple[NodeConfig, NodeMessageConfig]]]
     nodes: list[NodeConfig]
+    change_handlers: list[Callable[[], None]]
+    unknown_frames: int
+    unknown_stats: dict[Tuple[Optional[str], int], IdStats]  # per (bus key, arbitration id) of frames without message
+    decode_failures: dict[Tuple[Optional[str], int], int]
 
     _nodes_by_key: dict[str, NodeConfig]
+    # keyed by (bus key, arbitration id): nodes on different buses may use the same source address
+    _dispatch: dict[Tuple[Optional[str], int], DispatchEntry]
+    _unknown_ids: set[Tuple[Optional[str], int]]
 
     def __init__(self, nodes: list[NodeConfig]):
+        self.change_handlers = []
+        self.unknown_frames = 0
+        self.decode_failures = {}
+        self.update_nodes(nodes)
+
+    def update_nodes(self, nodes: list[NodeConfig]) -> None:
         self.nodes = nodes
         self._nodes_by_key = {n.key: n for n in nodes}
 
@@ -20,35 +62,230 @@ class MsgRegistry:
                 if msg_def.direction == "rx":
                     self.msg_by_pgn.setdefault(msg_def.dbc_msg.frame_id, []).append((node, msg_def))
 
-    def decode(self, msg: can.Message) -> Optional[Tuple[NodeConfig, NodeMessageConfig, dict]]:
-        if msg is None:
-            return None
+        self._build_dispatch()
+
+        for change_handler in self.change_handlers:
+            change_handler()
+
+    def can_filters(self, bus: Optional[str] = None) -> list[dict]:
+        # SocketCAN acceptance filters that let pass exactly the frames `decode` can resolve (of the nodes on `bus` if
+        # given). Priority bits are ignored and for PDU format 1 messages the destination address is checked by `decode`.
+        filters = {}
+        for pgn, candidates in self.msg_by_pgn.items():
+            for node, _ in candidates:
+                if bus is not None and node.bus != bus:
+                    continue
+
+                can_mask = J1939_PF_MASK if is_pdu_format_1(pgn) else J1939_PGN_MASK
+                src_addr = 0x00
+
+                if node.node_addr is not None:
+                    can_mask |= J1939_SRC_ADDR_MASK
+                    src_addr = node.node_addr
 
-        pgn, priority, msg_src_addr, msg_dest_addr = can_id_to_pgn(msg.arbitration_id)
+                can_id = pgn_to_can_id(pgn, 0, src_addr, 0x00) & can_mask
+                filters[(can_id, can_mask)] = {"can_id": can_id, "can_mask": can_mask, "extended": True}
+
+        # transport protocol frames of nodes that send or receive multi frame messages
+        for node in self.nodes:
+            if (bus is not None and node.bus != bus) or not any(msg_def.msg_type.is_multi_frame for msg_def in node.messages):
+                continue
+
+            for tp_pgn in (PGN_TP_CM, PGN_TP_DT):
+                can_mask = J1939_PF_MASK | J1939_SRC_ADDR_MASK
+                can_id = pgn_to_can_id(tp_pgn, 0, node.node_addr, 0x00) & can_mask
+                filters[(can_id, can_mask)] = {"can_id": can_id, "can_mask": can_mask, "extended": True}
+
+        return list(filters.values())
+
+    def _build_dispatch(self) -> None:
+        # precompute the arbitration ids of all rx messages sent with their configured priority. Ids that differ from
+        # these (e.g. other priorities) are resolved once by `_resolve` and cached afterwards.
+        self._dispatch = {}
+        self._unknown_ids = set()
+        self.unknown_stats = {}
+
+        for pgn, candidates in self.msg_by_pgn.items():
+            for node, msg_def in candidates:
+                if node.node_addr is None:
+                    continue
+
+                dest_addrs = [0xFF, node.node_addr] if is_pdu_format_1(pgn) else [0xFF]
+                for dest_addr in dest_addrs:
+                    can_id = pgn_to_can_id(pgn, msg_def.priority, node.node_addr, dest_addr)
+                    if (node.bus, can_id) not in self._dispatch:
+                        self._resolve(node.bus, can_id)
+
+    def _resolve_candidates(self, bus: Optional[str], arbitration_id: int) -> Optional[Tuple[NodeConfig, NodeMessageConfig]]:
+        pgn, priority, msg_src_addr, msg_dest_addr = can_id_to_pgn(arbitration_id)
         msg_def_candidates: Optional[list[Tuple[NodeConfig, NodeMessageConfig]]] = self.msg_by_pgn.get(pgn)
 
         if msg_def_candidates is None:
             return None
         else:
             for node, msg_def in msg_def_candidates:
+                if bus is not None and node.bus != bus:
+                    continue
+
                 if (node.node_addr is None or msg_dest_addr == 0xFF or msg_dest_addr == node.node_addr) \
                         and (node.node_addr is None or msg_src_addr == node.node_addr):
-                    return node, msg_def, msg_def.decode(msg_def.dbc_msg.decode(msg.data))
+                    return node, msg_def
 
         return None
 
+    def _resolve(self, bus: Optional[str], arbitration_id: int) -> Optional[DispatchEntry]:
+        key = (bus, arbitration_id)
+        candidate = self._resolve_candidates(bus, arbitration_id)
+
+        if candidate is None:
+            if len(self._unknown_ids) >= MAX_UNKNOWN_IDS:
+                self._unknown_ids.clear()
+            self._unknown_ids.add(key)
+            return None
+
+        entry = DispatchEntry(*candidate)
+        self._dispatch[key] = entry
+        return entry
+
+    def lookup(self, arbitration_id: int, bus: Optional[str] = None) -> Optional[DispatchEntry]:
+        # `bus` is the key of the bus the frame was received on, only nodes on this bus are matched. Without bus the
+        # nodes of all buses are candidates (e.g. for frames of a recording without bus information).
+        key = (bus, arbitration_id)
+        entry = self._dispatch.get(key)
+
+        if entry is not None:
+            return entry
+        elif key in self._unknown_ids:
+            return None
+        else:
+            return self._resolve(bus, arbitration_id)
+
+    def _record_unknown(self, bus: Optional[str], arbitration_id: int, t: float, dlc: int) -> None:
+        self.unknown_frames += 1
+
+        key = (bus, arbitration_id)
+        id_stats = self.unknown_stats.get(key)
+        if id_stats is None:
+            if len(self.unknown_stats) >= MAX_UNKNOWN_IDS:
+                # only counted in total
+                return
+            id_stats = self.unknown_stats[key] = IdStats()
+
+        id_stats.record(t, dlc, frame_bits(dlc))
+
+    def decode(self, msg: can.Message, bus: Optional[str] = None, t: Optional[float] = None) -> Optional[Tuple[NodeConfig, NodeMessageConfig, MsgRecord]]:
+        # `t` is the receive time of the frame for the statistics of unknown ids, defaults to the frame timestamp
+        if msg is None:
+            return None
+
+        entry = self.lookup(msg.arbitration_id, bus)
+        if entry is None:
+            self._record_unknown(bus, msg.arbitration_id, msg.timestamp if t is None else t, msg.dlc)
+            return None
+
+        try:
+            return entry.node, entry.msg_def, entry.decode(msg.data)
+        except ValueError:
+            # payload that doesn't fit the message definition (e.g. invalid flag value)
+            key = (bus, msg.arbitration_id)
+            self.decode_failures[key] = self.decode_failures.get(key, 0) + 1
+            return None
+
+    def decode_batch(self, frames: np.ndarray | Sequence[Tuple[float, int, bytes]], bus: Optional[str] = None) -> dict[Tuple[str, str], np.ndarray]:
+        """
+        Decodes a batch of frames into one structured array per (node key, message key) using the dtype of the
+        message type. Frames are given either as (timestamp, arbitration_id, data) tuples or as structured array with
+        the fields `timestamp`, `arbitration_id` and `data` (8 bytes). Frames that don't resolve to a message are
+        skipped, the order of frames per message is preserved. All frames are from `bus` (see `lookup`).
+        """
+        if isinstance(frames, np.ndarray):
+            t = frames["timestamp"]
+            arbitration_ids = frames["arbitration_id"]
+            raw = np.ascontiguousarray(frames["data"]).view("<u8").reshape(-1)
+            dlc = frames["dlc"] if "dlc" in frames.dtype.names else None
+        else:
+            t = np.fromiter((frame[0] for frame in frames), dtype=np.float64, count=len(frames))
+            arbitration_ids = np.fromiter((frame[1] for frame in frames), dtype=np.uint32, count=len(frames))
+            raw = np.frombuffer(b"".join(bytes(frame[2]).ljust(8, b"\x00") for frame in frames), dtype="<u8")
+            dlc = None
+
+        unique_ids, inverse = np.unique(arbitration_ids, return_inverse=True)
+        order = np.argsort(inverse, kind="stable")
+        boundaries = np.cumsum(np.bincount(inverse, minlength=len(unique_ids)))[:-1]
+
+        indices_by_msg: dict[Tuple[str, str], list[np.ndarray]] = {}
+        msg_defs: dict[Tuple[str, str], NodeMessageConfig] = {}
+        for arbitration_id, indices in zip(unique_ids, np.split(order, boundaries)):
+            entry = self.lookup(int(arbitration_id), bus)
+            if entry is None:
+                for i in indices:
+                    self._record_unknown(bus, int(arbitration_id), float(t[i]), int(dlc[i]) if dlc is not None else len(frames[i][2]))
+                continue
+
+            key = (entry.node.key, entry.msg_def.key)
+            indices_by_msg.setdefault(key, []).append(indices)
+            msg_defs[key] = entry.msg_def
+
+        decoded = {}
+        for key, index_list in indices_by_msg.items():
+            # multiple arbitration ids (e.g. different priorities) can map to the same message -> restore frame order
+            indices = index_list[0] if len(index_list) == 1 else np.sort(np.concatenate(index_list))
+            decoded[key] = msg_defs[key].msg_type.decode_array(t[indices], raw[indices])
+
+        return decoded
+
     def encode(self, target_node_key: str, msg_key: str, msg: dict, src_node_key: str = 'master') -> can.Message:
         src_node: NodeConfig = self._nodes_by_key[src_node_key]
         target_node: NodeConfig = self._nodes_by_key[target_node_key]
-        msg_def: NodeMessageConfig = self._nodes_by_key[target_node_key].message(msg_key)
-        data: bytes = msg_def.dbc_msg.encode(msg_def.encode(msg))
+        msg_def: NodeMessageConfig = target_node.message(msg_key)
+
+        return self._encode(msg_def, msg, src_node.node_addr, target_node.node_addr)
 
+    def encode_node_message(self, src_node_key: str, msg_key: str, msg: dict) -> can.Message:
+        # frame as sent by the node itself (e.g. by mock nodes): source address is the node, destination is broadcast
+        src_node: NodeConfig = self._nodes_by_key[src_node_key]
+        msg_def: NodeMessageConfig = src_node.message(msg_key)
+
+        return self._encode(msg_def, msg, src_node.node_addr, 0xFF)
+
+    @staticmethod
+    def _encode(msg_def: NodeMessageConfig, msg: dict, src_addr: int, dest_addr: int) -> can.Message:
+        # multi frame messages (more than 8 bytes) are returned as one message and segmented by the transport protocol
+        data = msg_def.encode_data(msg)
         return can.Message(
-            arbitration_id=pgn_to_can_id(msg_def.dbc_msg.frame_id, msg_def.priority, src_node.node_addr, target_node.node_addr),
+            arbitration_id=pgn_to_can_id(msg_def.dbc_msg.frame_id, msg_def.priority, src_addr, dest_addr),
             data=data,
             is_extended_id=True,
-            dlc=8
+            dlc=len(data),
+            check=False
         )
 
+    def node_stats(self, bus_stats: BusStats, now: Optional[float] = None, bus: Optional[str] = None) -> dict:
+        # frame statistics of a bus grouped by node and message
+        nodes = {}
+        for arbitration_id, id_stats in bus_stats.by_id.items():
+            entry = self.lookup(arbitration_id, bus)
+            if entry is None:
+                continue
+
+            node_stats = nodes.setdefault(entry.node.key, {"frames": 0, "frames_per_s": 0.0, "decode_failures": 0, "messages": {}})
+            node_stats["frames"] += id_stats.frames
+            node_stats["frames_per_s"] += id_stats.frame_rate(now)
+            node_stats["decode_failures"] += self.decode_failures.get((bus, arbitration_id), 0)
+            # a message can be received under several ids (e.g. priorities) -> keep the most frequent one
+            msg_stats = node_stats["messages"].get(entry.msg_def.key)
+            if msg_stats is None or msg_stats["frames"] < id_stats.frames:
+                node_stats["messages"][entry.msg_def.key] = id_stats.to_dict(now)
+
+        return nodes
+
+    def unknown_id_stats(self, now: Optional[float] = None, bus: Optional[str] = None) -> dict:
+        # frame statistics of the arbitration ids of a bus that don't resolve to a message
+        return {
+            f"{arbitration_id:08X}": id_stats.to_dict(now)
+            for (id_bus, arbitration_id), id_stats in self.unknown_stats.items()
+            if id_bus == bus
+        }
+
     def nodes_by_type(self, type_name: str) -> list[NodeConfig]:
         return [node for node in self.nodes if node.node_type.key == type_name]
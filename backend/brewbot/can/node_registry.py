@@ -0,0 +1,186 @@
+import asyncio
+import heapq
+from brewbot.clock import Clock, SYSTEM_CLOCK
+from brewbot.config import NodeConfig
+from typing import Callable, Optional, Tuple
+
+# tolerance (s) for the comparison of a reported uptime with the uptime expected from the previous report
+UPTIME_TOLERANCE = 2.0
+
+
+class NodeInfo:
+    __slots__ = (
+        "bus", "node_addr", "node_key", "timeout", "node_type", "node_id", "version", "uptime", "uptime_t",
+        "first_seen", "last_seen", "alive", "reboots"
+    )
+
+    bus: str
+    node_addr: int
+    node_key: Optional[str]  # `None` for nodes that are not configured
+    timeout: Optional[float]
+    node_type: Optional[int]
+    node_id: Optional[int]
+    version: Optional[Tuple[int, int, int]]
+    uptime: Optional[int]
+    uptime_t: Optional[float]
+    first_seen: Optional[float]
+    last_seen: Optional[float]
+    alive: bool
+    reboots: int
+
+    def __init__(self, bus: str, node_addr: int, node_key: Optional[str] = None, timeout: Optional[float] = None):
+        self.bus = bus
+        self.node_addr = node_addr
+        self.node_key = node_key
+        self.timeout = timeout
+        self.node_type = None
+        self.node_id = None
+        self.version = None
+        self.uptime = None
+        self.uptime_t = None
+        self.first_seen = None
+        self.last_seen = None
+        self.alive = False
+        self.reboots = 0
+
+    def to_dict(self) -> dict:
+        return {
+            "bus": self.bus,
+            "node_addr": self.node_addr,
+            "node_key": self.node_key,
+            "node_type": self.node_type,
+            "node_id": self.node_id,
+            "version": ".".join(str(v) for v in self.version) if self.version is not None else None,
+            "uptime": self.uptime,
+            "first_seen": self.first_seen,
+            "last_seen": self.last_seen,
+            "alive": self.alive,
+            "reboots": self.reboots
+        }
+
+
+class NodeRegistry:
+    """
+    Liveness of the nodes on the buses. Every received message updates the last seen time of its sender, `node_info`
+    broadcasts additionally the firmware version and uptime (a smaller uptime than expected means the node rebooted).
+    Nodes with a liveness timeout are declared offline by a single deadline scheduler: the heap holds at most one
+    entry per alive node and is only corrected lazily when an entry becomes due, so updates are O(1) per message.
+
+    Event handlers are called with the node and one of 'discovered', 'online', 'offline' and 'reboot'.
+    """
+    clock: Clock
+    nodes: dict[Tuple[str, int], NodeInfo]
+    event_handlers: list[Callable[[NodeInfo, str], None]]
+
+    _deadlines: list[Tuple[float, Tuple[str, int]]]
+    _wakeup: asyncio.Event
+    _next_wakeup: Optional[float]
+
+    def __init__(self, nodes: list[NodeConfig], clock: Clock = SYSTEM_CLOCK):
+        self.clock = clock
+        self.event_handlers = []
+        self.nodes = {}
+
+        for node in nodes:
+            self.nodes[(node.bus, node.node_addr)] = NodeInfo(node.bus, node.node_addr, node.key, node.node_type.liveness_timeout)
+
+        self._deadlines = []
+        self._wakeup = asyncio.Event()
+        self._next_wakeup = None
+
+    def reset(self) -> None:
+        for info in self.nodes.values():
+            info.alive = False
+
+        self._deadlines = []
+
+    def notify(self, info: NodeInfo, evt: str) -> None:
+        for event_handler in self.event_handlers:
+            event_handler(info, evt)
+
+    def node(self, bus: str, node_addr: int) -> NodeInfo:
+        info = self.nodes.get((bus, node_addr))
+
+        if info is None:
+            info = self.nodes[(bus, node_addr)] = NodeInfo(bus, node_addr)
+            self.notify(info, 'discovered')
+
+        return info
+
+    def seen(self, bus: str, node_addr: int, t: Optional[float] = None) -> NodeInfo:
+        info = self.node(bus, node_addr)
+        t = self.clock.time() if t is None else t
+
+        if info.first_seen is None:
+            info.first_seen = t
+        info.last_seen = t
+
+        if not info.alive:
+            info.alive = True
+
+            if info.timeout is not None:
+                deadline = t + info.timeout
+                heapq.heappush(self._deadlines, (deadline, (bus, node_addr)))
+                if self._next_wakeup is None or deadline < self._next_wakeup:
+                    self._wakeup.set()
+
+            self.notify(info, 'online')
+
+        return info
+
+    def update_node_info(self, bus: str, node_addr: int, msg: dict, t: Optional[float] = None) -> NodeInfo:
+        info = self.seen(bus, node_addr, t)
+        t = info.last_seen
+
+        if info.uptime is not None and msg['uptime'] + UPTIME_TOLERANCE < info.uptime + (t - info.uptime_t):
+            info.reboots += 1
+            self.notify(info, 'reboot')
+
+        info.node_type = msg['node_type']
+        info.node_id = msg['node_id']
+        info.version = (msg['version_major'], msg['version_minor'], msg['version_patch'])
+        info.uptime = msg['uptime']
+        info.uptime_t = t
+
+        return info
+
+    def expire(self, now: float) -> Optional[float]:
+        # declares all nodes offline whose deadline passed, returns the next deadline
+        while len(self._deadlines) != 0 and self._deadlines[0][0] <= now:
+            _, key = heapq.heappop(self._deadlines)
+            info = self.nodes[key]
+
+            if not info.alive:
+                continue
+
+            deadline = info.last_seen + info.timeout
+            if deadline > now:
+                # seen since the entry was pushed -> reschedule
+                heapq.heappush(self._deadlines, (deadline, key))
+            else:
+                info.alive = False
+                self.notify(info, 'offline')
+
+        return self._deadlines[0][0] if len(self._deadlines) != 0 else None
+
+    async def liveness_coro(self):
+        try:
+            while True:
+                self._wakeup.clear()
+                self._next_wakeup = self.expire(self.clock.time())
+
+                if self._next_wakeup is None:
+                    await self._wakeup.wait()
+                else:
+                    sleep_task = asyncio.ensure_future(self.clock.sleep(self._next_wakeup - self.clock.time()))
+                    wakeup_task = asyncio.ensure_future(self._wakeup.wait())
+                    try:
+                        await asyncio.wait([sleep_task, wakeup_task], return_when=asyncio.FIRST_COMPLETED)
+                    finally:
+                        sleep_task.cancel()
+                        wakeup_task.cancel()
+        except asyncio.CancelledError:
+            self._next_wakeup = None
+
+    def to_dict(self) -> list[dict]:
+        return [info.to_dict() for info in self.nodes.values()]
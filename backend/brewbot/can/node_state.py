@@ -1,29 +1,53 @@
-import pandas as pd
 import asyncio
-from brewbot.config import CanEnvConfig, NodeConfig, NodeMessageConfig
-from brewbot.data.df import WindowedDataFrame
+from brewbot.can.codec import MsgRecord
+from brewbot.can.event_bus import EventBus, MsgEvent
+from brewbot.config import CanEnvConfig, NodeConfig, NodeMessageConfig, OutlierFilterConfig
+from brewbot.data.series import WindowedSeries
+from brewbot.data.outlier import HampelFilter
+from brewbot.can.send_queue import SendQueue
 from brewbot.util import format_on_off, load_object, async_infinite_loop
-import time
-import numpy as np
-from typing import Optional, Callable, Tuple
+from brewbot.clock import Clock, SYSTEM_CLOCK
+from typing import Optional, Tuple
+
+# default resolution (s) in time of derived node states: within a quantum a state is computed only once per version
+DEFAULT_STATE_QUANTUM = 0.05
 
 
 class NodeState:
     conf: CanEnvConfig
     node_conf: NodeConfig
-    rx_message_state: dict[str, Optional[dict]]
-    rx_message_handler: dict[str, list[Callable[[dict], None]]]
+    clock: Clock
+    rx_message_state: dict[str, Optional[MsgRecord]]
+    rx_message_time: dict[str, Optional[float]]
+    version: int  # bumped on every change of the rx state, values derived from it are cached per version
 
-    def __init__(self, conf: CanEnvConfig, node_conf: NodeConfig):
+    def __init__(self, conf: CanEnvConfig, node_conf: NodeConfig, clock: Clock = SYSTEM_CLOCK):
         self.conf = conf
         self.node_conf = node_conf
+        self.clock = clock
+        self.version = 0
         self.reset_message_state()
-        self.rx_message_handler = {msg.key: [] for msg in self.node_conf.messages if msg.direction == "rx"}
 
     def reset_message_state(self):
         self.rx_message_state = {msg.key: None for msg in self.node_conf.messages if msg.direction == "rx"}
+        self.rx_message_time = {msg.key: None for msg in self.node_conf.messages if msg.direction == "rx"}
+        self.version += 1
+
+    def rx_state_dict(self) -> dict[str, Optional[dict]]:
+        # received messages as plain dicts, e.g. for JSON responses
+        return {msg_key: None if msg is None else dict(msg) for msg_key, msg in self.rx_message_state.items()}
+
+    def mark_stale(self) -> None:
+        # node went silent -> drop the received state instead of reporting outdated values
+        self.reset_message_state()
+
+    def accept_rx(self, msg_key: str, msg: dict) -> bool:
+        # node states can reject received messages (e.g. outliers) before they change the rx state
+        return True
 
-    def update_rx_state(self, msg_def: NodeMessageConfig | str, msg: dict) -> None:
+    def update_rx_state(self, msg_def: NodeMessageConfig | str, msg: dict, t: Optional[float] = None) -> bool:
+        # `t` is the receive time of the frame. False if the message was rejected (see `accept_rx`), the rx state and
+        # its version are left untouched then. Consumers of the messages subscribe to the event bus (see `subscribe`).
         if isinstance(msg_def, NodeMessageConfig):
             msg_key = msg_def.key
         else:
@@ -32,31 +56,32 @@ class NodeState:
         if msg_key not in self.rx_message_state:
             raise ValueError("Invalid message")
 
-        self.rx_message_state[msg_key] = msg
-        for handler in self.rx_message_handler[msg_key]:
-            handler(msg)
+        if not self.accept_rx(msg_key, msg):
+            return False
 
-    def register_rx_message_handler(self, msg_def: NodeMessageConfig | str, handler: Callable[[dict], None]):
-        if isinstance(msg_def, NodeMessageConfig):
-            msg_key = msg_def.key
-        else:
-            msg_key = msg_def
+        t = self.clock.time() if t is None else t
 
-        if msg_key not in self.rx_message_handler:
-            raise ValueError("Invalid message")
+        self.rx_message_state[msg_key] = msg
+        self.rx_message_time[msg_key] = t
+        self.version += 1
+        return True
 
-        self.rx_message_handler[msg_key].append(handler)
+    def subscribe(self, event_bus: EventBus) -> None:
+        # consumers of the node's messages subscribe to the event bus of the environment
+        pass
 
-    def queue_coros(self, send_queue: list[Tuple[NodeConfig, NodeMessageConfig, dict]]):
-        coros = []
-        for msg_def in [msg_def for msg_def in self.node_conf.messages if msg_def.direction == "tx" and msg_def.frequency is not None]:
+    def unsubscribe(self, event_bus: EventBus) -> None:
+        pass
+
+    def queue_coros(self, send_queue: SendQueue):
+        def queue_coro(msg_def: NodeMessageConfig):
             @async_infinite_loop
             async def _coro():
-                send_queue.append((self.node_conf, msg_def, self.tx_msg(msg_def)))
-                await asyncio.sleep(1.0 / msg_def.frequency)
-            coros.append(_coro)
+                send_queue.put(self.node_conf, msg_def, self.tx_msg(msg_def))
+                await self.clock.sleep(1.0 / msg_def.frequency)
+            return _coro
 
-        return coros
+        return [queue_coro(msg_def) for msg_def in self.node_conf.messages if msg_def.direction == "tx" and msg_def.frequency is not None]
 
     def tx_msg(self, msg_def: NodeMessageConfig) -> dict:
         ...
@@ -66,58 +91,94 @@ class MasterNodeState(NodeState):
     conf: CanEnvConfig
     node_conf: NodeConfig
 
-    def __init__(self, conf: CanEnvConfig, node_conf: NodeConfig):
-        super().__init__(conf, node_conf)
+    def __init__(self, conf: CanEnvConfig, node_conf: NodeConfig, clock: Clock = SYSTEM_CLOCK):
+        super().__init__(conf, node_conf, clock)
 
 
 class ThermometerNodeState(NodeState):
     conf: CanEnvConfig
     node_conf: NodeConfig
     window: float
-    temp_c_frame: WindowedDataFrame
-    temp_v_frame: WindowedDataFrame
+    state_quantum: float
+    temp_series: WindowedSeries
+    outlier_filter: Optional[HampelFilter]
+
+    _therm_state_key: Optional[Tuple[int, int]]
+    _therm_state: Optional[dict]
 
-    def __init__(self, conf: CanEnvConfig, node_conf: NodeConfig):
-        super().__init__(conf, node_conf)
+    def __init__(self, conf: CanEnvConfig, node_conf: NodeConfig, clock: Clock = SYSTEM_CLOCK):
+        super().__init__(conf, node_conf, clock)
         self.window = node_conf.params['window']
-        self.temp_c_frame = WindowedDataFrame(self.window, columns=["t", "y"], index_column="t")
-        self.temp_v_frame = WindowedDataFrame(self.window, columns=["t", "y"], index_column="t")
-        self.register_rx_message_handler("therm_state", self.therm_state_update)
+        self.state_quantum = node_conf.params.get('state_quantum', DEFAULT_STATE_QUANTUM)
+        self._therm_state_key = None
+        self._therm_state = None
+        self.temp_series = WindowedSeries(self.window, columns=["temp_c", "temp_v"], fit=True)
+
+        filter_params = node_conf.params.get('outlier_filter')
+        if filter_params is not None:
+            filter_conf = OutlierFilterConfig(**filter_params)
+            self.outlier_filter = HampelFilter(filter_conf.size, filter_conf.n_sigmas, filter_conf.min_deviation)
+        else:
+            self.outlier_filter = None
 
-    def therm_state_update(self, msg: dict) -> None:
-        self.temp_c_frame.append({"t": [time.time()], "y": [msg['temp_c']]})
-        self.temp_v_frame.append({"t": [time.time()], "y": [msg['temp_v']]})
+    def subscribe(self, event_bus: EventBus) -> None:
+        event_bus.subscribe(self.therm_state_update, self.node_conf.key, "therm_state")
 
-    def therm_state(self) -> dict:
-        if len(self.temp_c_frame.df) != 0:
-            temp_c = ThermometerNodeState.interp(self.temp_c_frame.df, time.time(), self.window)
-        else:
-            temp_c = None
+    def unsubscribe(self, event_bus: EventBus) -> None:
+        event_bus.unsubscribe(self.therm_state_update)
 
-        if len(self.temp_v_frame.df) != 0:
-            temp_v = ThermometerNodeState.interp(self.temp_v_frame.df, time.time(), self.window)
-        else:
-            temp_v = None
+    def mark_stale(self) -> None:
+        super().mark_stale()
+        self.temp_series.clear()
+        if self.outlier_filter is not None:
+            self.outlier_filter.clear()
 
+    def accept_rx(self, msg_key: str, msg: dict) -> bool:
+        if msg_key != "therm_state" or self.outlier_filter is None:
+            return True
+
+        return self.outlier_filter.accept(msg['temp_c'])
+
+    def therm_state_update(self, event: MsgEvent) -> None:
+        # frames that fell back to the dispatch time may be stamped later than a following frame -> keep the order
+        last_t = self.temp_series.last_t
+        self.temp_series.append(event.t if last_t is None else max(event.t, last_t), (event.msg['temp_c'], event.msg['temp_v']))
+
+    def state_key(self) -> Tuple[int, int]:
+        # the extrapolated temperature only changes with new samples or the time
+        return self.version, int(self.clock.time() // self.state_quantum)
+
+    def therm_state(self) -> dict:
+        # the returned dict is shared between the calls within a quantum and must not be modified
+        key = self.state_key()
+        if key != self._therm_state_key:
+            self._therm_state = self.calc_therm_state()
+            self._therm_state_key = key
+
+        return self._therm_state
+
+    def calc_therm_state(self) -> dict:
+        if len(self.temp_series) == 0:
+            return {
+                "temp_c": None,
+                "temp_v": None
+            }
+
+        temp_c, temp_v = ThermometerNodeState.interp(self.temp_series, self.clock.time(), self.window)
         return {
             "temp_c": temp_c,
             "temp_v": temp_v
         }
 
     @classmethod
-    def interp(cls, df: pd.DataFrame, current_time: float, window: float):
-        if len(df) == 0:
-            return float("nan")
-
-        filtered_data = df.loc[(current_time - window):current_time]
+    def interp(cls, series: WindowedSeries, current_time: float, window: float) -> list[float]:
+        # value of every column of the series at `current_time`, extrapolated by a linear fit over the window
+        line = series.linear_fit(current_time, window)
 
-        if len(filtered_data) == 0:
-            return float("nan")
-        elif len(filtered_data) == 1:
-            return float(filtered_data.iloc[0]["y"])
+        if line is None:
+            return [float("nan")] * len(series.columns)
         else:
-            poly = np.polyfit(filtered_data.index.to_numpy(), filtered_data['y'].to_numpy(), 1)
-            return float(np.polyval(poly, current_time))
+            return [float(v) for v in line[0]]
 
 
 class RelayNodeState(NodeState):
@@ -125,8 +186,8 @@ class RelayNodeState(NodeState):
     node_conf: NodeConfig
     cmd_state: bool
 
-    def __init__(self, conf: CanEnvConfig, node_conf: NodeConfig):
-        super().__init__(conf, node_conf)
+    def __init__(self, conf: CanEnvConfig, node_conf: NodeConfig, clock: Clock = SYSTEM_CLOCK):
+        super().__init__(conf, node_conf, clock)
         self.cmd_state = False
 
     def tx_msg(self, msg_def: NodeMessageConfig) -> dict:
@@ -136,11 +197,11 @@ class RelayNodeState(NodeState):
             raise ValueError("Invalid message")
 
 
-def gen_node_states(conf: CanEnvConfig) -> dict[str, NodeState]:
+def gen_node_states(conf: CanEnvConfig, clock: Clock = SYSTEM_CLOCK) -> dict[str, NodeState]:
     node_states = {}
     for node in conf.nodes:
         if node.node_state_class is not None:
             node_state_class = load_object(node.node_state_class)
-            node_states[node.key] = node_state_class(conf, node)
+            node_states[node.key] = node_state_class(conf, node, clock)
 
     return node_states
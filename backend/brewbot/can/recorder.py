@@ -0,0 +1,292 @@
+import can
+import datetime
+import json
+import mmap
+import os
+import struct
+import time
+import numpy as np
+from brewbot.config import RecorderConfig
+from brewbot.can.util import MAX_TIMESTAMP_SKEW
+from typing import Optional, Tuple
+
+# Recordings are stored per session in a directory of segment files `seg-<n>.bin`. Each segment consists of a fixed
+# size header followed by fixed size frame records and is written through a memory map. Next to each segment an
+# append-only index `seg-<n>.idx` holds (timestamp, record number) pairs every `index_interval` records. Frames carry the
+# index of their bus in `buses.json` of the session.
+
+SEGMENT_MAGIC = b"BBCANREC"
+SEGMENT_VERSION = 2
+# version 1 has no bus index (zero padding in its place): all frames are read as frames of the first bus
+SEGMENT_VERSIONS = {1, 2}
+SEGMENT_HEADER = struct.Struct("<8sHHIdQ")  # magic, version, record size, capacity, wall clock offset, record count
+SEGMENT_HEADER_SIZE = 64
+SEGMENT_COUNT_OFFSET = 24
+
+FRAME_RECORD = struct.Struct("<dIBB8sH")  # monotonic timestamp, arbitration id, dlc, direction, data, bus index
+FRAME_RECORD_DTYPE = np.dtype({
+    "names": ["timestamp", "arbitration_id", "dlc", "direction", "data", "bus"],
+    "formats": ["<f8", "<u4", "u1", "u1", ("u1", 8), "<u2"],
+    "offsets": [0, 8, 12, 13, 14, 22],
+    "itemsize": FRAME_RECORD.size
+})
+
+INDEX_RECORD = struct.Struct("<dQ")
+INDEX_RECORD_DTYPE = np.dtype([("timestamp", "<f8"), ("record", "<u8")])
+
+DIRECTION_RX = 0
+DIRECTION_TX = 1
+
+COUNT = struct.Struct("<Q")
+
+
+def segment_path(session_path: str, segment_no: int) -> str:
+    return os.path.join(session_path, f"seg-{segment_no:06d}.bin")
+
+
+def index_path(session_path: str, segment_no: int) -> str:
+    return os.path.join(session_path, f"seg-{segment_no:06d}.idx")
+
+
+def buses_path(session_path: str) -> str:
+    return os.path.join(session_path, "buses.json")
+
+
+class FrameRecorder:
+    conf: RecorderConfig
+    bus_keys: list[str]
+    session_path: Optional[str]
+    segment_no: int
+
+    _file: Optional[int]
+    _mm: Optional[mmap.mmap]
+    _index_file: Optional[object]
+    _count: int
+    _wall_offset: float
+    _last_timestamp: float
+    _bus_index: dict[str, int]
+
+    def __init__(self, conf: RecorderConfig, bus_keys: list[str]):
+        self.conf = conf
+        self.bus_keys = bus_keys
+        self.session_path = None
+        self.segment_no = 0
+
+        self._file = None
+        self._mm = None
+        self._index_file = None
+        self._count = 0
+        self._wall_offset = 0.0
+        self._last_timestamp = 0.0
+        self._bus_index = {bus_key: i for i, bus_key in enumerate(bus_keys)}
+
+    @property
+    def is_open(self) -> bool:
+        return self.session_path is not None
+
+    def open(self, session: Optional[str] = None) -> None:
+        if self.is_open:
+            self.close()
+
+        if session is None:
+            session = datetime.datetime.now().strftime("%Y%m%d-%H%M%S")
+
+        self.session_path = os.path.join(self.conf.path, session)
+        os.makedirs(self.session_path, exist_ok=True)
+
+        with open(buses_path(self.session_path), "w") as f:
+            json.dump(self.bus_keys, f)
+
+        self.segment_no = 0
+        while os.path.exists(segment_path(self.session_path, self.segment_no)):
+            self.segment_no += 1
+
+        self._open_segment()
+
+    def close(self) -> None:
+        if self._mm is not None:
+            self._close_segment()
+
+        self.session_path = None
+
+    def _open_segment(self) -> None:
+        capacity = self.conf.segment_records
+        size = SEGMENT_HEADER_SIZE + capacity * FRAME_RECORD.size
+
+        self._file = os.open(segment_path(self.session_path, self.segment_no), os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o644)
+        os.ftruncate(self._file, size)
+        self._mm = mmap.mmap(self._file, size)
+        self._index_file = open(index_path(self.session_path, self.segment_no), "wb")
+        self._count = 0
+        self._wall_offset = time.time() - time.monotonic()
+
+        SEGMENT_HEADER.pack_into(self._mm, 0, SEGMENT_MAGIC, SEGMENT_VERSION, FRAME_RECORD.size, capacity, self._wall_offset, 0)
+
+    def _close_segment(self) -> None:
+        self._mm.flush()
+        self._mm.close()
+        # drop the preallocated but unused part of the segment
+        os.ftruncate(self._file, SEGMENT_HEADER_SIZE + self._count * FRAME_RECORD.size)
+        os.close(self._file)
+        self._index_file.close()
+
+        self._file = None
+        self._mm = None
+        self._index_file = None
+
+    def record(self, msg: can.Message, direction: int, bus: str) -> None:
+        if self._mm is None:
+            return
+
+        if self._count == self.conf.segment_records:
+            self._close_segment()
+            self.segment_no += 1
+            self._open_segment()
+
+        timestamp = self.frame_timestamp(msg, direction)
+        if self._count % self.conf.index_interval == 0:
+            self._index_file.write(INDEX_RECORD.pack(timestamp, self._count))
+
+        FRAME_RECORD.pack_into(self._mm, SEGMENT_HEADER_SIZE + self._count * FRAME_RECORD.size, timestamp, msg.arbitration_id, msg.dlc, direction, bytes(msg.data), self._bus_index[bus])
+        self._count += 1
+        COUNT.pack_into(self._mm, SEGMENT_COUNT_OFFSET, self._count)
+
+    def frame_timestamp(self, msg: can.Message, direction: int) -> float:
+        # received frames keep their receive time (unix time stamped by the kernel) so that a replay reproduces the
+        # bus timing instead of the dispatch delays, sent frames are stamped when they are recorded. A frame received
+        # before a tx frame that was recorded first is stamped with the time of that tx frame: records stay sorted by
+        # timestamp (which `Segment.seek` relies on) at the cost of shifting such frames by the dispatch delay.
+        now = time.monotonic()
+        timestamp = now
+
+        if direction == DIRECTION_RX and msg.timestamp > 0.0:
+            rx_timestamp = msg.timestamp - self._wall_offset
+            if abs(now - rx_timestamp) <= MAX_TIMESTAMP_SKEW:
+                timestamp = min(rx_timestamp, now)
+
+        timestamp = max(timestamp, self._last_timestamp)
+        self._last_timestamp = timestamp
+        return timestamp
+
+
+class Segment:
+    path: str
+    wall_offset: float
+    records: np.ndarray
+    index: np.ndarray
+
+    def __init__(self, session_path: str, segment_no: int):
+        self.path = segment_path(session_path, segment_no)
+
+        with open(self.path, "rb") as f:
+            magic, version, record_size, capacity, wall_offset, count = SEGMENT_HEADER.unpack(f.read(SEGMENT_HEADER.size))
+
+        if magic != SEGMENT_MAGIC or version not in SEGMENT_VERSIONS or record_size != FRAME_RECORD.size:
+            raise ValueError(f"Invalid frame log segment: {self.path}")
+
+        self.wall_offset = wall_offset
+        if count == 0:
+            self.records = np.empty(0, dtype=FRAME_RECORD_DTYPE)
+        else:
+            self.records = np.memmap(self.path, dtype=FRAME_RECORD_DTYPE, mode="r", offset=SEGMENT_HEADER_SIZE, shape=(count,))
+
+        idx_path = index_path(session_path, segment_no)
+        if os.path.exists(idx_path):
+            self.index = np.fromfile(idx_path, dtype=INDEX_RECORD_DTYPE)
+        else:
+            self.index = np.empty(0, dtype=INDEX_RECORD_DTYPE)
+
+    def __len__(self) -> int:
+        return len(self.records)
+
+    @property
+    def t_start(self) -> float:
+        return float(self.records[0]["timestamp"])
+
+    @property
+    def t_end(self) -> float:
+        return float(self.records[-1]["timestamp"])
+
+    def seek(self, t: float) -> int:
+        # narrow down the search range with the index, then bisect the records in between (records are sorted by
+        # timestamp, see `FrameRecorder.frame_timestamp`)
+        i = int(np.searchsorted(self.index["timestamp"], t, side="right"))
+        lo = int(self.index["record"][i - 1]) if i > 0 else 0
+        hi = int(self.index["record"][i]) if i < len(self.index) else len(self.records)
+        hi = min(max(hi, lo), len(self.records))
+
+        return lo + int(np.searchsorted(self.records["timestamp"][lo:hi], t, side="left"))
+
+
+class FrameLog:
+    """
+    Read access to a recorded session. Timestamps are monotonic clock values of the recording host,
+    `wall_offset` converts them to unix time. The `bus` field of a record is an index into `bus_keys`.
+    """
+    session_path: str
+    bus_keys: list[str]
+    segments: list[Segment]
+
+    def __init__(self, session_path: str):
+        self.session_path = session_path
+        self.segments = []
+
+        if os.path.exists(buses_path(session_path)):
+            with open(buses_path(session_path)) as f:
+                self.bus_keys = json.load(f)
+        else:
+            # recorded before buses were stored
+            self.bus_keys = []
+
+        segment_no = 0
+        while os.path.exists(segment_path(session_path, segment_no)):
+            segment = Segment(session_path, segment_no)
+            if len(segment) != 0:
+                self.segments.append(segment)
+            segment_no += 1
+
+    def __len__(self) -> int:
+        return sum(len(segment) for segment in self.segments)
+
+    @property
+    def wall_offset(self) -> float:
+        return self.segments[0].wall_offset if len(self.segments) != 0 else 0.0
+
+    def time_range(self) -> Optional[Tuple[float, float]]:
+        if len(self.segments) == 0:
+            return None
+
+        return self.segments[0].t_start, self.segments[-1].t_end
+
+    def read(self, t_start: Optional[float] = None, t_end: Optional[float] = None) -> np.ndarray:
+        # records with t_start <= timestamp < t_end. Returns a view into the memory map if the range lies within
+        # a single segment
+        parts = []
+        for segment in self.segments:
+            if (t_end is not None and segment.t_start >= t_end) or (t_start is not None and segment.t_end < t_start):
+                continue
+
+            lo = segment.seek(t_start) if t_start is not None else 0
+            hi = segment.seek(t_end) if t_end is not None else len(segment)
+            parts.append(segment.records[lo:hi])
+
+        if len(parts) == 0:
+            return np.empty(0, dtype=FRAME_RECORD_DTYPE)
+        elif len(parts) == 1:
+            return parts[0]
+        else:
+            return np.concatenate(parts)
+
+    def read_wall_time(self, t_start: Optional[float] = None, t_end: Optional[float] = None) -> np.ndarray:
+        wall_offset = self.wall_offset
+        return self.read(
+            t_start - wall_offset if t_start is not None else None,
+            t_end - wall_offset if t_end is not None else None
+        )
+
+
+def list_sessions(path: str) -> list[str]:
+    if not os.path.isdir(path):
+        return []
+
+    return sorted(d for d in os.listdir(path) if os.path.exists(segment_path(os.path.join(path, d), 0)))
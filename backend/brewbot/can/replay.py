@@ -0,0 +1,293 @@
+import argparse
+import asyncio
+import can
+import os
+import time
+from dataclasses import dataclass, field
+from brewbot.can.can_env import CanEnv
+from brewbot.can.recorder import FrameLog, DIRECTION_RX
+from brewbot.can.stats import BusStats
+from brewbot.clock import VirtualClock
+from brewbot.config import CanPortConfig, CanBusConfig, CanEnvConfig, load_config
+from typing import Callable, Iterator, Optional
+
+# python -m brewbot.can.replay recordings/20250101-120000 --speed 0
+# python -m brewbot.can.replay candump.log --speed 4 --setpoint 65
+
+# number of frames after which an as-fast-as-possible replay yields to the event loop
+YIELD_INTERVAL = 256
+
+
+def read_frame_log(session_path: str, chunk_size: int = 4096) -> Iterator[can.Message]:
+    # the bus key of a frame is passed on as its channel (None for recordings without bus keys)
+    frame_log = FrameLog(session_path)
+    wall_offset = frame_log.wall_offset
+    bus_keys = frame_log.bus_keys
+
+    for segment in frame_log.segments:
+        for start in range(0, len(segment), chunk_size):
+            records = segment.records[start:start + chunk_size]
+            for timestamp, arbitration_id, dlc, direction, data, bus in records.tolist():
+                yield can.Message(
+                    timestamp=timestamp + wall_offset,
+                    arbitration_id=arbitration_id,
+                    data=bytes(data[:dlc]),
+                    is_extended_id=True,
+                    is_rx=direction == DIRECTION_RX,
+                    channel=bus_keys[bus] if bus < len(bus_keys) else None
+                )
+
+
+def read_frames(source: str) -> Iterator[can.Message]:
+    # a directory is a session of our own recorder, files are read with python-can's log readers (by file suffix)
+    if os.path.isdir(source):
+        frames = read_frame_log(source)
+    else:
+        frames = can.LogReader(source)
+
+    for msg in frames:
+        # frames we sent ourselves during the recording are produced again by the replayed pipeline
+        if msg.is_rx and not msg.is_error_frame and not msg.is_remote_frame:
+            yield msg
+
+
+def frame_bus(conf: CanPortConfig, channel) -> str:
+    # bus of a replayed frame by the bus key (frame recorder) or the channel of the interface (python-can logs).
+    # Frames of other or unknown channels are replayed on the default bus.
+    for bus_conf in conf.buses:
+        if channel == bus_conf.key or channel == bus_conf.channel:
+            return bus_conf.key
+
+    return conf.bus.key
+
+
+class ReplayPort:
+    """
+    Drop-in replacement for `CanPort` of one bus. Frames are handed over one by one by the `ReplaySource`.
+    """
+    conf: CanPortConfig
+    bus_conf: CanBusConfig
+    clock: VirtualClock
+    event_handlers: list[Callable[[str], None]]
+    can_filters: Optional[list[dict]]
+    stats: BusStats
+    connected: asyncio.Event
+
+    frames_received: int
+    frames_sent: int
+
+    _queue: asyncio.Queue
+
+    def __init__(self, conf: CanPortConfig, bus_conf: CanBusConfig, clock: VirtualClock):
+        self.conf = conf
+        self.bus_conf = bus_conf
+        self.clock = clock
+        self.event_handlers = []
+        self.can_filters = None
+        self.stats = BusStats(bus_conf.bitrate)
+        self.connected = asyncio.Event()
+
+        self.frames_received = 0
+        self.frames_sent = 0
+
+        self._queue = asyncio.Queue()
+
+    @property
+    def event_driven(self) -> bool:
+        return True
+
+    def add_event_handler(self, event_handler: Callable[[str], None]) -> None:
+        self.event_handlers.append(event_handler)
+
+    def notify(self, evt: str) -> None:
+        for event_handler in self.event_handlers:
+            event_handler(evt)
+
+    def set_filters(self, can_filters: Optional[list[dict]]) -> None:
+        # the registry resolves unknown ids anyway, so the filters are not emulated
+        self.can_filters = can_filters
+
+    def shutdown(self) -> None:
+        self.connected.clear()
+        self.notify('shutdown')
+
+    def send(self, msg: can.Message) -> None:
+        self.frames_sent += 1
+        self.stats.record_tx(msg, self.clock.time())
+
+    async def feed(self, msg: can.Message) -> None:
+        # returns once the receive task took the frame and handled it up to its next await
+        self._queue.put_nowait(msg)
+        await self._queue.join()
+
+    async def recv_batch(self) -> list[can.Message]:
+        msg = await self._queue.get()
+        self._queue.task_done()
+
+        self.frames_received += 1
+        self.stats.record(msg)
+        return [msg]
+
+    async def connect_can_coro(self):
+        try:
+            self.connected.set()
+            self.notify('connected')
+            await asyncio.Future()
+        except asyncio.CancelledError:
+            self.shutdown()
+
+
+class ReplaySource:
+    """
+    Feeds the frames of a recorded log into the `ReplayPort` of their bus and moves a `VirtualClock` along with the
+    frame timestamps. Frames of all buses are replayed in the order of the log. With `speed` > 0 frames are paced
+    relative to the log (1.0 = real time), `speed` = 0 replays as fast as possible.
+    """
+    conf: CanPortConfig
+    source: str
+    ports: dict[str, ReplayPort]
+    clock: VirtualClock
+    speed: float
+
+    frames: int
+    read_time: float
+    log_start: Optional[float]
+
+    def __init__(self, conf: CanPortConfig, source: str, ports: dict[str, ReplayPort], clock: VirtualClock, speed: float = 1.0):
+        self.conf = conf
+        self.source = source
+        self.ports = ports
+        self.clock = clock
+        self.speed = speed
+
+        self.frames = 0
+        self.read_time = 0.0
+        self.log_start = None
+
+    async def run(self) -> None:
+        # all ports are connected before the first frame, so that no bus misses frames
+        await asyncio.gather(*(port.connected.wait() for port in self.ports.values()))
+
+        frames = read_frames(self.source)
+        t0_real = None
+
+        while True:
+            start = time.perf_counter()
+            msg = next(frames, None)
+            self.read_time += time.perf_counter() - start
+
+            if msg is None:
+                break
+
+            if self.log_start is None:
+                self.log_start = msg.timestamp
+                t0_real = time.perf_counter()
+                self.clock.advance(msg.timestamp)
+
+            if self.speed > 0:
+                delay = t0_real + (msg.timestamp - self.log_start) / self.speed - time.perf_counter()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+
+            # frames are handed over one by one so that handlers see the clock at the time of their frame. Sleepers
+            # that were due before the frame get the chance to run first.
+            if self.clock.advance(msg.timestamp) or self.frames % YIELD_INTERVAL == 0:
+                await asyncio.sleep(0)
+
+            self.frames += 1
+            await self.ports[frame_bus(self.conf, msg.channel)].feed(msg)
+
+
+@dataclass
+class ReplayReport:
+    frames: int = 0
+    frames_sent: int = 0
+    log_duration: float = 0.0
+    wall_duration: float = 0.0
+    stage_times: dict[str, float] = field(default_factory=dict)
+
+    @property
+    def frames_per_second(self) -> float:
+        return self.frames / self.wall_duration if self.wall_duration > 0 else float("nan")
+
+    def __str__(self) -> str:
+        lines = [
+            f"frames:       {self.frames} rx / {self.frames_sent} tx",
+            f"log duration: {self.log_duration:.1f} s",
+            f"replay time:  {self.wall_duration:.3f} s ({self.log_duration / self.wall_duration if self.wall_duration > 0 else float('nan'):.1f}x)",
+            f"throughput:   {self.frames_per_second:,.0f} frames/s"
+        ]
+        for stage, stage_time in self.stage_times.items():
+            per_frame = stage_time / self.frames * 1e6 if self.frames > 0 else float("nan")
+            lines.append(f"  {stage:<10} {stage_time:8.3f} s  ({per_frame:6.2f} us/frame)")
+
+        return "\n".join(lines)
+
+
+def instrument(stage_times: dict[str, float], stage: str, fun: Callable) -> Callable:
+    stage_times[stage] = 0.0
+
+    def _fun(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return fun(*args, **kwargs)
+        finally:
+            stage_times[stage] += time.perf_counter() - start
+
+    return _fun
+
+
+async def replay(conf: CanEnvConfig, source: str, speed: float = 0.0, setpoint: Optional[float] = None) -> ReplayReport:
+    clock = VirtualClock()
+    ports = {bus_conf.key: ReplayPort(conf.port, bus_conf, clock) for bus_conf in conf.port.buses}
+    frame_source = ReplaySource(conf.port, source, ports, clock, speed)
+    env = CanEnv(conf, can_ports=ports, clock=clock)
+    # don't record the replayed session again
+    env.recorder = None
+    env.store = None
+
+    stage_times = {}
+    env.msg_reg.decode = instrument(stage_times, "decode", env.msg_reg.decode)
+    env.handle_message = instrument(stage_times, "dispatch", env.handle_message)
+    env.send_message = instrument(stage_times, "send", env.send_message)
+
+    if setpoint is not None:
+        async def startup_coro():
+            await CanEnv.startup_coro(env)
+            for assembly in env.assemblies.values():
+                if hasattr(assembly, "set_heat_plate_setpoint"):
+                    assembly.set_heat_plate_setpoint(setpoint)
+        env.startup_coro = startup_coro
+
+    start = time.perf_counter()
+    env.run()
+    await frame_source.run()
+    wall_duration = time.perf_counter() - start
+    await env.stop()
+
+    stage_times["read"] = frame_source.read_time
+    stage_times["other"] = max(wall_duration - sum(stage_times.values()), 0.0)
+
+    return ReplayReport(
+        frames=frame_source.frames,
+        frames_sent=sum(port.frames_sent for port in ports.values()),
+        log_duration=clock.time() - frame_source.log_start if frame_source.log_start is not None else 0.0,
+        wall_duration=wall_duration,
+        stage_times=stage_times
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay a recorded CAN log through the brewbot pipeline")
+    parser.add_argument("source", help="session directory of the frame recorder or python-can log file (.asc, .blf, .log, ...)")
+    parser.add_argument("--speed", type=float, default=0.0, help="replay speed relative to the log, 0 = as fast as possible")
+    parser.add_argument("--setpoint", type=float, default=None, help="temperature setpoint applied to all kettles")
+    parser.add_argument("--config", default=None, help="config file")
+    args = parser.parse_args()
+
+    conf = load_config(args.config) if args.config is not None else load_config()
+    print(asyncio.run(replay(conf, args.source, args.speed, args.setpoint)))
+
+
+if __name__ == "__main__":
+    main()
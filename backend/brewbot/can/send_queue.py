@@ -0,0 +1,70 @@
+import asyncio
+from brewbot.config import NodeConfig, NodeMessageConfig
+from typing import Tuple
+
+
+class SendQueue:
+    """
+    Bounded transmit queue that only keeps the latest pending payload per (node, message).
+
+    Re-queuing a message that is still pending replaces its payload in place (coalesce). When the queue is full,
+    the oldest pending entry is dropped in favour of the new one.
+    """
+    max_size: int
+    pending: dict[Tuple[str, str], Tuple[NodeConfig, NodeMessageConfig, dict]]
+
+    queued: int
+    coalesced: int
+    dropped: int
+
+    _ready: asyncio.Event
+
+    def __init__(self, max_size: int):
+        if max_size < 1:
+            raise ValueError("Send queue size must be >= 1")
+
+        self.max_size = max_size
+        self.pending = {}
+        self._ready = asyncio.Event()
+
+        self.queued = 0
+        self.coalesced = 0
+        self.dropped = 0
+
+    def __len__(self) -> int:
+        return len(self.pending)
+
+    def put(self, node: NodeConfig, msg_def: NodeMessageConfig, msg: dict) -> None:
+        key = (node.key, msg_def.key)
+
+        if key in self.pending:
+            self.coalesced += 1
+        elif len(self.pending) >= self.max_size:
+            del self.pending[next(iter(self.pending))]
+            self.dropped += 1
+
+        self.pending[key] = (node, msg_def, msg)
+        self.queued += 1
+        self._ready.set()
+
+    def get_batch(self) -> list[Tuple[NodeConfig, NodeMessageConfig, dict]]:
+        batch = list(self.pending.values())
+        self.pending.clear()
+        self._ready.clear()
+        return batch
+
+    async def wait_batch(self) -> list[Tuple[NodeConfig, NodeMessageConfig, dict]]:
+        await self._ready.wait()
+        return self.get_batch()
+
+    def clear(self) -> None:
+        self.pending.clear()
+        self._ready.clear()
+
+    def stats(self) -> dict[str, int]:
+        return {
+            "pending": len(self.pending),
+            "queued": self.queued,
+            "coalesced": self.coalesced,
+            "dropped": self.dropped
+        }
@@ -0,0 +1,163 @@
+import bisect
+import can
+import math
+from typing import Optional
+
+# upper bounds (s) of the inter-arrival histogram buckets (1-2-5 series), the last bucket collects everything above
+INTERVAL_BUCKETS = [0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1.0, 2.0, 5.0]
+
+# upper bound for the number of tracked arbitration ids, frames of further ids are only counted in total
+MAX_TRACKED_IDS = 1024
+
+# smoothing factor of the exponentially weighted inter-arrival mean / variance
+EWMA_ALPHA = 0.05
+
+
+def frame_bits(dlc: int, is_extended_id: bool = True) -> int:
+    # bits on the wire incl. worst case bit stuffing and interframe space
+    if is_extended_id:
+        return 67 + 8 * dlc + (54 + 8 * dlc - 1) // 4
+    else:
+        return 47 + 8 * dlc + (34 + 8 * dlc - 1) // 4
+
+
+class IdStats:
+    """
+    Counters of a single arbitration id. Inter-arrival times are tracked as exponentially weighted mean and variance
+    (so rates and jitter follow the recent traffic) and in a fixed bucket histogram.
+    """
+    __slots__ = ("frames", "bytes", "bits", "first_t", "last_t", "interval_mean", "interval_var", "histogram")
+
+    frames: int
+    bytes: int
+    bits: int
+    first_t: Optional[float]
+    last_t: Optional[float]
+    interval_mean: Optional[float]
+    interval_var: float
+    histogram: list[int]
+
+    def __init__(self):
+        self.frames = 0
+        self.bytes = 0
+        self.bits = 0
+        self.first_t = None
+        self.last_t = None
+        self.interval_mean = None
+        self.interval_var = 0.0
+        self.histogram = [0] * (len(INTERVAL_BUCKETS) + 1)
+
+    def record(self, t: float, dlc: int, bits: int) -> None:
+        self.frames += 1
+        self.bytes += dlc
+        self.bits += bits
+
+        if self.last_t is None:
+            self.first_t = t
+        else:
+            dt = t - self.last_t
+            self.histogram[bisect.bisect_left(INTERVAL_BUCKETS, dt)] += 1
+
+            if self.interval_mean is None:
+                self.interval_mean = dt
+            else:
+                diff = dt - self.interval_mean
+                incr = EWMA_ALPHA * diff
+                self.interval_mean += incr
+                self.interval_var = (1 - EWMA_ALPHA) * (self.interval_var + diff * incr)
+
+        self.last_t = t
+
+    def frame_rate(self, now: Optional[float] = None) -> float:
+        # frames/s. A stream that went silent for longer than its mean interval decays towards 0.
+        if not self.interval_mean:
+            return 0.0
+
+        interval = self.interval_mean if now is None else max(self.interval_mean, now - self.last_t)
+        return 1.0 / interval
+
+    def byte_rate(self, now: Optional[float] = None) -> float:
+        return self.frame_rate(now) * self.bytes / self.frames if self.frames != 0 else 0.0
+
+    def bit_rate(self, now: Optional[float] = None) -> float:
+        return self.frame_rate(now) * self.bits / self.frames if self.frames != 0 else 0.0
+
+    @property
+    def jitter(self) -> float:
+        # standard deviation of the inter-arrival time (s)
+        return math.sqrt(self.interval_var)
+
+    def to_dict(self, now: Optional[float] = None) -> dict:
+        return {
+            "frames": self.frames,
+            "bytes": self.bytes,
+            "frames_per_s": self.frame_rate(now),
+            "bytes_per_s": self.byte_rate(now),
+            "interval_mean_s": self.interval_mean,
+            "interval_jitter_s": self.jitter,
+            "interval_histogram": self.histogram
+        }
+
+
+class BusStats:
+    """
+    Per arbitration id counters of the frames seen on a bus. Counters are only updated from the event loop, so no
+    locking is needed.
+    """
+    bitrate: int
+    by_id: dict[int, IdStats]
+    tx_frames: int
+    error_frames: int
+    untracked_frames: int
+    dropped_frames: int  # lost because the receive buffer of the port was full
+
+    def __init__(self, bitrate: int):
+        self.bitrate = bitrate
+        self.reset()
+
+    def reset(self) -> None:
+        self.by_id = {}
+        self.tx_frames = 0
+        self.error_frames = 0
+        self.untracked_frames = 0
+        self.dropped_frames = 0
+
+    def record(self, msg: can.Message, t: Optional[float] = None) -> None:
+        if msg.is_error_frame:
+            self.error_frames += 1
+            return
+
+        id_stats = self.by_id.get(msg.arbitration_id)
+        if id_stats is None:
+            if len(self.by_id) >= MAX_TRACKED_IDS:
+                self.untracked_frames += 1
+                return
+            id_stats = self.by_id[msg.arbitration_id] = IdStats()
+
+        id_stats.record(msg.timestamp if t is None else t, msg.dlc, frame_bits(msg.dlc, msg.is_extended_id))
+
+    def record_tx(self, msg: can.Message, t: float) -> None:
+        self.tx_frames += 1
+        self.record(msg, t)
+
+    @property
+    def frames(self) -> int:
+        return sum(id_stats.frames for id_stats in self.by_id.values()) + self.untracked_frames
+
+    def utilisation(self, now: Optional[float] = None) -> float:
+        # estimated share of the bus bandwidth (0..1) at the current frame rates
+        return sum(id_stats.bit_rate(now) for id_stats in self.by_id.values()) / self.bitrate
+
+    def to_dict(self, now: Optional[float] = None) -> dict:
+        return {
+            "bitrate": self.bitrate,
+            "utilisation": self.utilisation(now),
+            "frames": self.frames,
+            "tx_frames": self.tx_frames,
+            "error_frames": self.error_frames,
+            "untracked_frames": self.untracked_frames,
+            "dropped_frames": self.dropped_frames,
+            "frames_per_s": sum(id_stats.frame_rate(now) for id_stats in self.by_id.values()),
+            "interval_buckets_s": INTERVAL_BUCKETS,
+            "by_id": {f"{arbitration_id:08X}": id_stats.to_dict(now) for arbitration_id, id_stats in self.by_id.items()}
+        }
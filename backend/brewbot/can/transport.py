@@ -0,0 +1,331 @@
+import asyncio
+import can
+import logging
+from brewbot.can.util import pgn_to_can_id, can_id_to_pgn
+from brewbot.clock import Clock, SYSTEM_CLOCK
+from cysystemd import journal
+from typing import Callable, Optional, Tuple
+
+# J1939-21 transport protocol: messages of up to 1785 bytes are sent as a connection management frame (TP.CM)
+# followed by up to 255 data transfer frames (TP.DT) with 7 bytes each. Broadcasts use BAM, messages to a specific
+# node use RTS/CTS flow control.
+
+PGN_TP_CM = 0xEC00
+PGN_TP_DT = 0xEB00
+
+TP_CM_RTS = 16
+TP_CM_CTS = 17
+TP_CM_EOM_ACK = 19
+TP_CM_BAM = 32
+TP_CM_ABORT = 255
+
+ABORT_BUSY = 1
+ABORT_RESOURCES = 2
+ABORT_TIMEOUT = 3
+ABORT_BAD_SEQUENCE = 7
+
+TP_PRIORITY = 7
+TP_MAX_SIZE = 1785
+TP_PACKET_SIZE = 7
+
+# timeouts (s) of J1939-21: T1 between data frames, T2 after a CTS, T3 waiting for CTS / EOM, T4 after a hold CTS
+T1 = 0.75
+T2 = 1.25
+T3 = 1.25
+T4 = 1.05
+
+BAM_PACKET_INTERVAL = 0.05
+CTS_WINDOW = 16
+MAX_RX_SESSIONS = 32
+# interval (s) of the periodic expiry of receive sessions whose sender went silent
+EXPIRY_INTERVAL = 0.25
+
+# arbitration id bits that identify TP.CM / TP.DT frames (data page and PDU format)
+TP_PF_MASK = 0x03FF0000
+TP_CM_ID = pgn_to_can_id(PGN_TP_CM, 0, 0, 0) & TP_PF_MASK
+TP_DT_ID = pgn_to_can_id(PGN_TP_DT, 0, 0, 0) & TP_PF_MASK
+
+logger = logging.getLogger("brewbot.can.transport")
+logger.setLevel(logging.INFO)
+
+if not logger.hasHandlers():  # Prevent duplicate logs if already configured
+    handler = journal.JournaldLogHandler()
+    formatter = logging.Formatter("[%(levelname)s] %(asctime)s %(name)s: %(message)s")
+    handler.setFormatter(formatter)
+    logger.addHandler(handler)
+
+
+def is_transport_frame(arbitration_id: int) -> bool:
+    pf = arbitration_id & TP_PF_MASK
+    return pf == TP_CM_ID or pf == TP_DT_ID
+
+
+def num_packets(size: int) -> int:
+    return (size + TP_PACKET_SIZE - 1) // TP_PACKET_SIZE
+
+
+def cm_data(control: int, b1: int, b2: int, b3: int, b4: int, pgn: int) -> bytes:
+    return bytes([control, b1 & 0xFF, b2 & 0xFF, b3 & 0xFF, b4 & 0xFF, pgn & 0xFF, (pgn >> 8) & 0xFF, (pgn >> 16) & 0xFF])
+
+
+def cm_frame(control: int, b1: int, b2: int, b3: int, b4: int, pgn: int, src_addr: int, dest_addr: int) -> can.Message:
+    return can.Message(
+        arbitration_id=pgn_to_can_id(PGN_TP_CM, TP_PRIORITY, src_addr, dest_addr),
+        data=cm_data(control, b1, b2, b3, b4, pgn),
+        is_extended_id=True
+    )
+
+
+def dt_frames(data: bytes, src_addr: int, dest_addr: int, first_seq: int = 1, count: Optional[int] = None) -> list[can.Message]:
+    # data transfer frames with sequence numbers `first_seq`.. (1-based), the last packet is padded with 0xFF
+    arbitration_id = pgn_to_can_id(PGN_TP_DT, TP_PRIORITY, src_addr, dest_addr)
+    last_seq = num_packets(len(data)) if count is None else min(first_seq + count - 1, num_packets(len(data)))
+
+    frames = []
+    for seq in range(first_seq, last_seq + 1):
+        chunk = data[(seq - 1) * TP_PACKET_SIZE:seq * TP_PACKET_SIZE]
+        frames.append(can.Message(
+            arbitration_id=arbitration_id,
+            data=bytes([seq]) + chunk.ljust(TP_PACKET_SIZE, b"\xff"),
+            is_extended_id=True
+        ))
+
+    return frames
+
+
+class RxSession:
+    __slots__ = ("pgn", "priority", "size", "packets", "is_bam", "data", "next_seq", "window_end", "deadline")
+
+    pgn: int
+    priority: int
+    size: int
+    packets: int
+    is_bam: bool
+    data: bytearray
+    next_seq: int
+    window_end: int
+    deadline: float
+
+    def __init__(self, pgn: int, priority: int, size: int, packets: int, is_bam: bool, deadline: float):
+        self.pgn = pgn
+        self.priority = priority
+        self.size = size
+        self.packets = packets
+        self.is_bam = is_bam
+        self.data = bytearray()
+        self.next_seq = 1
+        self.window_end = packets
+        self.deadline = deadline
+
+
+class Transport:
+    """
+    Transport protocol endpoint of the master on one bus. `feed` takes TP.CM / TP.DT frames and returns the
+    reassembled message (as `can.Message` with the id of the transported PGN) once complete. `send_message` segments
+    a payload of more than 8 bytes. Reassembly is bounded in the number of concurrent sessions and in size, and
+    sessions are dropped when their timeout expires. Timeouts are checked on every TP frame and by `expire`, which
+    has to be called periodically as well, so a session whose sender stopped is aborted without further traffic.
+    All timeouts and the BAM packet interval are measured on `clock`.
+    """
+    own_addr: int
+    send_frame: Callable[[can.Message], None]
+    clock: Clock
+
+    rx_sessions: dict[Tuple[int, int], RxSession]
+    messages_reassembled: int
+    sessions_aborted: int
+
+    _tx_queues: dict[int, asyncio.Queue]
+    _tx_tasks: set[asyncio.Task]
+
+    def __init__(self, own_addr: int, send_frame: Callable[[can.Message], None], clock: Clock = SYSTEM_CLOCK):
+        self.own_addr = own_addr
+        self.send_frame = send_frame
+        self.clock = clock
+
+        self.rx_sessions = {}
+        self.messages_reassembled = 0
+        self.sessions_aborted = 0
+
+        self._tx_queues = {}
+        self._tx_tasks = set()
+
+    def reset(self) -> None:
+        for task in self._tx_tasks:
+            task.cancel()
+
+        self.rx_sessions = {}
+        self._tx_queues = {}
+        self._tx_tasks = set()
+
+    def expire(self, now: float) -> None:
+        for key in [key for key, session in self.rx_sessions.items() if session.deadline < now]:
+            session = self.rx_sessions.pop(key)
+            self.sessions_aborted += 1
+
+            if not session.is_bam:
+                self.send_frame(cm_frame(TP_CM_ABORT, ABORT_TIMEOUT, 0xFF, 0xFF, 0xFF, session.pgn, self.own_addr, key[0]))
+
+    def feed(self, msg: can.Message) -> Optional[can.Message]:
+        _, priority, src_addr, dest_addr = can_id_to_pgn(msg.arbitration_id)
+        now = self.clock.time()
+
+        if len(self.rx_sessions) != 0:
+            self.expire(now)
+
+        if dest_addr != 0xFF and dest_addr != self.own_addr:
+            return None
+
+        if msg.arbitration_id & TP_PF_MASK == TP_CM_ID:
+            self._handle_cm(msg.data, priority, src_addr, dest_addr, now)
+            return None
+        else:
+            return self._handle_dt(msg, src_addr, dest_addr, now)
+
+    def _handle_cm(self, data: bytes, priority: int, src_addr: int, dest_addr: int, now: float) -> None:
+        if len(data) < 8:
+            return
+
+        control = data[0]
+        pgn = data[5] | (data[6] << 8) | (data[7] << 16)
+
+        if control == TP_CM_BAM or control == TP_CM_RTS:
+            size = data[1] | (data[2] << 8)
+            packets = data[3]
+            is_bam = control == TP_CM_BAM
+            key = (src_addr, 0xFF if is_bam else dest_addr)
+
+            if size > TP_MAX_SIZE or packets != num_packets(size) or (len(self.rx_sessions) >= MAX_RX_SESSIONS and key not in self.rx_sessions):
+                if not is_bam:
+                    self.send_frame(cm_frame(TP_CM_ABORT, ABORT_RESOURCES, 0xFF, 0xFF, 0xFF, pgn, self.own_addr, src_addr))
+                return
+
+            # a new announcement replaces a pending session of the same sender
+            session = RxSession(pgn, priority, size, packets, is_bam, now + T1)
+            self.rx_sessions[key] = session
+
+            if not is_bam:
+                max_packets = data[4] if data[4] != 0 else 0xFF
+                self._send_cts(session, src_addr, min(CTS_WINDOW, max_packets), now)
+        elif control == TP_CM_ABORT:
+            session = self.rx_sessions.get((src_addr, dest_addr))
+            if session is not None and session.pgn == pgn:
+                del self.rx_sessions[(src_addr, dest_addr)]
+                self.sessions_aborted += 1
+
+            queue = self._tx_queues.get(src_addr)
+            if queue is not None:
+                queue.put_nowait(data)
+        elif control == TP_CM_CTS or control == TP_CM_EOM_ACK:
+            queue = self._tx_queues.get(src_addr)
+            if queue is not None:
+                queue.put_nowait(data)
+
+    def _send_cts(self, session: RxSession, src_addr: int, window: int, now: float) -> None:
+        count = min(window, session.packets - session.next_seq + 1)
+        session.window_end = session.next_seq + count - 1
+        session.deadline = now + T2
+        self.send_frame(cm_frame(TP_CM_CTS, count, session.next_seq, 0xFF, 0xFF, session.pgn, self.own_addr, src_addr))
+
+    def _handle_dt(self, msg: can.Message, src_addr: int, dest_addr: int, now: float) -> Optional[can.Message]:
+        key = (src_addr, dest_addr)
+        session = self.rx_sessions.get(key)
+
+        if session is None or len(msg.data) < 2:
+            return None
+
+        if msg.data[0] != session.next_seq:
+            del self.rx_sessions[key]
+            self.sessions_aborted += 1
+            if not session.is_bam:
+                self.send_frame(cm_frame(TP_CM_ABORT, ABORT_BAD_SEQUENCE, 0xFF, 0xFF, 0xFF, session.pgn, self.own_addr, src_addr))
+            return None
+
+        session.data += msg.data[1:TP_PACKET_SIZE + 1]
+        session.next_seq += 1
+        session.deadline = now + T1
+
+        if session.next_seq <= session.packets:
+            if not session.is_bam and session.next_seq > session.window_end:
+                self._send_cts(session, src_addr, CTS_WINDOW, now)
+            return None
+
+        del self.rx_sessions[key]
+        self.messages_reassembled += 1
+
+        if not session.is_bam:
+            self.send_frame(cm_frame(TP_CM_EOM_ACK, session.size, session.size >> 8, session.packets, 0xFF, session.pgn, self.own_addr, src_addr))
+
+        return can.Message(
+            timestamp=msg.timestamp,
+            arbitration_id=pgn_to_can_id(session.pgn, session.priority, src_addr, dest_addr),
+            data=bytes(session.data[:session.size]),
+            dlc=session.size,
+            is_extended_id=True,
+            check=False
+        )
+
+    def send_message(self, msg: can.Message) -> None:
+        # segments a message with more than 8 bytes payload in a background task
+        pgn, _, src_addr, dest_addr = can_id_to_pgn(msg.arbitration_id)
+        data = bytes(msg.data)
+
+        if len(data) > TP_MAX_SIZE:
+            raise ValueError(f"Message too long for the transport protocol: {len(data)} bytes")
+
+        if dest_addr == 0xFF:
+            coro = self._send_bam(pgn, src_addr, data)
+        else:
+            coro = self._send_rts_cts(pgn, src_addr, dest_addr, data)
+
+        task = asyncio.create_task(coro)
+        self._tx_tasks.add(task)
+        task.add_done_callback(self._tx_tasks.discard)
+
+    async def _send_bam(self, pgn: int, src_addr: int, data: bytes) -> None:
+        self.send_frame(cm_frame(TP_CM_BAM, len(data), len(data) >> 8, num_packets(len(data)), 0xFF, pgn, src_addr, 0xFF))
+
+        for frame in dt_frames(data, src_addr, 0xFF):
+            await self.clock.sleep(BAM_PACKET_INTERVAL)
+            self.send_frame(frame)
+
+    async def _send_rts_cts(self, pgn: int, src_addr: int, dest_addr: int, data: bytes) -> None:
+        if dest_addr in self._tx_queues:
+            logger.warning(f"Transport session to {dest_addr:#04x} already active -> drop message of pgn {pgn:#06x}")
+            return
+
+        queue = asyncio.Queue()
+        self._tx_queues[dest_addr] = queue
+        packets = num_packets(len(data))
+        timeout = T3
+
+        try:
+            self.send_frame(cm_frame(TP_CM_RTS, len(data), len(data) >> 8, packets, 0xFF, pgn, src_addr, dest_addr))
+
+            while True:
+                cm = await self.clock.wait_for(queue.get(), timeout)
+                control = cm[0]
+
+                if control == TP_CM_CTS:
+                    count, next_seq = cm[1], cm[2]
+                    if count == 0:
+                        # receiver holds the connection open
+                        timeout = T4
+                        continue
+
+                    for frame in dt_frames(data, src_addr, dest_addr, next_seq, count):
+                        self.send_frame(frame)
+                    timeout = T3
+                elif control == TP_CM_EOM_ACK:
+                    return
+                elif control == TP_CM_ABORT:
+                    logger.warning(f"Transport session to {dest_addr:#04x} aborted by receiver (reason {cm[1]})")
+                    self.sessions_aborted += 1
+                    return
+        except asyncio.TimeoutError:
+            logger.warning(f"Transport session to {dest_addr:#04x} timed out")
+            self.sessions_aborted += 1
+            self.send_frame(cm_frame(TP_CM_ABORT, ABORT_TIMEOUT, 0xFF, 0xFF, 0xFF, pgn, src_addr, dest_addr))
+        finally:
+            if self._tx_queues.get(dest_addr) is queue:
+                del self._tx_queues[dest_addr]
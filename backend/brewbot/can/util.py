@@ -1,5 +1,10 @@
 from typing import Tuple
 
+# frame timestamps that deviate more than this (s) from the clock are not in its time base (e.g. hardware timestamps
+# counting from device start) -> such frames are stamped with the time of dispatch
+MAX_TIMESTAMP_SKEW = 10.0
+
+
 def pdu_format(pgn: int) -> int:
     return (pgn >> 8) & 0xFF
 
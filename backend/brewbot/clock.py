@@ -0,0 +1,93 @@
+import asyncio
+import heapq
+import itertools
+import time
+from typing import Awaitable, Optional, TypeVar
+
+T = TypeVar("T")
+
+
+class Clock:
+    """
+    Time source of the CAN environment. Node states and assemblies take timestamps and sleep through the clock so that
+    the whole pipeline can also run on the time of a replayed log.
+    """
+
+    def time(self) -> float:
+        return time.time()
+
+    async def sleep(self, delay: float) -> None:
+        await asyncio.sleep(delay)
+
+    async def wait_for(self, aw: Awaitable[T], timeout: float) -> T:
+        # `asyncio.wait_for` with the timeout measured on this clock
+        return await asyncio.wait_for(aw, timeout)
+
+
+SYSTEM_CLOCK = Clock()
+
+
+class VirtualClock(Clock):
+    """
+    Clock that only moves when `advance` is called. Sleeping coroutines are woken up once the clock passed their
+    deadline.
+    """
+    now: float
+    _sleepers: list
+    _seq: itertools.count
+
+    def __init__(self, now: float = 0.0):
+        self.now = now
+        self._sleepers = []
+        self._seq = itertools.count()
+
+    def time(self) -> float:
+        return self.now
+
+    async def sleep(self, delay: float) -> None:
+        if delay <= 0:
+            await asyncio.sleep(0)
+            return
+
+        fut = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._sleepers, (self.now + delay, next(self._seq), fut))
+        await fut
+
+    async def wait_for(self, aw: Awaitable[T], timeout: float) -> T:
+        task = asyncio.ensure_future(aw)
+        timer = asyncio.ensure_future(self.sleep(timeout))
+
+        try:
+            await asyncio.wait([task, timer], return_when=asyncio.FIRST_COMPLETED)
+        except asyncio.CancelledError:
+            task.cancel()
+            raise
+        finally:
+            timer.cancel()
+
+        if task.done():
+            return task.result()
+
+        task.cancel()
+        raise asyncio.TimeoutError()
+
+    def next_deadline(self) -> Optional[float]:
+        while len(self._sleepers) != 0 and self._sleepers[0][2].done():
+            # cancelled sleepers
+            heapq.heappop(self._sleepers)
+
+        return self._sleepers[0][0] if len(self._sleepers) != 0 else None
+
+    def advance(self, t: float) -> bool:
+        # returns whether sleepers were woken up
+        if t > self.now:
+            self.now = t
+
+        woken = False
+        while len(self._sleepers) != 0 and self._sleepers[0][0] <= self.now:
+            _, _, fut = heapq.heappop(self._sleepers)
+            if not fut.done():
+                fut.set_result(None)
+                woken = True
+
+        return woken
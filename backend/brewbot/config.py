@@ -1,11 +1,13 @@
-from typing import Optional, Any
+from typing import Optional, Any, Callable
 
 import yaml
+import numpy as np
 from typing_extensions import Annotated
 from pydantic import BaseModel, Field, BeforeValidator, PrivateAttr
 from brewbot.util import encode_on_off, parse_on_off, load_object, int_range
 from cantools.database import Database, load_string as load_dbc_string
 from cantools.database.can.message import Message
+from brewbot.can.codec import MsgRecord, compile_record_class, compile_decoder, compile_encoder, decode_array
 
 CONFIG_PATH = 'conf/config.yaml'
 
@@ -21,16 +23,96 @@ signal_decoders = {
     "flag": parse_on_off
 }
 
+def check_receive_mode(receive_mode: str) -> str:
+    if receive_mode not in ["event", "poll"]:
+        raise ValueError(f"Receive mode must be event or poll. Instead found {receive_mode}")
+    return receive_mode
+
+
+def is_virtual_channel(interface: str, channel: str) -> bool:
+    # in-process bus of python-can or a virtual SocketCAN device: frames never reach a physical bus
+    return interface == "virtual" or (interface == "socketcan" and channel.startswith("vcan"))
+
+
 class CanBusConfig(BaseModel):
+    key: str = "default"
     channel: str
     interface: str
     receive_timeout: float
+    receive_mode: Annotated[str, BeforeValidator(check_receive_mode)] = "event"
+    bitrate: int = 125000  # only used to estimate the bus utilisation
+    mock_channel: Optional[str] = None  # virtual channel the bus runs on while nodes of it are mocked
+
+    def model_post_init(self, __context: Any) -> None:
+        if self.mock_channel is not None and not is_virtual_channel(self.interface, self.mock_channel):
+            raise ValueError(f"Mock channel of bus {self.key} must be virtual (interface virtual or a vcan device). "
+                             f"Instead found {self.interface} {self.mock_channel}")
+
+    def mock_config(self) -> "CanBusConfig":
+        # the bus as used while nodes of it are mocked: port and mock nodes are moved to the mock channel, so that mock
+        # frames never reach the physical bus (and real nodes on it)
+        if self.mock_channel is None:
+            raise ValueError(f"Bus {self.key} has no mock channel")
+
+        return self.model_copy(update={"channel": self.mock_channel})
 
 
 class CanPortConfig(BaseModel):
     process_interval: float
-    bus: Optional[CanBusConfig] = None
-    device_connect_interval: float
+    bus: Optional[CanBusConfig] = None  # single bus setup, same as `buses` with one entry
+    buses: list[CanBusConfig] = Field(default_factory=lambda: [])
+    device_connect_interval: float  # initial retry interval, doubled after each failed attempt
+    device_connect_max_interval: float = 5.0
+    send_queue_size: int = 64
+    rx_buffer_size: int = 4096  # max. received frames per bus that wait for the receive loop (event receive mode)
+
+    def model_post_init(self, __context: Any) -> None:
+        if len(self.buses) == 0 and self.bus is not None:
+            self.buses = [self.bus]
+        elif self.bus is None and len(self.buses) != 0:
+            # the first bus is the default for nodes without bus
+            self.bus = self.buses[0]
+
+        bus_keys = [bus.key for bus in self.buses]
+        if len(set(bus_keys)) != len(bus_keys):
+            raise ValueError(f"Bus keys must be unique. Found {bus_keys}")
+
+    def bus_config(self, key: str) -> CanBusConfig:
+        for bus in self.buses:
+            if bus.key == key:
+                return bus
+
+        raise ValueError(f"Unknown bus: {key}")
+
+
+class RecorderConfig(BaseModel):
+    path: str
+    segment_records: int = 131072  # frame records per segment file (24 bytes each)
+    index_interval: int = 1024  # frame records between two index entries
+
+
+class StoreConfig(BaseModel):
+    path: str
+    chunk_size: int = 4096  # samples per chunk file and signal
+    flush_interval: float = 10.0  # s, upper bound for the samples lost on a crash
+    max_pending_chunks: int = 256  # chunks waiting for the writer before further chunks are dropped
+
+
+class RollupResolutionConfig(BaseModel):
+    interval: float  # s per bucket
+    capacity: int  # number of buckets kept
+
+
+class RollupConfig(BaseModel):
+    resolutions: list[RollupResolutionConfig]
+
+    def model_post_init(self, __context: Any) -> None:
+        if len(self.resolutions) == 0:
+            raise ValueError("At least one rollup resolution is required")
+
+        for resolution in self.resolutions:
+            if resolution.interval <= 0 or resolution.capacity <= 0:
+                raise ValueError("Rollup interval and capacity must be positive")
 
 
 class SignalDefConfig(BaseModel):
@@ -55,19 +137,30 @@ class SignalDefConfig(BaseModel):
     def decode_signal(self):
         return signal_decoders[self.py_type]
 
+    @property
+    def np_dtype(self) -> np.dtype:
+        if self.py_type == "flag":
+            return np.dtype(np.bool_)
+        elif self.py_type == "int" and self.value_scale == int(self.value_scale) and self.value_offset == int(self.value_offset):
+            raw_min, raw_max = int_range(self.signal_size, self.signed)
+            values = [raw_min * int(self.value_scale) + int(self.value_offset), raw_max * int(self.value_scale) + int(self.value_offset)]
+            return np.result_type(*[np.min_scalar_type(v) for v in values])
+        else:
+            return np.dtype(np.float64)
+
     @property
     def value_min(self):
         if self.value_min_raw is not None:
             return self.value_min_raw
         else:
-            return int_range(self.signal_size, self.signed)[0] * self.value_scale
+            return min(v * self.value_scale + self.value_offset for v in int_range(self.signal_size, self.signed))
 
     @property
     def value_max(self):
         if self.value_max_raw is not None:
             return self.value_max_raw
         else:
-            return int_range(self.signal_size, self.signed)[1] * self.value_scale
+            return max(v * self.value_scale + self.value_offset for v in int_range(self.signal_size, self.signed))
 
 
 def check_direction(direction: str) -> str:
@@ -76,19 +169,76 @@ def check_direction(direction: str) -> str:
     return direction
 
 
+def check_msg_size(size: int) -> int:
+    # messages with more than 8 bytes are sent with the J1939 transport protocol (max. 255 packets of 7 bytes)
+    if not 1 <= size <= 1785:
+        raise ValueError(f"Message size must be between 1 and 1785 bytes. Instead found {size}")
+    return size
+
+
 class MsgTypeConfig(BaseModel):
     key: str
     dbc_name: str
     priority: int
     pgn: int
     direction: Annotated[str, BeforeValidator(check_direction)]
+    size: Annotated[int, BeforeValidator(check_msg_size)] = 8
+    dedup: bool = False
     signals: list[SignalDefConfig]
 
+    _record_class: type[MsgRecord] = PrivateAttr()
+    _data_decoder: Callable[[bytes], MsgRecord] = PrivateAttr()
+    _data_encoder: Callable[[dict], bytes] = PrivateAttr()
+
+    def model_post_init(self, __context: Any) -> None:
+        for signal in self.signals:
+            if signal.start_bit + signal.signal_size > self.size * 8:
+                raise ValueError(f"Signal {signal.key} exceeds the size of message {self.key} ({self.size} bytes)")
+
+        self._record_class = compile_record_class(self.key, self.signals)
+        self._data_decoder = compile_decoder(self.key, self.signals, self._record_class)
+        self._data_encoder = compile_encoder(self.key, self.signals, self.size)
+
     def encode(self, d):
         return {s.dbc_name: s.encode_signal(d[s.key]) for s in self.signals}
 
     def decode(self, can_msg):
-        return {s.key: s.decode_signal(can_msg[s.dbc_name]) for s in self.signals}
+        return self._record_class.make(*(s.decode_signal(can_msg[s.dbc_name]) for s in self.signals))
+
+    @property
+    def np_dtype(self) -> np.dtype:
+        return np.dtype([("t", np.float64)] + [(s.key, s.np_dtype) for s in self.signals])
+
+    @property
+    def record_class(self) -> type[MsgRecord]:
+        return self._record_class
+
+    @property
+    def data_decoder(self) -> Callable[[bytes], MsgRecord]:
+        return self._data_decoder
+
+    @property
+    def data_encoder(self) -> Callable[[dict], bytes]:
+        return self._data_encoder
+
+    def decode_data(self, data: bytes) -> MsgRecord:
+        return self._data_decoder(data)
+
+    def encode_data(self, d: dict) -> bytes:
+        return self._data_encoder(d)
+
+    @property
+    def is_multi_frame(self) -> bool:
+        return self.size > 8
+
+    def decode_array(self, t: np.ndarray, raw: np.ndarray) -> np.ndarray:
+        if self.is_multi_frame:
+            raise ValueError(f"Array decoding only supports single frame messages: {self.key} has {self.size} bytes")
+
+        out = np.empty(len(raw), dtype=self.np_dtype)
+        out["t"] = t
+        decode_array(self.signals, raw, out)
+        return out
 
 
 class NodeMessageConfig(BaseModel):
@@ -129,12 +279,19 @@ class NodeMessageConfig(BaseModel):
     def decode(self, can_msg: dict):
         return self.msg_type.decode(can_msg)
 
+    def encode_data(self, d: dict) -> bytes:
+        return self.msg_type.encode_data(d)
+
+    def decode_data(self, data: bytes) -> MsgRecord:
+        return self.msg_type.decode_data(data)
+
 
 class NodeTypeConfig(BaseModel):
     key: str
     messages: list[NodeMessageConfig]
     mock_class: Optional[str] = None
     node_state_class: Optional[str] = None
+    liveness_timeout: Optional[float] = None  # node is considered offline after this time (s) without messages
 
     _message_by_key: Optional[dict[str, NodeMessageConfig]] = PrivateAttr(default=None)
 
@@ -155,6 +312,7 @@ class NodeConfig(BaseModel):
     node_addr: int
     params: Optional[dict] = Field(default_factory=lambda: {})
     debug: dict
+    bus: Optional[str] = None  # key of the bus the node is connected to, defaults to the first bus
     node_mock_class: Optional[str] = Field(default=None, alias="mock_class")
     node_node_state_class: Optional[str] = Field(default=None, alias="node_state_class")
 
@@ -273,6 +431,12 @@ class AssemblyConfig(BaseModel):
         return repr(self)
 
 
+class OutlierFilterConfig(BaseModel):
+    size: int = 15  # samples in the window of the filter
+    n_sigmas: float = 3.5  # threshold in (MAD based) standard deviations
+    min_deviation: float = 0.05  # °C, lower bound of the standard deviation
+
+
 class ControllerConfig(BaseModel):
     p_gain: float
     d_gain: float
@@ -287,6 +451,15 @@ class DataCollectConfig(BaseModel):
     collect_interval: float
 
 
+class FusionConfig(BaseModel):
+    process_noise: float = 1e-5  # °C² / s³, random changes of the heating rate
+    measurement_noise: float = 0.01  # °C², variance of a thermometer sample
+    sensor_noise: dict[str, float] = {}  # variance per thermometer node key, overrides `measurement_noise`
+
+    def sensor_variance(self, node_key: str) -> float:
+        return self.sensor_noise.get(node_key, self.measurement_noise)
+
+
 class TempSignalControllerConfig(BaseModel):
     p_gain: float
     d_gain: float
@@ -299,6 +472,9 @@ class TempSignalControllerConfig(BaseModel):
 class CanEnvConfig:
     conf_dict: dict
     port: CanPortConfig
+    recorder: Optional[RecorderConfig]
+    rollup: Optional[RollupConfig]
+    store: Optional[StoreConfig]
     dbc: Database
     message_types: list[MsgTypeConfig]
     node_types: list[NodeTypeConfig]
@@ -316,6 +492,21 @@ class CanEnvConfig:
         self.conf_dict = conf_dict
         self.port = CanPortConfig(**conf_dict['port'])
 
+        if conf_dict.get('recorder') is not None:
+            self.recorder = RecorderConfig(**conf_dict['recorder'])
+        else:
+            self.recorder = None
+
+        if conf_dict.get('rollup') is not None:
+            self.rollup = RollupConfig(**conf_dict['rollup'])
+        else:
+            self.rollup = None
+
+        if conf_dict.get('store') is not None:
+            self.store = StoreConfig(**conf_dict['store'])
+        else:
+            self.store = None
+
         self.message_types = []
         self._message_types_by_key = {}
         for mt_conf in conf_dict['message_types']:
@@ -338,6 +529,12 @@ class CanEnvConfig:
         for node_conf in conf_dict['nodes']:
             node = NodeConfig(**node_conf)
             node.bind(self.node_types) #, self.dbc)
+            if node.bus is None and self.port.bus is not None:
+                node.bus = self.port.bus.key
+            elif node.bus is not None:
+                self.port.bus_config(node.bus)
+            if node.debug.get('mock', False) and node.bus is not None and self.port.bus_config(node.bus).mock_channel is None:
+                raise ValueError(f"Node {node.key} is mocked but bus {node.bus} has no mock channel")
             self.nodes.append(node)
             self._nodes_by_key[node.key] = node
 
@@ -369,6 +566,14 @@ class CanEnvConfig:
     def assembly(self, key):
         return self._assembly_by_key[key]
 
+    def bus_config(self, key: str) -> CanBusConfig:
+        # config of the bus as used by the port, i.e. on the mock channel if nodes of the bus are mocked
+        bus_conf = self.port.bus_config(key)
+        if any(node.bus == key and node.debug.get('mock', False) for node in self.nodes):
+            return bus_conf.mock_config()
+        else:
+            return bus_conf
+
 
 def load_config_dict(path=CONFIG_PATH) -> dict:
     with open(path) as f:
@@ -429,7 +634,7 @@ BU_: MASTER SLAVE
             raise ValueError("message direction was not 'rx' or 'tx'")
 
         dbc_str_buf.append("\n")
-        dbc_str_buf.append(f"BO_ {can_id} {msg_type_conf.dbc_name}: 8 {sender_node}\n")
+        dbc_str_buf.append(f"BO_ {can_id} {msg_type_conf.dbc_name}: {msg_type_conf.size} {sender_node}\n")
 
         for signal in msg_type_conf.signals:
             if abs(signal.value_scale - int(signal.value_scale)) < 1e-12:
@@ -0,0 +1,95 @@
+import math
+from typing import Optional, Tuple
+
+
+class TempKalman:
+    """
+    Kalman filter over the state (temperature, rate of change) with a constant rate model. Samples of several sensors
+    are fused by updating the same state with the noise variance of the respective sensor. Predict and update are
+    O(1), the 2x2 matrices are kept as scalars.
+
+    `process_noise` is the spectral density (°C² / s³) of the random changes of the rate, it trades smoothness of the
+    rate estimate against the latency to changes of the heating power.
+    """
+    process_noise: float
+    initial_rate_variance: float
+
+    t: Optional[float]
+    temp: float
+    rate: float
+    # covariance [[p00, p01], [p01, p11]]
+    p00: float
+    p01: float
+    p11: float
+    version: int  # bumped on every update
+
+    def __init__(self, process_noise: float, initial_rate_variance: float = 1.0):
+        self.process_noise = process_noise
+        self.initial_rate_variance = initial_rate_variance
+        self.version = 0
+        self.reset()
+
+    def reset(self) -> None:
+        self.t = None
+        self.temp = float("nan")
+        self.rate = 0.0
+        self.p00 = self.p01 = self.p11 = 0.0
+        self.version += 1
+
+    @property
+    def initialized(self) -> bool:
+        return self.t is not None
+
+    def _predicted(self, t: float) -> Tuple[float, float, float, float, float]:
+        # state and covariance moved forward to `t` (samples older than the state are applied at the state time)
+        dt = max(t - self.t, 0.0)
+        q = self.process_noise
+
+        temp = self.temp + dt * self.rate
+        p00 = self.p00 + dt * (2.0 * self.p01 + dt * self.p11) + q * dt ** 3 / 3.0
+        p01 = self.p01 + dt * self.p11 + q * dt ** 2 / 2.0
+        p11 = self.p11 + q * dt
+        return temp, self.rate, p00, p01, p11
+
+    def update(self, t: float, temp: float, variance: float) -> None:
+        if math.isnan(temp):
+            return
+
+        if self.t is None:
+            self.t = t
+            self.temp = temp
+            self.rate = 0.0
+            self.p00, self.p01, self.p11 = variance, 0.0, self.initial_rate_variance
+            self.version += 1
+            return
+
+        x0, x1, p00, p01, p11 = self._predicted(t)
+
+        # measurement of the temperature only: H = [1, 0]
+        s = p00 + variance
+        k0 = p00 / s
+        k1 = p01 / s
+        innovation = temp - x0
+
+        self.temp = x0 + k0 * innovation
+        self.rate = x1 + k1 * innovation
+        self.p00 = (1.0 - k0) * p00
+        self.p01 = (1.0 - k0) * p01
+        self.p11 = p11 - k1 * p01
+        self.t = max(t, self.t)
+        self.version += 1
+
+    def state(self, t: float) -> Optional[Tuple[float, float]]:
+        # temperature and rate (°C / s) extrapolated to `t`, `None` before the first sample
+        if self.t is None:
+            return None
+
+        x0, x1, _, _, _ = self._predicted(t)
+        return x0, x1
+
+    def variance(self, t: float) -> Optional[Tuple[float, float]]:
+        if self.t is None:
+            return None
+
+        _, _, p00, _, p11 = self._predicted(t)
+        return p00, p11
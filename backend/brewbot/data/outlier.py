@@ -0,0 +1,143 @@
+import math
+from bisect import bisect_left, insort
+from typing import Optional
+
+# MAD of normally distributed samples * MAD_SCALE = standard deviation
+MAD_SCALE = 1.4826
+
+
+class HampelFilter:
+    """
+    Streaming Hampel filter: a sample is rejected if it deviates from the median of the last `size` samples by more
+    than `n_sigmas` times the scaled median absolute deviation (MAD) of these samples. `min_deviation` is a lower bound
+    of the scaled MAD, so a window of (almost) identical readings doesn't reject the next small change.
+
+    The window is kept twice, as a ring in arrival order and as a sorted list of fixed length. Replacing the oldest
+    sample is a bisect plus a delete and an insert within the sorted list, which shift the list: O(n), but a memmove
+    of n pointers is negligible for windows of up to a few thousand samples and beats O(log n) structures written in
+    Python (e.g. an indexable skiplist) by far for such windows. Median and MAD are read from the sorted list in
+    O(log n) (the MAD is the k-th smallest distance of the two sorted halves left and right of the median). No
+    containers are allocated per sample.
+
+    Rejected samples still enter the window, so a real step of the signal is accepted once it makes up half of the
+    window.
+    """
+    size: int
+    n_sigmas: float
+    min_deviation: float
+    min_samples: int
+
+    accepted: int
+    rejected: int
+
+    _ring: list[float]
+    _sorted: list[float]
+    _head: int
+
+    def __init__(self, size: int, n_sigmas: float = 3.0, min_deviation: float = 0.0, min_samples: int = 3):
+        if size < 3:
+            raise ValueError("filter size must be at least 3")
+
+        self.size = size
+        self.n_sigmas = n_sigmas
+        self.min_deviation = min_deviation
+        self.min_samples = min(max(min_samples, 1), size)
+
+        self.accepted = 0
+        self.rejected = 0
+
+        self._ring = [0.0] * size
+        self._sorted = []
+        self._head = 0
+
+    def clear(self) -> None:
+        # the counters are kept
+        self._sorted.clear()
+        self._head = 0
+
+    def __len__(self) -> int:
+        return len(self._sorted)
+
+    def median(self) -> Optional[float]:
+        s = self._sorted
+        n = len(s)
+        if n == 0:
+            return None
+
+        mid = n // 2
+        return s[mid] if n % 2 == 1 else 0.5 * (s[mid - 1] + s[mid])
+
+    def mad(self) -> Optional[float]:
+        # median absolute deviation from the median
+        n = len(self._sorted)
+        if n == 0:
+            return None
+
+        m = self.median()
+        p = bisect_left(self._sorted, m)
+        mid = n // 2
+        if n % 2 == 1:
+            return self._kth_deviation(m, p, mid)
+        else:
+            return 0.5 * (self._kth_deviation(m, p, mid - 1) + self._kth_deviation(m, p, mid))
+
+    def _kth_deviation(self, m: float, p: int, k: int) -> float:
+        # k-th smallest (from 0) of |s[i] - m|. The distances left of `p` (m - s[p - 1 - i]) and right of it
+        # (s[p + j] - m) are both ascending, the k-th smallest of both is found by bisecting how many of the k + 1
+        # smallest come from the left.
+        s = self._sorted
+        n_left, n_right = p, len(s) - p
+
+        lo, hi = max(0, k + 1 - n_right), min(k + 1, n_left)
+        while lo < hi:
+            i = (lo + hi) // 2
+            j = k + 1 - i
+            if m - s[p - 1 - i] < s[p + j - 1] - m:
+                lo = i + 1
+            else:
+                hi = i
+
+        i, j = lo, k + 1 - lo
+        left = m - s[p - i] if i > 0 else -math.inf
+        right = s[p + j - 1] - m if j > 0 else -math.inf
+        return max(left, right)
+
+    def is_outlier(self, value: float) -> bool:
+        # test `value` against the current window without adding it
+        if math.isnan(value):
+            return True
+
+        if len(self._sorted) < self.min_samples:
+            return False
+
+        scale = max(MAD_SCALE * self.mad(), self.min_deviation)
+        return abs(value - self.median()) > self.n_sigmas * scale
+
+    def push(self, value: float) -> None:
+        s = self._sorted
+        if len(s) == self.size:
+            del s[bisect_left(s, self._ring[self._head])]
+
+        insort(s, value)
+        self._ring[self._head] = value
+        self._head = (self._head + 1) % self.size
+
+    def accept(self, value: float) -> bool:
+        # True if the sample passes the filter. NaN samples are rejected and not added to the window.
+        outlier = self.is_outlier(value)
+
+        if not math.isnan(value):
+            self.push(value)
+
+        if outlier:
+            self.rejected += 1
+        else:
+            self.accepted += 1
+
+        return not outlier
+
+    def stats(self) -> dict[str, int]:
+        return {
+            "accepted": self.accepted,
+            "rejected": self.rejected
+        }
@@ -1,14 +1,14 @@
 import numpy as np
-import pandas as pd
+from brewbot.data.series import WindowedSeries
 
 
-def calculate_pd_error(setpoint: float, df: pd.DataFrame, current_time: float, time_window: float) -> (float, float):
+def calculate_pd_error(setpoint: float, series: WindowedSeries, current_time: float, time_window: float) -> (float, float):
     """
     Calculates the proportional (P) and derivative (D) error components for a PID controller.
 
     Parameters:
     - setpoint: The desired reference value (r).
-    - df: A pandas DataFrame containing time-indexed measurements of the system.
+    - series: A WindowedSeries containing the time-indexed measurements of the system (first column).
     - current_time: The current time (t) for which the P and D errors are being calculated.
     - time_window: The time window (dt) to filter the measurements from current_time - time_window to current_time.
 
@@ -17,20 +17,16 @@ def calculate_pd_error(setpoint: float, df: pd.DataFrame, current_time: float, t
     - d_error: Derivative error (D component).
     """
 
-    filtered_data = df.loc[(current_time - time_window):current_time]
+    # Linear least squares fit over the window, maintained incrementally by the series. With only one data point the
+    # slope is 0 (D = 0.0)
+    line = series.linear_fit(current_time, time_window)
 
-    if len(filtered_data) == 0:
+    if line is None:
         return float("nan"), float("nan")
 
-    if len(filtered_data) == 1:
-        # If only one data point exists, assume no change in slope (D = 0.0)
-        return setpoint - filtered_data.iloc[0]["y"], 0.0
-
-    # Fit a linear polynomial (1st-degree) to the filtered data to approximate slope
-    poly = np.polyfit(filtered_data.index.to_numpy(), filtered_data['y'].to_numpy(), 1)
-
-    p_error = setpoint - np.polyval(poly, current_time)
-    d_error = -poly[0]  # D-Error = negative of the slope from the polynomial fit
+    value, slope = line
+    p_error = setpoint - float(value[0])
+    d_error = -float(slope[0])  # D-Error = negative of the slope of the fitted line
 
     return p_error, d_error
 
@@ -0,0 +1,106 @@
+import numpy as np
+from typing import Optional, Tuple
+
+
+class RunningLinearFit:
+    """
+    Least squares line through a sliding set of samples, maintained with the running sums Σt, Σy, Σt², Σty so that
+    adding a sample, removing a sample and querying the line are O(1).
+
+    Times are taken relative to the reference `t0` (time centring) to keep the sums small. `needs_rebuild` tells when
+    the reference lies too far behind the samples, the owner then rebuilds the sums from its samples which also drops
+    the rounding errors accumulated by the removals.
+    """
+    columns: int
+    t0: Optional[float]
+    span: float
+
+    n: int
+    sum_t: float
+    sum_tt: float
+    sum_y: np.ndarray
+    sum_ty: np.ndarray
+
+    def __init__(self, columns: int, span: float):
+        self.columns = columns
+        self.span = span
+        self.reset()
+
+    def reset(self, t0: Optional[float] = None) -> None:
+        self.t0 = t0
+        self.n = 0
+        self.sum_t = 0.0
+        self.sum_tt = 0.0
+        self.sum_y = np.zeros(self.columns)
+        self.sum_ty = np.zeros(self.columns)
+
+    def rebuild(self, t: np.ndarray, values: np.ndarray) -> None:
+        if len(t) == 0:
+            self.reset()
+            return
+
+        self.reset(float(t[0]))
+        dt = t - self.t0
+        self.n = len(t)
+        self.sum_t = float(dt.sum())
+        self.sum_tt = float(dt @ dt)
+        self.sum_y = values.sum(axis=0)
+        self.sum_ty = dt @ values
+
+    def needs_rebuild(self, t: float) -> bool:
+        return self.t0 is not None and t - self.t0 > self.span
+
+    def add(self, t: float, values: np.ndarray) -> None:
+        if self.t0 is None:
+            self.t0 = t
+
+        dt = t - self.t0
+        self.n += 1
+        self.sum_t += dt
+        self.sum_tt += dt * dt
+        self.sum_y += values
+        self.sum_ty += dt * values
+
+    def remove(self, t: float, values: np.ndarray) -> None:
+        if self.n <= 1:
+            self.reset()
+            return
+
+        dt = t - self.t0
+        self.n -= 1
+        self.sum_t -= dt
+        self.sum_tt -= dt * dt
+        self.sum_y -= values
+        self.sum_ty -= dt * values
+
+    def line(self, t: float) -> Optional[Tuple[np.ndarray, np.ndarray]]:
+        # value at `t` and slope of every column, `None` without samples. A single sample (or samples that all share
+        # the same time) has slope 0.
+        return self._line(t, self.n, self.sum_t, self.sum_tt, self.sum_y, self.sum_ty)
+
+    def line_without(self, t: float, t_old: np.ndarray, values_old: np.ndarray) -> Optional[Tuple[np.ndarray, np.ndarray]]:
+        # `line` of the samples without the (contained) samples `t_old` / `values_old`, the sums are left unchanged
+        dt = t_old - self.t0
+        return self._line(
+            t,
+            self.n - len(dt),
+            self.sum_t - float(dt.sum()),
+            self.sum_tt - float(dt @ dt),
+            self.sum_y - values_old.sum(axis=0),
+            self.sum_ty - dt @ values_old
+        )
+
+    def _line(self, t: float, n: int, sum_t: float, sum_tt: float, sum_y: np.ndarray, sum_ty: np.ndarray) -> Optional[Tuple[np.ndarray, np.ndarray]]:
+        if n <= 0:
+            return None
+
+        mean_t = sum_t / n
+        mean_y = sum_y / n
+        var_t = sum_tt - sum_t * mean_t
+
+        if var_t <= 1e-12 * max(sum_tt, 1.0):
+            slope = np.zeros(self.columns)
+        else:
+            slope = (sum_ty - sum_t * mean_y) / var_t
+
+        return mean_y + slope * (t - self.t0 - mean_t), slope
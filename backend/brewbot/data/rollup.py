@@ -0,0 +1,195 @@
+import math
+import numpy as np
+from typing import Optional, Sequence
+
+
+class RollupSeries:
+    """
+    Min / max / mean / last of a signal per time bucket of `interval` seconds, for the last `capacity` buckets.
+
+    Bucket `b` covers [b * interval, (b + 1) * interval) and lives in slot `b % capacity` of fixed-size arrays, so memory
+    is bounded and a query touches only the buckets it returns.
+    """
+    interval: float
+    capacity: int
+
+    bucket: np.ndarray  # bucket number held by the slot, -1 = empty
+    count: np.ndarray
+    min: np.ndarray
+    max: np.ndarray
+    sum: np.ndarray
+    last: np.ndarray
+    first: int  # bucket number of the first sample, -1 = no samples yet
+    latest: int  # newest bucket number, -1 = no samples yet
+
+    def __init__(self, interval: float, capacity: int):
+        if interval <= 0 or capacity <= 0:
+            raise ValueError("interval and capacity must be positive")
+
+        self.interval = interval
+        self.capacity = capacity
+
+        self.bucket = np.full(capacity, -1, dtype=np.int64)
+        self.count = np.zeros(capacity, dtype=np.int64)
+        self.min = np.zeros(capacity)
+        self.max = np.zeros(capacity)
+        self.sum = np.zeros(capacity)
+        self.last = np.zeros(capacity)
+        self.first = -1
+        self.latest = -1
+
+    @property
+    def nbytes(self) -> int:
+        return sum(a.nbytes for a in (self.bucket, self.count, self.min, self.max, self.sum, self.last))
+
+    @property
+    def oldest_t(self) -> Optional[float]:
+        # start of the oldest bucket that is still retained
+        if self.latest < 0:
+            return None
+
+        return max(self.latest - self.capacity + 1, self.first) * self.interval
+
+    def add(self, t: float, value: float) -> None:
+        b = int(t // self.interval)
+        if b < self.latest - self.capacity + 1:
+            # older than the retained history
+            return
+
+        slot = b % self.capacity
+
+        if self.bucket[slot] != b:
+            self.bucket[slot] = b
+            self.count[slot] = 1
+            self.min[slot] = self.max[slot] = self.sum[slot] = self.last[slot] = value
+        else:
+            self.count[slot] += 1
+            if value < self.min[slot]:
+                self.min[slot] = value
+            if value > self.max[slot]:
+                self.max[slot] = value
+            self.sum[slot] += value
+            self.last[slot] = value
+
+        if self.first < 0:
+            self.first = b
+        if b > self.latest:
+            self.latest = b
+
+    def query(self, t_from: Optional[float] = None, t_to: Optional[float] = None) -> dict[str, np.ndarray]:
+        # buckets with samples overlapping [t_from, t_to], `t` is the bucket start
+        if self.latest < 0:
+            b_from, b_to = 0, -1
+        else:
+            b_oldest = max(self.latest - self.capacity + 1, self.first)
+            b_from = b_oldest if t_from is None else max(int(t_from // self.interval), b_oldest)
+            b_to = self.latest if t_to is None else min(int(t_to // self.interval), self.latest)
+
+        buckets = np.arange(b_from, b_to + 1, dtype=np.int64)
+        slots = buckets % self.capacity
+        slots = slots[self.bucket[slots] == buckets]
+
+        count = self.count[slots]
+        return {
+            "t": self.bucket[slots] * self.interval,
+            "count": count,
+            "min": self.min[slots],
+            "max": self.max[slots],
+            "mean": self.sum[slots] / count,
+            "last": self.last[slots]
+        }
+
+
+class SignalRollup:
+    """
+    Rollups of a single signal at several resolutions (finest first). Every sample updates all of them.
+    """
+    resolutions: list[RollupSeries]
+
+    def __init__(self, resolutions: Sequence[tuple[float, int]]):
+        self.resolutions = [RollupSeries(interval, capacity) for interval, capacity in sorted(resolutions)]
+
+    def add(self, t: float, value: float) -> None:
+        for series in self.resolutions:
+            series.add(t, value)
+
+    def select(self, t_from: Optional[float], t_to: Optional[float], max_points: Optional[int] = None) -> RollupSeries:
+        # finest resolution that still retains `t_from` (default: the first sample) and doesn't return more than
+        # `max_points` buckets. Falls back to the coarsest resolution.
+        for series in self.resolutions[:-1]:
+            if series.latest < 0:
+                return series
+
+            t_start = series.first * series.interval if t_from is None else t_from
+            if t_start < series.oldest_t:
+                continue
+
+            t_end = (series.latest + 1) * series.interval if t_to is None else t_to
+            if max_points is not None and math.ceil((t_end - t_start) / series.interval) > max_points:
+                continue
+
+            return series
+
+        return self.resolutions[-1]
+
+
+class RollupStore:
+    """
+    Downsampled history of all decoded signals, keyed by `<node>.<message>.<signal>`. Flags are stored as 0 / 1, so the
+    mean of a relay state is its duty cycle within the bucket.
+    """
+    resolutions: list[tuple[float, int]]
+    signals: dict[str, SignalRollup]
+
+    _last_msgs: dict[tuple[str, str], dict]
+    _signal_keys: dict[tuple[str, str], tuple[Sequence[str], list[str]]]  # message keys -> signal keys
+
+    def __init__(self, resolutions: Sequence[tuple[float, int]]):
+        if len(resolutions) == 0:
+            raise ValueError("at least one rollup resolution is required")
+
+        self.resolutions = sorted(resolutions)
+        self.signals = {}
+        self._last_msgs = {}
+        self._signal_keys = {}
+
+    def signal(self, key: str) -> SignalRollup:
+        rollup = self.signals.get(key)
+        if rollup is None:
+            rollup = self.signals[key] = SignalRollup(self.resolutions)
+
+        return rollup
+
+    def record(self, key: str, t: float, value: float) -> None:
+        self.signal(key).add(t, value)
+
+    def record_message(self, node_key: str, msg_key: str, msg: dict, t: float) -> None:
+        self._last_msgs[(node_key, msg_key)] = msg
+
+        # records of a message share the `_fields` tuple of their class, so the signal keys are built once
+        fields = msg.keys()
+        cached = self._signal_keys.get((node_key, msg_key))
+        if cached is None or cached[0] is not fields:
+            cached = self._signal_keys[(node_key, msg_key)] = (fields, [f"{node_key}.{msg_key}.{field}" for field in fields])
+
+        for key, value in zip(cached[1], msg.values()):
+            if isinstance(value, (int, float)):
+                self.record(key, t, float(value))
+
+    def repeat_message(self, node_key: str, msg_key: str, t: float) -> None:
+        # a frame that repeated the last payload of the message (see `MsgTypeConfig.dedup`)
+        msg = self._last_msgs.get((node_key, msg_key))
+        if msg is not None:
+            self.record_message(node_key, msg_key, msg, t)
+
+    def query(self, key: str, t_from: Optional[float] = None, t_to: Optional[float] = None, max_points: Optional[int] = None) -> Optional[dict]:
+        rollup = self.signals.get(key)
+        if rollup is None:
+            return None
+
+        series = rollup.select(t_from, t_to, max_points)
+        return {"interval": series.interval, **{k: v.tolist() for k, v in series.query(t_from, t_to).items()}}
+
+    @property
+    def nbytes(self) -> int:
+        return sum(series.nbytes for rollup in self.signals.values() for series in rollup.resolutions)
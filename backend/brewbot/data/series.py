@@ -0,0 +1,145 @@
+import numpy as np
+from brewbot.data.regression import RunningLinearFit
+from typing import Optional, Sequence, Tuple
+
+# default number of samples a series holds, the oldest samples are dropped when it is exceeded
+DEFAULT_CAPACITY = 4096
+
+
+class WindowedSeries:
+    """
+    Time series of the samples within the last `window` seconds, stored in preallocated numpy arrays.
+
+    Every sample is written twice, at `i` and `i + capacity`, so the live window is always the contiguous slice
+    `[start, start + size)` of the doubled arrays: appending is O(1) and `t` / `values` are views without copying.
+    Samples are expected in time order. If more than `capacity` samples fall into the window, the oldest are dropped.
+
+    With `fit` a least squares line through the window is maintained along with the samples (see `linear_fit`).
+    """
+    window: float
+    columns: list[str]
+    capacity: int
+
+    _t: np.ndarray
+    _values: np.ndarray
+    _start: int
+    _size: int
+    _fit: Optional[RunningLinearFit]
+
+    def __init__(self, window: float, columns: Sequence[str] = ("y",), capacity: int = DEFAULT_CAPACITY, fit: bool = False):
+        if capacity <= 0:
+            raise ValueError("capacity must be positive")
+
+        self.window = window
+        self.columns = list(columns)
+        self.capacity = capacity
+
+        self._t = np.empty(2 * capacity, dtype=np.float64)
+        self._values = np.empty((2 * capacity, len(self.columns)), dtype=np.float64)
+        self._fit = RunningLinearFit(len(self.columns), window) if fit else None
+        self.clear()
+
+    def clear(self) -> None:
+        self._start = 0
+        self._size = 0
+
+        if self._fit is not None:
+            self._fit.reset()
+
+    def __len__(self) -> int:
+        return self._size
+
+    @property
+    def t(self) -> np.ndarray:
+        return self._t[self._start:self._start + self._size]
+
+    @property
+    def values(self) -> np.ndarray:
+        # (samples, columns)
+        return self._values[self._start:self._start + self._size]
+
+    def column(self, column: str) -> np.ndarray:
+        return self.values[:, self.columns.index(column)]
+
+    @property
+    def last_t(self) -> Optional[float]:
+        return float(self._t[self._start + self._size - 1]) if self._size != 0 else None
+
+    def append(self, t: float, values: float | Sequence[float], curr: Optional[float] = None) -> None:
+        if self._size != 0 and t < self._t[self._start + self._size - 1]:
+            raise ValueError(f"Sample at {t} is older than the last sample of the series")
+
+        if self._size == self.capacity:
+            self._drop_first()
+
+        if self._start == self.capacity:
+            # the window moved into the mirrored half -> continue in the first half
+            self._start = 0
+
+        i = self._start + self._size
+        j = i - self.capacity if i >= self.capacity else i + self.capacity
+
+        self._t[i] = self._t[j] = t
+        self._values[i] = self._values[j] = values
+        self._size += 1
+
+        if self._fit is not None:
+            self._fit.add(t, self._values[i])
+
+        self._remove_old(t if curr is None else curr)
+
+        if self._fit is not None and self._fit.needs_rebuild(t):
+            self._fit.rebuild(self.t, self.values)
+
+    def _drop_first(self) -> None:
+        if self._fit is not None:
+            self._fit.remove(self._t[self._start], self._values[self._start])
+
+        self._start += 1
+        self._size -= 1
+
+    def _remove_old(self, current_time: float) -> None:
+        t_min = current_time - self.window
+        while self._size != 0 and self._t[self._start] < t_min:
+            self._drop_first()
+
+        if self._start >= self.capacity:
+            self._start -= self.capacity
+
+    def between(self, t_from: float, t_to: float) -> Tuple[np.ndarray, np.ndarray]:
+        # views of the timestamps and values with t_from <= t <= t_to
+        t = self.t
+        lo = int(np.searchsorted(t, t_from, side="left"))
+        hi = int(np.searchsorted(t, t_to, side="right"))
+        return t[lo:hi], self.values[lo:hi]
+
+    def linear_fit(self, current_time: float, window: Optional[float] = None) -> Optional[Tuple[np.ndarray, np.ndarray]]:
+        """
+        Least squares line through the samples within `window` (default: the window of the series) before
+        `current_time`. Returns the value of the line at `current_time` and its slope for every column, `None` if there
+        are no samples. With a single sample the slope is 0.
+
+        Constant time (apart from the samples that left the window since the last `append`) if the series maintains
+        the fit and `window` is the window of the series, otherwise the line is fitted over the selected samples.
+        Queries don't change the series.
+        """
+        window = self.window if window is None else window
+
+        if self._fit is not None and window == self.window and (self._size == 0 or self.last_t <= current_time):
+            # samples that left the window by `current_time` are excluded from the result only: queries don't change
+            # the series, samples are evicted by `append`
+            n_old = int(np.searchsorted(self.t, current_time - window, side="left"))
+            if n_old == 0:
+                return self._fit.line(current_time)
+            else:
+                return self._fit.line_without(current_time, self.t[:n_old], self.values[:n_old])
+
+        t, values = self.between(current_time - window, current_time)
+
+        if len(t) == 0:
+            return None
+        elif len(t) == 1:
+            return values[0].copy(), np.zeros(len(self.columns))
+        else:
+            poly = np.polyfit(t, values, 1)
+            return poly[0] * current_time + poly[1], poly[0]
@@ -0,0 +1,325 @@
+import asyncio
+import datetime
+import logging
+import os
+import re
+import struct
+import numpy as np
+from concurrent.futures import Future, ThreadPoolExecutor
+from brewbot.config import StoreConfig
+from cysystemd import journal
+from typing import Optional, Sequence, Tuple
+
+# Signals are stored per session in a directory `<session>/<signal key>/` of compressed chunks `chunk-<n>.npz` with
+# the arrays `t` and `v`. Next to the chunks an append-only index `index.bin` holds one record per written chunk, so
+# range queries only load the chunks that overlap the range. A chunk is renamed into place before its index record is
+# written, a crash loses at most the samples that were not flushed yet.
+
+CHUNK_INDEX_RECORD = struct.Struct("<ddQI")  # first timestamp, last timestamp, sample count, chunk number
+CHUNK_INDEX_DTYPE = np.dtype([("t_first", "<f8"), ("t_last", "<f8"), ("count", "<u8"), ("chunk_no", "<u4")])
+
+# signal keys are `<node key>.<message key>.<signal key>`: word characters separated by single dots, so that a key
+# never resolves outside of the session directory
+SIGNAL_KEY_PATTERN = re.compile(r"\w+(\.\w+)*")
+
+logger = logging.getLogger("brewbot.data.store")
+logger.setLevel(logging.INFO)
+
+if not logger.hasHandlers():  # Prevent duplicate logs if already configured
+    handler = journal.JournaldLogHandler()
+    formatter = logging.Formatter("[%(levelname)s] %(asctime)s %(name)s: %(message)s")
+    handler.setFormatter(formatter)
+    logger.addHandler(handler)
+
+
+def is_valid_signal_key(key: str) -> bool:
+    return SIGNAL_KEY_PATTERN.fullmatch(key) is not None
+
+
+def chunk_path(signal_path: str, chunk_no: int) -> str:
+    return os.path.join(signal_path, f"chunk-{chunk_no:06d}.npz")
+
+
+def index_path(signal_path: str) -> str:
+    return os.path.join(signal_path, "index.bin")
+
+
+def write_chunk(signal_path: str, chunk_no: int, t: np.ndarray, v: np.ndarray) -> None:
+    # runs in the writer thread
+    os.makedirs(signal_path, exist_ok=True)
+
+    path = chunk_path(signal_path, chunk_no)
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "wb") as f:
+        np.savez_compressed(f, t=t, v=v)
+    os.replace(tmp_path, path)
+
+    with open(index_path(signal_path), "ab") as f:
+        f.write(CHUNK_INDEX_RECORD.pack(float(t[0]), float(t[-1]), len(t), chunk_no))
+
+
+def read_chunks(signal_path: str, t_from: Optional[float] = None, t_to: Optional[float] = None) -> Tuple[np.ndarray, np.ndarray]:
+    # samples with t_from <= t <= t_to of the chunks on disk
+    idx_path = index_path(signal_path)
+    if not os.path.exists(idx_path):
+        return np.empty(0), np.empty(0)
+
+    with open(idx_path, "rb") as f:
+        data = f.read()
+    # ignore a record that was cut off by a crash
+    index = np.frombuffer(data[:len(data) - len(data) % CHUNK_INDEX_DTYPE.itemsize], dtype=CHUNK_INDEX_DTYPE)
+    if t_from is not None:
+        index = index[index["t_last"] >= t_from]
+    if t_to is not None:
+        index = index[index["t_first"] <= t_to]
+
+    ts, vs = [], []
+    for chunk_no in index["chunk_no"]:
+        with np.load(chunk_path(signal_path, int(chunk_no))) as chunk:
+            t, v = chunk["t"], chunk["v"]
+
+        lo = int(np.searchsorted(t, t_from, side="left")) if t_from is not None else 0
+        hi = int(np.searchsorted(t, t_to, side="right")) if t_to is not None else len(t)
+        ts.append(t[lo:hi])
+        vs.append(v[lo:hi])
+
+    if len(ts) == 0:
+        return np.empty(0), np.empty(0)
+
+    return np.concatenate(ts), np.concatenate(vs)
+
+
+class SignalBuffer:
+    __slots__ = ("t", "v", "size", "chunk_no")
+
+    t: np.ndarray
+    v: np.ndarray
+    size: int
+    chunk_no: int
+
+    def __init__(self, capacity: int):
+        self.t = np.empty(capacity)
+        self.v = np.empty(capacity)
+        self.size = 0
+        self.chunk_no = 0
+
+
+class SignalStore:
+    """
+    Persistent history of all decoded signals, one directory per session. Samples are collected in preallocated
+    buffers on the event loop; full buffers and all buffers every `flush_interval` are compressed and written by a
+    single writer thread, so disk latency never blocks the loop. If the writer falls behind by more than
+    `max_pending_chunks`, further chunks are dropped (and counted) instead of piling up in memory. Chunks that fail to
+    be written are logged and counted as dropped as well.
+    """
+    conf: StoreConfig
+    session_path: Optional[str]
+    dropped_samples: int
+
+    _buffers: dict[str, SignalBuffer]
+    _signal_keys: dict[Tuple[str, str], Tuple[Sequence[str], list[str]]]
+    _in_flight: dict[Tuple[str, int], Tuple[np.ndarray, np.ndarray]]
+    _executor: ThreadPoolExecutor
+    _loop: Optional[asyncio.AbstractEventLoop]
+    _generation: int
+    _chunk_offsets: dict[Tuple[int, str], int]  # only used by the writer thread
+
+    def __init__(self, conf: StoreConfig):
+        self.conf = conf
+        self.session_path = None
+        self.dropped_samples = 0
+
+        self._buffers = {}
+        self._signal_keys = {}
+        self._in_flight = {}
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="signal_store")
+        self._loop = None
+        self._generation = 0
+        self._chunk_offsets = {}
+
+    @property
+    def is_open(self) -> bool:
+        return self.session_path is not None
+
+    def open(self, session: Optional[str] = None) -> None:
+        if self.is_open:
+            self.close()
+
+        if session is None:
+            session = datetime.datetime.now().strftime("%Y%m%d-%H%M%S")
+
+        self.session_path = os.path.join(self.conf.path, session)
+        os.makedirs(self.session_path, exist_ok=True)
+        self._buffers = {}
+        self._loop = asyncio.get_running_loop()
+        # chunks are numbered from 0 per open, the writer continues after the chunks of earlier opens of the session
+        self._generation += 1
+
+    def close(self) -> None:
+        # the remaining samples are still written, the writer thread finishes them in order
+        if self.is_open:
+            self.flush()
+
+        self.session_path = None
+        self._buffers = {}
+
+    def signal_path(self, key: str) -> str:
+        if not is_valid_signal_key(key):
+            raise ValueError(f"Invalid signal key: {key}")
+
+        return os.path.join(self.session_path, key)
+
+    def append(self, key: str, t: float, value: float) -> None:
+        if self.session_path is None:
+            return
+
+        buffer = self._buffers.get(key)
+        if buffer is None:
+            buffer = self._buffers[key] = SignalBuffer(self.conf.chunk_size)
+
+        buffer.t[buffer.size] = t
+        buffer.v[buffer.size] = value
+        buffer.size += 1
+
+        if buffer.size == self.conf.chunk_size:
+            self._submit(key, buffer)
+
+    def append_message(self, node_key: str, msg_key: str, msg: dict, t: float) -> None:
+        # the keys of a record are the `_fields` of its class -> signal keys are only formatted for a new message type
+        fields = msg.keys()
+        cached = self._signal_keys.get((node_key, msg_key))
+        if cached is None or cached[0] is not fields:
+            cached = self._signal_keys[(node_key, msg_key)] = (fields, [f"{node_key}.{msg_key}.{field}" for field in fields])
+
+        for key, value in zip(cached[1], msg.values()):
+            if isinstance(value, (int, float)):
+                self.append(key, t, float(value))
+
+    def flush(self) -> None:
+        for key, buffer in self._buffers.items():
+            if buffer.size != 0:
+                self._submit(key, buffer)
+
+    def _submit(self, key: str, buffer: SignalBuffer) -> None:
+        t = buffer.t[:buffer.size].copy()
+        v = buffer.v[:buffer.size].copy()
+        chunk_no = buffer.chunk_no
+
+        buffer.size = 0
+        buffer.chunk_no += 1
+
+        if len(self._in_flight) >= self.conf.max_pending_chunks:
+            self.dropped_samples += len(t)
+            return
+
+        in_flight_key = (key, chunk_no)
+        self._in_flight[in_flight_key] = (t, v)
+
+        loop = self._loop
+
+        def written(f: Future):
+            # runs in the writer thread
+            if loop.is_closed():
+                self._written(in_flight_key, f)
+            else:
+                loop.call_soon_threadsafe(self._written, in_flight_key, f)
+
+        future = self._executor.submit(self._write_chunk, self._generation, self.signal_path(key), chunk_no, t, v)
+        future.add_done_callback(written)
+
+    def _write_chunk(self, generation: int, signal_path: str, chunk_no: int, t: np.ndarray, v: np.ndarray) -> None:
+        # runs in the writer thread
+        offset = self._chunk_offsets.get((generation, signal_path))
+        if offset is None:
+            # continue after the chunks of earlier opens of the session (which may have gaps of dropped chunks)
+            names = os.listdir(signal_path) if os.path.isdir(signal_path) else []
+            chunk_nos = [int(name[6:12]) for name in names if name.startswith("chunk-") and name.endswith(".npz")]
+            offset = self._chunk_offsets[(generation, signal_path)] = max(chunk_nos) + 1 if len(chunk_nos) != 0 else 0
+
+        write_chunk(signal_path, offset + chunk_no, t, v)
+
+    def _written(self, in_flight_key: Tuple[str, int], future: Future) -> None:
+        t, _ = self._in_flight.pop(in_flight_key, (None, None))
+
+        error = future.exception()
+        if error is not None:
+            key, chunk_no = in_flight_key
+            samples = len(t) if t is not None else 0
+            self.dropped_samples += samples
+            logger.error(f"Failed to write chunk {chunk_no} of {key} ({samples} samples dropped): {error}")
+
+    async def flush_coro(self):
+        await asyncio.sleep(self.conf.flush_interval)
+        self.flush()
+
+    def _pending(self, key: str) -> list[Tuple[np.ndarray, np.ndarray]]:
+        # copies of the samples of the signal that are not on disk yet (chunks being written and the buffer)
+        pending = [chunk for (chunk_key, _), chunk in sorted(self._in_flight.items()) if chunk_key == key]
+        buffer = self._buffers.get(key)
+        if buffer is not None and buffer.size != 0:
+            pending.append((buffer.t[:buffer.size].copy(), buffer.v[:buffer.size].copy()))
+
+        return pending
+
+    @staticmethod
+    def _merge(disk: Tuple[np.ndarray, np.ndarray], pending: list[Tuple[np.ndarray, np.ndarray]], t_from: Optional[float], t_to: Optional[float]) -> Tuple[np.ndarray, np.ndarray]:
+        t, v = disk
+        ts, vs = [t], [v]
+
+        written_until = t[-1] if len(t) != 0 else None
+        for chunk_t, chunk_v in pending:
+            mask = np.ones(len(chunk_t), dtype=bool)
+            if t_from is not None:
+                mask &= chunk_t >= t_from
+            if t_to is not None:
+                mask &= chunk_t <= t_to
+            if written_until is not None:
+                # pending chunks may have been written in the meantime
+                mask &= chunk_t > written_until
+            ts.append(chunk_t[mask])
+            vs.append(chunk_v[mask])
+
+        return np.concatenate(ts), np.concatenate(vs)
+
+    def read(self, key: str, t_from: Optional[float] = None, t_to: Optional[float] = None) -> Tuple[np.ndarray, np.ndarray]:
+        # samples of the current session: chunks on disk, chunks being written and the buffer
+        if self.session_path is None:
+            return np.empty(0), np.empty(0)
+
+        pending = self._pending(key)
+        return self._merge(read_chunks(self.signal_path(key), t_from, t_to), pending, t_from, t_to)
+
+    async def read_coro(self, key: str, t_from: Optional[float] = None, t_to: Optional[float] = None) -> Tuple[np.ndarray, np.ndarray]:
+        # like `read`, but the chunks are loaded in a thread to keep the event loop free
+        if self.session_path is None:
+            return np.empty(0), np.empty(0)
+
+        pending = self._pending(key)
+        disk = await asyncio.get_running_loop().run_in_executor(None, read_chunks, self.signal_path(key), t_from, t_to)
+        return self._merge(disk, pending, t_from, t_to)
+
+
+class SignalLog:
+    """
+    Read access to the stored signals of a session.
+    """
+    session_path: str
+
+    def __init__(self, session_path: str):
+        self.session_path = session_path
+
+    def signals(self) -> list[str]:
+        return sorted(d for d in os.listdir(self.session_path) if os.path.exists(index_path(os.path.join(self.session_path, d))))
+
+    def read(self, key: str, t_from: Optional[float] = None, t_to: Optional[float] = None) -> Tuple[np.ndarray, np.ndarray]:
+        if not is_valid_signal_key(key):
+            raise ValueError(f"Invalid signal key: {key}")
+
+        return read_chunks(os.path.join(self.session_path, key), t_from, t_to)
+
+
+def list_sessions(path: str) -> list[str]:
+    if not os.path.isdir(path):
+        return []
+
+    return sorted(d for d in os.listdir(path) if os.path.isdir(os.path.join(path, d)))
@@ -1,13 +1,17 @@
 from asyncio.tasks import Task
 from fastapi import FastAPI, Query
 from contextlib import asynccontextmanager
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, StreamingResponse
 from brewbot.assembly.kettle import KettleAssembly
 from brewbot.config import load_config, CanEnvConfig
 from brewbot.can.can_env import CanEnv
+from brewbot.can.event_bus import POLICY_DROP_OLDEST, POLICY_LATEST_ONLY, DEFAULT_QUEUE_SIZE
+from brewbot.data.store import is_valid_signal_key
 from brewbot.util import map_tasks
 from typing import Optional
 from dataclasses import dataclass
+import itertools
+import json
 import logging
 from cysystemd import journal
 
@@ -180,7 +184,7 @@ async def get_heat_plate_state_route(kettle_name):
             "action": "get_heat_plate_state",
             "kettle_name": kettle_name,
             "status": "success",
-            "data": {kettle.heat_plate_state}
+            "data": kettle.heat_plate_state
         })
 
 
@@ -244,6 +248,95 @@ async def set_temp_setpoint_route(kettle_name, r: float = Query(None, descriptio
         })
 
 
+@app.get("/history")
+async def get_history_signals_route():
+    app_state: AppState = app.state.app_state
+    can_env: CanEnv = app_state.can_env
+
+    if can_env.rollups is None:
+        return JSONResponse(status_code=400, content={
+            "action": "get_history_signals",
+            "status": "error",
+            "error": {"code": 400, "msg": "history is not configured"}
+        })
+    else:
+        return JSONResponse(status_code=200, content={
+            "action": "get_history_signals",
+            "status": "success",
+            "data": {
+                "resolutions": [{"interval": interval, "capacity": capacity} for interval, capacity in can_env.rollups.resolutions],
+                "signals": sorted(can_env.rollups.signals.keys()),
+                "bytes": can_env.rollups.nbytes
+            }
+        })
+
+
+@app.get("/history/{signal_key}")
+async def get_history_route(
+        signal_key,
+        t_from: float = Query(None, description="Start time (unix timestamp), default: first sample"),
+        t_to: float = Query(None, description="End time (unix timestamp), default: latest sample"),
+        max_points: int = Query(None, description="Upper bound for the number of buckets, selects the resolution")):
+    app_state: AppState = app.state.app_state
+    can_env: CanEnv = app_state.can_env
+
+    history = can_env.rollups.query(signal_key, t_from, t_to, max_points) if can_env.rollups is not None else None
+
+    if history is None:
+        return JSONResponse(status_code=400, content={
+            "action": "get_history",
+            "signal_key": signal_key,
+            "status": "error",
+            "error": {"code": 400, "msg": f"no history for signal: {signal_key}"}
+        })
+    else:
+        return JSONResponse(status_code=200, content={
+            "action": "get_history",
+            "signal_key": signal_key,
+            "status": "success",
+            "data": history
+        })
+
+
+@app.get("/history/{signal_key}/raw")
+async def get_raw_history_route(
+        signal_key,
+        t_from: float = Query(None, description="Start time (unix timestamp)"),
+        t_to: float = Query(None, description="End time (unix timestamp)")):
+    app_state: AppState = app.state.app_state
+    can_env: CanEnv = app_state.can_env
+
+    if can_env.store is None:
+        return JSONResponse(status_code=400, content={
+            "action": "get_raw_history",
+            "signal_key": signal_key,
+            "status": "error",
+            "error": {"code": 400, "msg": "signal store is not configured"}
+        })
+    elif not is_valid_signal_key(signal_key):
+        return JSONResponse(status_code=400, content={
+            "action": "get_raw_history",
+            "signal_key": signal_key,
+            "status": "error",
+            "error": {"code": 400, "msg": f"invalid signal key: {signal_key}"}
+        })
+    elif signal_key not in can_env.signal_keys():
+        return JSONResponse(status_code=404, content={
+            "action": "get_raw_history",
+            "signal_key": signal_key,
+            "status": "error",
+            "error": {"code": 404, "msg": f"unknown signal: {signal_key}"}
+        })
+    else:
+        t, v = await can_env.store.read_coro(signal_key, t_from, t_to)
+        return JSONResponse(status_code=200, content={
+            "action": "get_raw_history",
+            "signal_key": signal_key,
+            "status": "success",
+            "data": {"t": t.tolist(), "v": v.tolist()}
+        })
+
+
 @app.get("/tasks")
 async def get_tasks_route():
     app_state: AppState = app.state.app_state
@@ -265,3 +358,73 @@ async def get_tasks_route():
         "data": tasks
     })
 
+
+
+@app.get("/can/send_queue")
+async def get_send_queue_route():
+    app_state: AppState = app.state.app_state
+    can_env: CanEnv = app_state.can_env
+
+    return JSONResponse(status_code=200, content={
+        "action": "get_send_queue",
+        "status": "success",
+        "data": can_env.send_queue.stats()
+    })
+
+
+@app.get("/can/stats")
+async def get_can_stats_route():
+    app_state: AppState = app.state.app_state
+    can_env: CanEnv = app_state.can_env
+
+    return JSONResponse(status_code=200, content={
+        "action": "get_can_stats",
+        "status": "success",
+        "data": can_env.stats()
+    })
+
+
+# numbering of the event stream subscriptions of API clients
+event_stream_ids = itertools.count()
+
+
+@app.get("/can/events")
+async def get_can_events_route(
+        node_key: str = Query(None, description="Only messages of this node, default: all nodes"),
+        msg_key: str = Query(None, description="Only messages of this type, default: all messages"),
+        policy: str = Query(POLICY_LATEST_ONLY, description="`latest_only` or `drop_oldest` if the client falls behind"),
+        max_size: int = Query(DEFAULT_QUEUE_SIZE, description="Queue size for `drop_oldest`")):
+    app_state: AppState = app.state.app_state
+    can_env: CanEnv = app_state.can_env
+
+    # a slow client must not hold up the reception -> no `block` policy
+    if policy not in (POLICY_LATEST_ONLY, POLICY_DROP_OLDEST) or max_size < 1:
+        return JSONResponse(status_code=400, content={
+            "action": "get_can_events",
+            "status": "error",
+            "error": {"code": 400, "msg": f"invalid policy or queue size: {policy}, {max_size}"}
+        })
+
+    subscription = can_env.event_bus.subscribe_queue(f"api.events.{next(event_stream_ids)}", node_key, msg_key, policy, max_size)
+
+    async def event_stream():
+        # server-sent events, one per received message
+        try:
+            async for event in subscription:
+                yield f"data: {json.dumps(event.to_dict())}\n\n"
+        finally:
+            can_env.event_bus.unsubscribe_queue(subscription)
+
+    return StreamingResponse(event_stream(), media_type="text/event-stream")
+
+
+@app.get("/can/nodes")
+async def get_can_nodes_route():
+    app_state: AppState = app.state.app_state
+    can_env: CanEnv = app_state.can_env
+
+    return JSONResponse(status_code=200, content={
+        "action": "get_can_nodes",
+        "status": "success",
+        "data": can_env.node_registry.to_dict()
+    })
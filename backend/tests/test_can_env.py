@@ -0,0 +1,94 @@
+import asyncio
+from brewbot.can.can_env import CanEnv
+from brewbot.can.event_bus import EVENT_MESSAGE, EVENT_REPEATED
+from brewbot.config import load_config
+
+
+def can_env() -> CanEnv:
+    # the ports are never connected, frames are passed to the dispatch directly
+    conf = load_config()
+    conf.port.bus.interface = "virtual"
+    conf.store = None
+    return CanEnv(conf)
+
+
+def receive(env: CanEnv, node_key: str, msg_key: str, msg: dict, t: float) -> None:
+    # part of the receive loop after the reassembly of multi frame messages
+    bus_key = env.conf.node(node_key).bus
+    frame = env.msg_reg.encode_node_message(node_key, msg_key, msg)
+
+    if not env.is_repeated(bus_key, frame, t):
+        env.handle_message(*env.msg_reg.decode(frame, bus_key, t), t)
+
+
+async def settle() -> None:
+    # let the history tasks consume the published events
+    for _ in range(5):
+        await asyncio.sleep(0)
+
+
+def test_dedup():
+    env = can_env()
+    env.setup_nodes()
+    events = env.event_bus.subscribe_queue("test", raw=True)
+    heat_01 = env.conf.node("heat_01")
+
+    receive(env, "heat_01", "relay_state", {"on": True}, 1.0)
+    receive(env, "heat_01", "relay_state", {"on": True}, 2.0)
+    receive(env, "heat_01", "relay_state", {"on": False}, 3.0)
+    receive(env, "heat_01", "relay_state", {"on": False}, 4.0)
+    receive(env, "motor_01", "relay_state", {"on": False}, 5.0)
+
+    # repeats are not dispatched but refresh the liveness, the dedup is per arbitration id
+    node_state = env.node_states["heat_01"]
+    assert node_state.rx_message_time["relay_state"] == 3.0 and not node_state.rx_message_state["relay_state"]["on"]
+    assert env.node_registry.nodes[(heat_01.bus, heat_01.node_addr)].last_seen == 4.0
+
+    received = []
+    while (event := events.get_nowait()) is not None:
+        received.append((event.node_key, event.kind, event.t))
+    assert received == [
+        ("heat_01", EVENT_MESSAGE, 1.0),
+        ("heat_01", EVENT_REPEATED, 2.0),
+        ("heat_01", EVENT_MESSAGE, 3.0),
+        ("heat_01", EVENT_REPEATED, 4.0),
+        ("motor_01", EVENT_MESSAGE, 5.0)
+    ]
+
+    # messages without `dedup` are never dropped
+    receive(env, "therm_01", "therm_state", {"temp_c": 20.0, "temp_v": 1.0}, 6.0)
+    receive(env, "therm_01", "therm_state", {"temp_c": 20.0, "temp_v": 1.0}, 7.0)
+    assert env.node_states["therm_01"].rx_message_time["therm_state"] == 7.0
+
+
+def test_history():
+    async def run():
+        env = can_env()
+        env.setup_nodes()
+        env.create_history_task("rollups", env.record_rollups)
+
+        receive(env, "heat_01", "relay_state", {"on": True}, 0.1)
+        receive(env, "heat_01", "relay_state", {"on": True}, 0.3)
+        receive(env, "heat_01", "relay_state", {"on": False}, 0.5)
+        receive(env, "heat_01", "relay_state", {"on": False}, 0.7)
+        await settle()
+
+        # outliers are rejected by the thermometer but kept by the history
+        for i in range(20):
+            receive(env, "therm_01", "therm_state", {"temp_c": 20.0 + 0.01 * (i % 3), "temp_v": 1.0}, 1.0 + 0.1 * i)
+        receive(env, "therm_01", "therm_state", {"temp_c": 90.0, "temp_v": 1.0}, 3.5)
+
+        # pending events are recorded on cancellation
+        await env.cancel_tasks()
+        return env
+
+    env = asyncio.run(run())
+    relay = env.rollups.query("heat_01.relay_state.on")
+    assert relay["count"] == [4] and relay["mean"] == [0.5]
+
+    temp = env.rollups.query("therm_01.therm_state.temp_c")
+    assert sum(temp["count"]) == 21 and max(temp["max"]) == 90.0
+    assert env.node_states["therm_01"].temp_series.column("temp_c").max() < 21.0
+
+    assert len(env.event_bus.subscriptions) == 0 and env.tasks["history"] == {}
+    assert env.event_bus.stats()["published"] == 4 + 21
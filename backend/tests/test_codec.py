@@ -0,0 +1,98 @@
+import os
+import random
+import pytest
+from brewbot.can.codec import compile_decoder, compile_encoder
+from brewbot.config import CanEnvConfig, load_config_dict
+
+CONFIG_PATH = os.path.join(os.path.dirname(__file__), "..", "conf", "config.yaml")
+
+# message types in addition to the configured ones to cover signed, scaled / offset, float, byte crossing and
+# multi frame (> 8 bytes) signals
+EXTRA_MESSAGE_TYPES = [
+    {
+        "key": "test_signed",
+        "dbc_name": "TEST_SIGNED",
+        "priority": 6,
+        "pgn": 65520,  # 0xFFF0
+        "direction": "rx",
+        "signals": [
+            {"key": "a", "dbc_name": "A", "start_bit": 0, "signal_size": 12, "signed": True, "value_scale": 0.5, "value_offset": -20.0, "c_type": "double", "py_type": "float"},
+            {"key": "b", "dbc_name": "B", "start_bit": 12, "signal_size": 20, "signed": True, "value_scale": 3, "value_offset": 7, "c_type": "int32_t", "py_type": "int"},
+            {"key": "c", "dbc_name": "C", "start_bit": 32, "signal_size": 31, "c_type": "uint32_t", "py_type": "int"},
+            {"key": "d", "dbc_name": "D", "start_bit": 63, "signal_size": 1, "c_type": "uint8_t", "py_type": "flag"}
+        ]
+    },
+    {
+        "key": "test_large",
+        "dbc_name": "TEST_LARGE",
+        "priority": 6,
+        "pgn": 65521,  # 0xFFF1
+        "direction": "tx",
+        "size": 16,
+        "signals": [
+            {"key": "x", "dbc_name": "X", "start_bit": 0, "signal_size": 16, "signed": True, "value_scale": 0.01, "c_type": "double", "py_type": "float"},
+            {"key": "y", "dbc_name": "Y", "start_bit": 56, "signal_size": 24, "value_scale": 0.001, "value_offset": 1.5, "c_type": "double", "py_type": "float"},
+            {"key": "z", "dbc_name": "Z", "start_bit": 80, "signal_size": 48, "signed": True, "c_type": "int64_t", "py_type": "int"}
+        ]
+    }
+]
+
+
+def load_test_config() -> CanEnvConfig:
+    conf_dict = load_config_dict(CONFIG_PATH)
+    conf_dict["message_types"] = conf_dict["message_types"] + EXTRA_MESSAGE_TYPES
+    return CanEnvConfig(conf_dict)
+
+
+CONF = load_test_config()
+
+
+def random_payloads(msg_type, n: int = 500, seed: int = 0) -> list[bytes]:
+    rnd = random.Random(seed)
+    dbc_msg = CONF.dbc.get_message_by_name(msg_type.dbc_name)
+
+    payloads = [bytes(msg_type.size), b"\xff" * msg_type.size]
+    for _ in range(n):
+        payloads.append(bytes(rnd.randrange(0x100) for _ in range(msg_type.size)))
+
+    # round trip through cantools to clear bits that are not covered by any signal
+    return [dbc_msg.encode(dbc_msg.decode(data, decode_choices=False), strict=False) for data in payloads]
+
+
+@pytest.mark.parametrize("msg_type", CONF.message_types, ids=lambda msg_type: msg_type.key)
+def test_codec_matches_cantools(msg_type):
+    dbc_msg = CONF.dbc.get_message_by_name(msg_type.dbc_name)
+    decode = compile_decoder(msg_type.key, msg_type.signals)
+    encode = compile_encoder(msg_type.key, msg_type.signals, msg_type.size)
+
+    for data in random_payloads(msg_type):
+        expected = msg_type.decode(dbc_msg.decode(data))
+        actual = decode(data)
+        assert actual == expected, data.hex()
+
+        assert encode(actual) == dbc_msg.encode(msg_type.encode(actual)), data.hex()
+        assert encode(actual) == data, data.hex()
+
+
+def test_extra_message_types_are_covered():
+    sizes = {msg_type.key: msg_type.size for msg_type in CONF.message_types}
+    assert sizes["test_large"] > 8
+
+    signals = [signal for msg_type in CONF.message_types for signal in msg_type.signals]
+    assert any(signal.signed for signal in signals)
+    assert any(signal.py_type == "float" for signal in signals)
+    assert any(signal.start_bit // 8 != (signal.start_bit + signal.signal_size - 1) // 8 for signal in signals)
+
+
+@pytest.mark.parametrize("msg_type", CONF.message_types, ids=lambda msg_type: msg_type.key)
+def test_encoder_range_check(msg_type):
+    encode = compile_encoder(msg_type.key, msg_type.signals, msg_type.size)
+    signal = next((s for s in msg_type.signals if s.py_type != "flag"), None)
+    if signal is None:
+        pytest.skip("no numeric signal")
+
+    msg = {s.key: (s.value_min if s.py_type != "flag" else "off") for s in msg_type.signals}
+    msg[signal.key] = signal.value_max + abs(signal.value_scale) * 10
+
+    with pytest.raises(ValueError):
+        encode(msg)
@@ -0,0 +1,141 @@
+import asyncio
+import pytest
+from brewbot.can.event_bus import EventBus, Subscription, POLICY_DROP_OLDEST, POLICY_LATEST_ONLY, POLICY_BLOCK, \
+    EVENT_REJECTED, EVENT_REPEATED
+from brewbot.clock import VirtualClock
+
+
+def publish(bus: EventBus, node_key: str, n: int, t0: float = 0.0, msg_key: str = "therm_state") -> None:
+    for i in range(n):
+        bus.publish(node_key, msg_key, {"i": i}, t0 + i)
+
+
+def drain(subscription: Subscription) -> list:
+    events = []
+    while (event := subscription.get_nowait()) is not None:
+        events.append((event.node_key, event.msg["i"] if event.msg is not None else None))
+    return events
+
+
+def test_callbacks_and_filters():
+    bus = EventBus(VirtualClock())
+    therm_01, relays = [], []
+    bus.subscribe(lambda e: therm_01.append(e.msg["i"]), node_key="therm_01")
+    bus.subscribe(lambda e: relays.append(e.node_key), msg_key="relay_state")
+
+    publish(bus, "therm_01", 2)
+    publish(bus, "therm_02", 1)
+    publish(bus, "heat_01", 1, msg_key="relay_state")
+
+    # subscribing later invalidates the cached targets
+    late = bus.subscribe_queue("late", node_key="therm_02")
+    publish(bus, "therm_02", 1)
+
+    assert therm_01 == [0, 1] and relays == ["heat_01"]
+    assert drain(late) == [("therm_02", 0)]
+    with pytest.raises(ValueError):
+        bus.subscribe_queue("late")
+
+
+def test_drop_oldest():
+    clock = VirtualClock()
+    bus = EventBus(clock)
+    subscription = bus.subscribe_queue("s", policy=POLICY_DROP_OLDEST, max_size=3)
+    publish(bus, "therm_01", 5)
+
+    clock.advance(10.0)
+    assert subscription.lag() == 8.0  # oldest pending event is the one of t = 2
+    assert drain(subscription) == [("therm_01", 2), ("therm_01", 3), ("therm_01", 4)]
+    assert (subscription.received, subscription.delivered, subscription.dropped) == (5, 3, 2)
+    assert subscription.max_latency == 8.0 and subscription.last_latency == 6.0
+
+
+def test_latest_only():
+    bus = EventBus(VirtualClock())
+    subscription = bus.subscribe_queue("s", policy=POLICY_LATEST_ONLY)
+    publish(bus, "therm_01", 3)
+    publish(bus, "therm_02", 2)
+    publish(bus, "therm_01", 1, t0=10.0)
+
+    # one pending event per topic, in the order of their latest event
+    assert drain(subscription) == [("therm_02", 1), ("therm_01", 0)]
+    assert subscription.dropped == 4
+
+
+def test_raw_events():
+    bus = EventBus(VirtualClock())
+    callbacks = []
+    bus.subscribe(lambda e: callbacks.append(e.kind))
+    client = bus.subscribe_queue("client")
+    history = bus.subscribe_queue("history", raw=True)
+
+    bus.publish("therm_01", "therm_state", {"i": 0}, 0.0)
+    bus.publish("therm_01", "therm_state", {"i": 1}, 1.0, EVENT_REJECTED)
+    bus.publish("heat_01", "relay_state", None, 2.0, EVENT_REPEATED)
+
+    # rejected and repeated events only reach the raw subscriptions
+    assert callbacks == ["message"]
+    assert drain(client) == [("therm_01", 0)]
+    assert drain(history) == [("therm_01", 0), ("therm_01", 1), ("heat_01", None)]
+
+
+def test_block_backpressure():
+    async def run():
+        bus = EventBus(VirtualClock())
+        subscription = bus.subscribe_queue("s", policy=POLICY_BLOCK, max_size=2)
+
+        # publishing never waits, the batch may exceed the size
+        publish(bus, "therm_01", 3)
+        assert bus.blocked and len(subscription) == 3 and subscription.dropped == 0
+
+        waiter = asyncio.create_task(bus.wait_blocked())
+        await asyncio.sleep(0)
+        subscription.get_nowait()
+        await asyncio.sleep(0)
+        assert not waiter.done()
+
+        # released once the consumer made space
+        subscription.get_nowait()
+        await asyncio.wait_for(waiter, 1.0)
+        assert not bus.blocked
+
+        # closing a full subscription releases the publisher as well
+        publish(bus, "therm_01", 2)
+        waiter = asyncio.create_task(bus.wait_blocked())
+        await asyncio.sleep(0)
+        bus.unsubscribe_queue(subscription)
+        await asyncio.wait_for(waiter, 1.0)
+        return bus, subscription
+
+    bus, subscription = asyncio.run(run())
+    assert len(bus.subscriptions) == 0 and not bus.blocked
+    # pending events can still be read after closing
+    assert len(drain(subscription)) == 3
+
+
+def test_async_iteration():
+    async def run():
+        bus = EventBus(VirtualClock())
+        subscription = bus.subscribe_queue("s")
+        received = []
+
+        async def consume():
+            async for event in subscription:
+                received.append(event.msg["i"])
+
+        task = asyncio.create_task(consume())
+        publish(bus, "therm_01", 2)
+        await asyncio.sleep(0)
+        publish(bus, "therm_01", 1, t0=5.0)
+        bus.unsubscribe_queue(subscription)
+        await asyncio.wait_for(task, 1.0)
+        return received
+
+    assert asyncio.run(run()) == [0, 1, 0]
+
+
+def test_invalid_subscription():
+    with pytest.raises(ValueError):
+        Subscription("s", policy="unknown")
+    with pytest.raises(ValueError):
+        Subscription("s", max_size=0)
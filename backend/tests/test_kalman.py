@@ -0,0 +1,79 @@
+import math
+import random
+import pytest
+from brewbot.data.kalman import TempKalman
+
+
+def run(truth, n: int = 1200, interval: float = 0.5, variance: float = 0.01, seed: int = 0) -> tuple[TempKalman, list[tuple[float, float, float]]]:
+    # filter over noisy samples of `truth(t)`, returns the filter and (t, temperature error, rate) after every sample
+    rnd = random.Random(seed)
+    kalman = TempKalman(1e-5)
+    trace = []
+
+    for i in range(n):
+        t = i * interval
+        kalman.update(t, truth(t) + rnd.gauss(0.0, math.sqrt(variance)), variance)
+        temp, rate = kalman.state(t)
+        trace.append((t, temp - truth(t), rate))
+
+    return kalman, trace
+
+
+def mean(values) -> float:
+    values = list(values)
+    return sum(values) / len(values)
+
+
+def test_converges_to_constant():
+    assert TempKalman(1e-5).state(0.0) is None
+
+    kalman, trace = run(lambda t: 65.0)
+    settled = trace[len(trace) // 2:]
+
+    # unbiased and far less uncertain than a single sample, the errors stay within the estimated variance
+    p00, p11 = kalman.variance(trace[-1][0])
+    assert p00 < 0.01 / 5
+    assert abs(mean(err for _, err, _ in settled)) < 0.01
+    assert abs(mean(rate for _, _, rate in settled)) < 1e-3
+    assert all(abs(err) < 5.0 * math.sqrt(p00) for _, err, _ in settled)
+    assert all(abs(rate) < 5.0 * math.sqrt(p11) for _, _, rate in settled)
+
+
+def test_tracks_ramp():
+    slope = 1.0 / 60.0  # 1 °C / min
+    kalman, trace = run(lambda t: 20.0 + slope * t, seed=1)
+    settled = trace[len(trace) // 2:]
+
+    # constant rate model: no lag on a ramp once the rate is estimated
+    assert abs(mean(err for _, err, _ in settled)) < 0.01
+    assert mean(rate for _, _, rate in settled) == pytest.approx(slope, rel=0.1)
+
+    p00, _ = kalman.variance(trace[-1][0])
+    assert all(abs(err) < 5.0 * math.sqrt(p00) for _, err, _ in settled)
+
+
+def test_fuses_sensors_by_variance():
+    # a noisy sensor with a bias pulls the estimate less than the precise one
+    kalman = TempKalman(1e-5)
+    for i in range(400):
+        t = i * 0.5
+        kalman.update(t, 50.0, 0.01)
+        kalman.update(t, 51.0, 1.0)
+
+    temp, _ = kalman.state(200.0)
+    assert 50.0 < temp < 50.05
+
+
+def test_ignores_nan_and_reset():
+    kalman = TempKalman(1e-5)
+    kalman.update(0.0, float("nan"), 0.01)
+    assert not kalman.initialized
+
+    kalman.update(0.0, 20.0, 0.01)
+    version = kalman.version
+    kalman.update(1.0, float("nan"), 0.01)
+    assert kalman.version == version
+    assert kalman.state(1.0)[0] == 20.0
+
+    kalman.reset()
+    assert not kalman.initialized and kalman.state(1.0) is None
@@ -0,0 +1,95 @@
+import asyncio
+from brewbot.can.node_registry import NodeRegistry, UPTIME_TOLERANCE
+from brewbot.clock import VirtualClock
+from brewbot.config import load_config
+
+CONF = load_config()
+THERM = CONF.node("therm_01")  # liveness timeout 1 s
+RELAY = CONF.node("heat_01")  # liveness timeout 2 s
+
+
+def registry(clock: VirtualClock) -> tuple[NodeRegistry, list[tuple[str, str]]]:
+    reg = NodeRegistry(CONF.nodes, clock)
+    events = []
+    reg.event_handlers.append(lambda info, evt: events.append((info.node_key, evt)))
+    return reg, events
+
+
+def node_info(uptime: int) -> dict:
+    return {"node_type": 1, "node_id": 2, "version_major": 1, "version_minor": 2, "version_patch": 3, "uptime": uptime}
+
+
+def test_liveness():
+    reg, events = registry(VirtualClock())
+    reg.seen(THERM.bus, THERM.node_addr, 0.0)
+    reg.seen(RELAY.bus, RELAY.node_addr, 0.0)
+    assert events == [("therm_01", "online"), ("heat_01", "online")]
+
+    # a message before the deadline moves it, the due entry is rescheduled instead of declaring the node offline
+    reg.seen(THERM.bus, THERM.node_addr, 0.8)
+    assert reg.expire(1.0) == 1.8
+    assert reg.nodes[(THERM.bus, THERM.node_addr)].alive
+
+    assert reg.expire(1.8) == 2.0
+    assert events[-1] == ("therm_01", "offline")
+    assert reg.expire(2.0) is None
+    assert events[-1] == ("heat_01", "offline")
+
+    # back online with a new deadline
+    info = reg.seen(THERM.bus, THERM.node_addr, 5.0)
+    assert info.alive and info.first_seen == 0.0 and info.last_seen == 5.0
+    assert events[-1] == ("therm_01", "online") and reg.expire(5.5) == 6.0
+
+
+def test_discovery():
+    reg, events = registry(VirtualClock())
+    info = reg.seen(THERM.bus, 0x42, 1.0)
+    assert info.node_key is None and info.alive
+    assert events == [(None, "discovered"), (None, "online")]
+
+    # nodes without liveness timeout are never declared offline
+    assert reg.expire(1000.0) is None and info.alive
+
+
+def test_reboot():
+    reg, events = registry(VirtualClock())
+    reg.update_node_info(THERM.bus, THERM.node_addr, node_info(100), 0.0)
+    info = reg.update_node_info(THERM.bus, THERM.node_addr, node_info(110), 10.0)
+    assert info.reboots == 0 and info.version == (1, 2, 3)
+
+    # jitter of the reported uptime within the tolerance is no reboot
+    reg.update_node_info(THERM.bus, THERM.node_addr, node_info(int(120 - UPTIME_TOLERANCE)), 20.0)
+    assert info.reboots == 0
+
+    info = reg.update_node_info(THERM.bus, THERM.node_addr, node_info(3), 25.0)
+    assert info.reboots == 1 and info.uptime == 3
+    assert events.count(("therm_01", "reboot")) == 1
+
+
+async def settle() -> None:
+    # let the liveness task react to a wakeup or an expired sleep
+    for _ in range(5):
+        await asyncio.sleep(0)
+
+
+def test_liveness_coro():
+    async def run():
+        clock = VirtualClock()
+        reg, events = registry(clock)
+        task = asyncio.create_task(reg.liveness_coro())
+        await settle()
+
+        # wakes up for the first deadline
+        reg.seen(THERM.bus, THERM.node_addr, 0.0)
+        await settle()
+        clock.advance(0.9)
+        await settle()
+        assert ("therm_01", "offline") not in events
+
+        clock.advance(1.0)
+        await settle()
+        task.cancel()
+        await asyncio.wait([task])
+        return events
+
+    assert asyncio.run(run()) == [("therm_01", "online"), ("therm_01", "offline")]
@@ -0,0 +1,151 @@
+import random
+import numpy as np
+import pytest
+from brewbot.data.regression import RunningLinearFit
+from brewbot.data.series import WindowedSeries
+
+UNIX_TIME = 1.7e9
+
+
+def polyfit_line(t: np.ndarray, values: np.ndarray, current_time: float) -> tuple[np.ndarray, np.ndarray]:
+    # reference fit, centred on `current_time` so the reference itself is exact with unix timestamps
+    poly = np.polyfit(t - current_time, values, 1)
+    return poly[1], poly[0]
+
+
+def assert_line(line: tuple[np.ndarray, np.ndarray], t: np.ndarray, values: np.ndarray, current_time: float) -> None:
+    value, slope = line
+    reference_value, reference_slope = polyfit_line(t, values, current_time)
+    np.testing.assert_allclose(value, reference_value, rtol=1e-9, atol=1e-9)
+    np.testing.assert_allclose(slope, reference_slope, rtol=1e-6, atol=1e-9)
+
+
+def samples(n: int, t_start: float, rate: float, seed: int = 0) -> tuple[np.ndarray, np.ndarray]:
+    rnd = random.Random(seed)
+    t = t_start + np.cumsum([rnd.uniform(0.5, 1.5) / rate for _ in range(n)])
+    temp_c = np.array([20.0 + 0.01 * i + rnd.gauss(0.0, 0.1) for i in range(n)])
+    return t, np.column_stack([temp_c, temp_c / 19.0])
+
+
+@pytest.mark.parametrize("t_start", [0.0, UNIX_TIME])
+def test_running_fit_add_remove(t_start):
+    t, values = samples(400, t_start, 10.0)
+    fit = RunningLinearFit(2, span=1e9)
+
+    # sliding window of 50 samples: every removal must leave the fit of the remaining samples
+    for i in range(len(t)):
+        fit.add(t[i], values[i])
+        if i >= 50:
+            fit.remove(t[i - 50], values[i - 50])
+
+        lo = max(0, i - 49)
+        if i - lo >= 1:
+            assert fit.n == i - lo + 1
+            assert_line(fit.line(t[i]), t[lo:i + 1], values[lo:i + 1], t[i])
+
+
+def test_running_fit_rebuild():
+    t, values = samples(100, UNIX_TIME, 10.0)
+    fit = RunningLinearFit(2, span=8.0)
+
+    for ti, v in zip(t, values):
+        fit.add(ti, v)
+    for ti, v in zip(t[:50], values[:50]):
+        fit.remove(ti, v)
+
+    assert fit.t0 == t[0]
+    assert fit.needs_rebuild(t[-1])
+
+    fit.rebuild(t[50:100], values[50:100])
+    assert fit.t0 == t[50]
+    assert fit.n == 50
+    assert not fit.needs_rebuild(t[99])
+    assert_line(fit.line(t[99]), t[50:100], values[50:100], t[99])
+
+    # the rebuilt sums are those of a fit that only ever saw the remaining samples
+    fresh = RunningLinearFit(2, span=8.0)
+    for ti, v in zip(t[50:100], values[50:100]):
+        fresh.add(ti, v)
+    assert fit.sum_t == pytest.approx(fresh.sum_t)
+    assert fit.sum_tt == pytest.approx(fresh.sum_tt)
+    np.testing.assert_allclose(fit.sum_ty, fresh.sum_ty)
+
+
+def test_running_fit_degenerate():
+    fit = RunningLinearFit(1, span=10.0)
+    assert fit.line(UNIX_TIME) is None
+
+    fit.add(UNIX_TIME, np.array([20.0]))
+    value, slope = fit.line(UNIX_TIME + 1.0)
+    assert value[0] == 20.0 and slope[0] == 0.0
+
+    fit.remove(UNIX_TIME, np.array([20.0]))
+    assert fit.n == 0 and fit.t0 is None
+    fit.rebuild(np.empty(0), np.empty((0, 1)))
+    assert fit.line(UNIX_TIME) is None
+
+
+@pytest.mark.parametrize("t_start", [0.0, UNIX_TIME])
+@pytest.mark.parametrize("window, rate, capacity", [(10.0, 10.0, 150), (10.0, 10.0, 40), (30.0, 2.0, 90)])
+def test_windowed_series_fit(t_start, window, rate, capacity):
+    # eviction by the window and (with the small capacity) by the capacity, the fit is rebuilt every `window` seconds
+    rnd = random.Random(1)
+    series = WindowedSeries(window, columns=["temp_c", "temp_v"], capacity=capacity, fit=True)
+    t, values = samples(int(window * rate * 8), t_start, rate)
+    rebuilds = 0
+
+    for ti, v in zip(t, values):
+        t0 = series._fit.t0
+        series.append(ti, v)
+        if t0 is not None and series._fit.t0 != t0:
+            # rebuilt relative to the oldest sample of the window
+            assert series._fit.t0 == series.t[0]
+            rebuilds += 1
+
+        if len(series) < 2:
+            continue
+
+        assert len(series) <= capacity
+        assert series.t[0] >= ti - window
+
+        current_time = ti + rnd.uniform(0.0, 0.5 / rate)
+        ref_t, ref_values = series.between(current_time - window, current_time)
+        assert_line(series.linear_fit(current_time), ref_t, ref_values, current_time)
+
+    assert rebuilds >= 5
+
+
+def test_windowed_series_fit_read_only():
+    # queries far ahead of the samples don't evict: results of the next appends are those of a series never queried
+    queried = WindowedSeries(10.0, capacity=200, fit=True)
+    reference = WindowedSeries(10.0, capacity=200, fit=True)
+    t, values = samples(300, UNIX_TIME, 10.0)
+
+    for i, (ti, v) in enumerate(zip(t, values[:, 0])):
+        queried.append(ti, v)
+        reference.append(ti, v)
+
+        if i % 7 == 0:
+            n = len(queried)
+            assert queried.linear_fit(ti + 9.0) is not None
+            assert queried.linear_fit(ti + 30.0) is None
+            assert len(queried) == n
+
+        np.testing.assert_array_equal(queried.t, reference.t)
+        np.testing.assert_allclose(queried.linear_fit(ti), reference.linear_fit(ti), rtol=1e-12)
+
+
+def test_windowed_series_fit_other_window():
+    # a query window other than the series window falls back to fitting the selected samples
+    series = WindowedSeries(10.0, capacity=200, fit=True)
+    t, values = samples(100, UNIX_TIME, 10.0)
+    for ti, v in zip(t, values[:, 0]):
+        series.append(ti, v)
+
+    current_time = float(t[-1])
+    ref_t, ref_values = series.between(current_time - 3.0, current_time)
+    value, slope = series.linear_fit(current_time, 3.0)
+    reference_value, reference_slope = polyfit_line(ref_t, ref_values, current_time)
+    # the uncentred fallback loses precision with unix timestamps
+    np.testing.assert_allclose(value, reference_value, rtol=1e-6)
+    np.testing.assert_allclose(slope, reference_slope, rtol=1e-4)
@@ -0,0 +1,76 @@
+import pytest
+from brewbot.data.rollup import RollupSeries, RollupStore
+
+
+def test_bucket_aggregates():
+    series = RollupSeries(1.0, 4)
+    for t, value in [(0.1, 2.0), (0.5, 4.0), (0.9, 3.0), (2.5, -1.0)]:
+        series.add(t, value)
+
+    # empty buckets are skipped
+    result = series.query()
+    assert result["t"].tolist() == [0.0, 2.0]
+    assert result["count"].tolist() == [3, 1]
+    assert result["min"].tolist() == [2.0, -1.0]
+    assert result["max"].tolist() == [4.0, -1.0]
+    assert result["mean"].tolist() == [3.0, -1.0]
+    assert result["last"].tolist() == [3.0, -1.0]
+
+
+def test_wrap_around():
+    series = RollupSeries(1.0, 4)
+    for b in range(10):
+        series.add(b + 0.5, float(b))
+
+    # only the last `capacity` buckets are retained, their slots were reused
+    assert series.oldest_t == 6.0
+    assert series.query()["t"].tolist() == [6.0, 7.0, 8.0, 9.0]
+    assert series.query(7.5, 8.5)["last"].tolist() == [7.0, 8.0]
+    assert series.query(0.0, 5.9)["t"].tolist() == []
+
+    # a sample older than the retained history doesn't overwrite a slot
+    series.add(5.5, 100.0)
+    assert series.query()["max"].tolist() == [6.0, 7.0, 8.0, 9.0]
+
+    # a late sample within the history is merged into its bucket
+    series.add(6.9, 100.0)
+    assert series.query(6.0, 6.0)["count"].tolist() == [2]
+
+    # a jump over several buckets leaves no stale slots behind
+    series.add(11.5, 11.0)
+    result = series.query()
+    assert result["t"].tolist() == [8.0, 9.0, 11.0] and series.oldest_t == 8.0
+
+
+def test_select_resolution():
+    store = RollupStore([(10.0, 6), (1.0, 10)])
+    assert [interval for interval, _ in store.resolutions] == [1.0, 10.0]
+
+    for i in range(30):
+        store.record("a", float(i), float(i))
+
+    # the fine resolution only retains the last 10 s
+    assert store.query("a", 25.0)["interval"] == 1.0
+    assert store.query("a", 5.0)["interval"] == 10.0
+    assert store.query("a", 25.0, max_points=3)["interval"] == 10.0
+    assert store.query("b") is None
+
+    with pytest.raises(ValueError):
+        RollupStore([])
+
+
+def test_repeat_message():
+    store = RollupStore([(1.0, 10)])
+
+    # no message to repeat yet
+    store.repeat_message("heat_01", "relay_state", 0.1)
+    assert store.signals == {}
+
+    store.record_message("heat_01", "relay_state", {"on": True}, 0.2)
+    store.repeat_message("heat_01", "relay_state", 0.5)
+    store.record_message("heat_01", "relay_state", {"on": False}, 0.7)
+    store.repeat_message("heat_01", "relay_state", 0.9)
+
+    # the repeated values count as samples, the mean is the duty cycle
+    result = store.query("heat_01.relay_state.on")
+    assert result["count"] == [4] and result["mean"] == [0.5] and result["last"] == [0.0]
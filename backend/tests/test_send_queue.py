@@ -0,0 +1,69 @@
+import asyncio
+import pytest
+from brewbot.can.send_queue import SendQueue
+from brewbot.config import load_config
+
+CONF = load_config()
+RELAYS = [CONF.node("motor_01"), CONF.node("heat_01")]
+
+
+def put(queue: SendQueue, node_no: int, on: bool) -> None:
+    node = RELAYS[node_no]
+    queue.put(node, node.message("relay_cmd"), {"on": on})
+
+
+def test_coalesce():
+    queue = SendQueue(4)
+    put(queue, 0, False)
+    put(queue, 1, False)
+    put(queue, 0, True)
+
+    # the pending entry keeps its position and takes the latest payload
+    batch = queue.get_batch()
+    assert [(node.key, msg) for node, _, msg in batch] == [("motor_01", {"on": True}), ("heat_01", {"on": False})]
+    assert queue.stats() == {"pending": 0, "queued": 3, "coalesced": 1, "dropped": 0}
+    assert queue.get_batch() == []
+
+
+def test_drop_oldest():
+    queue = SendQueue(1)
+    put(queue, 0, True)
+    put(queue, 1, True)
+
+    [(node, _, _)] = queue.get_batch()
+    assert node.key == "heat_01"
+    assert queue.dropped == 1 and queue.coalesced == 0
+
+    # a full queue still coalesces instead of dropping
+    put(queue, 1, False)
+    put(queue, 1, True)
+    assert len(queue) == 1 and queue.dropped == 1 and queue.coalesced == 1
+
+
+def test_wait_batch():
+    async def run():
+        queue = SendQueue(4)
+        waiter = asyncio.create_task(queue.wait_batch())
+        await asyncio.sleep(0)
+        assert not waiter.done()
+
+        put(queue, 0, True)
+        put(queue, 0, False)
+        batch = await waiter
+
+        # cleared entries are not sent and don't wake up the sender
+        put(queue, 1, True)
+        queue.clear()
+        waiter = asyncio.create_task(queue.wait_batch())
+        await asyncio.sleep(0)
+        assert not waiter.done()
+        waiter.cancel()
+        return batch
+
+    [(node, _, msg)] = asyncio.run(run())
+    assert node.key == "motor_01" and msg == {"on": False}
+
+
+def test_invalid_size():
+    with pytest.raises(ValueError):
+        SendQueue(0)
@@ -0,0 +1,162 @@
+import asyncio
+import can
+from brewbot.can.transport import Transport, cm_frame, dt_frames, is_transport_frame, TP_CM_RTS, TP_CM_CTS, \
+    TP_CM_EOM_ACK, TP_CM_BAM, TP_CM_ABORT, ABORT_TIMEOUT, ABORT_BAD_SEQUENCE, BAM_PACKET_INTERVAL, T1, T2, T4
+from brewbot.can.util import pgn_to_can_id, can_id_to_pgn
+from brewbot.clock import VirtualClock
+
+PGN = 0xEF00  # proprietary A, PDU format 1 (destination specific)
+MASTER_ADDR = 0x00
+NODE_ADDR = 0x70
+
+
+class Loopback:
+    # two endpoints on a shared virtual clock, frames of one are fed to the other. All frames are kept in `frames`.
+    def __init__(self, drop=lambda frame: False):
+        self.clock = VirtualClock(1000.0)
+        self.frames = []
+        self.received = {MASTER_ADDR: [], NODE_ADDR: []}
+        self.drop = drop
+        self.master = Transport(MASTER_ADDR, lambda frame: self.deliver(frame, self.node), self.clock)
+        self.node = Transport(NODE_ADDR, lambda frame: self.deliver(frame, self.master), self.clock)
+
+    def deliver(self, frame: can.Message, receiver: Transport) -> None:
+        self.frames.append(frame)
+        if not self.drop(frame):
+            msg = receiver.feed(frame)
+            if msg is not None:
+                self.received[receiver.own_addr].append(msg)
+
+    async def run(self, duration: float, step: float = 0.01) -> None:
+        for _ in range(round(duration / step)):
+            await settle()
+            self.clock.advance(self.clock.time() + step)
+            await settle()
+
+
+async def settle() -> None:
+    # let the sender task and the timeout of `VirtualClock.wait_for` react
+    for _ in range(5):
+        await asyncio.sleep(0)
+
+
+def message(src_addr: int, dest_addr: int, size: int) -> can.Message:
+    data = bytes(i % 251 for i in range(size))
+    return can.Message(arbitration_id=pgn_to_can_id(PGN, 6, src_addr, dest_addr), data=data, dlc=size, is_extended_id=True, check=False)
+
+
+def controls(frames: list[can.Message], src_addr: int) -> list[int]:
+    # TP.CM control bytes sent by `src_addr`
+    return [f.data[0] for f in frames if can_id_to_pgn(f.arbitration_id)[0] == 0xEC00 and can_id_to_pgn(f.arbitration_id)[2] == src_addr]
+
+
+def test_bam_reassembly():
+    async def run():
+        loop = Loopback()
+        msg = message(NODE_ADDR, 0xFF, 40)
+        loop.node.send_message(msg)
+        await loop.run(7 * BAM_PACKET_INTERVAL)
+        return loop, msg
+
+    loop, msg = asyncio.run(run())
+    assert all(is_transport_frame(f.arbitration_id) for f in loop.frames)
+    assert len(loop.frames) == 1 + 6
+    [received] = loop.received[MASTER_ADDR]
+    assert bytes(received.data) == bytes(msg.data)
+    pgn, _, src_addr, dest_addr = can_id_to_pgn(received.arbitration_id)
+    assert (pgn, src_addr, dest_addr) == (PGN, NODE_ADDR, 0xFF)
+    assert loop.master.messages_reassembled == 1 and len(loop.master.rx_sessions) == 0
+
+
+def test_rts_cts_windows():
+    async def run():
+        loop = Loopback()
+        msg = message(MASTER_ADDR, NODE_ADDR, 200)  # 29 packets -> two CTS windows
+        loop.master.send_message(msg)
+        await loop.run(0.1)
+        return loop, msg
+
+    loop, msg = asyncio.run(run())
+    [received] = loop.received[NODE_ADDR]
+    assert bytes(received.data) == bytes(msg.data)
+    assert controls(loop.frames, NODE_ADDR) == [TP_CM_CTS, TP_CM_CTS, TP_CM_EOM_ACK]
+    assert controls(loop.frames, MASTER_ADDR) == [TP_CM_RTS]
+    assert len(loop.master._tx_tasks) == 0 and loop.master.sessions_aborted == 0
+
+
+def test_rts_cts_hold_and_timeout():
+    async def run(hold: float):
+        # the node is scripted: it holds the connection open with a CTS of 0 packets, then requests all packets
+        clock = VirtualClock(1000.0)
+        sent = []
+        master = Transport(MASTER_ADDR, sent.append, clock)
+        msg = message(MASTER_ADDR, NODE_ADDR, 20)
+        master.send_message(msg)
+        await settle()
+
+        master.feed(cm_frame(TP_CM_CTS, 0, 1, 0xFF, 0xFF, PGN, NODE_ADDR, MASTER_ADDR))
+        await settle()
+        clock.advance(clock.time() + hold)
+        await settle()
+
+        master.feed(cm_frame(TP_CM_CTS, 3, 1, 0xFF, 0xFF, PGN, NODE_ADDR, MASTER_ADDR))
+        await settle()
+        master.feed(cm_frame(TP_CM_EOM_ACK, 20, 0, 3, 0xFF, PGN, NODE_ADDR, MASTER_ADDR))
+        await settle()
+        return master, sent
+
+    # within T4 the hold keeps the session, the packets follow the second CTS
+    master, sent = asyncio.run(run(T4 - 0.05))
+    assert controls(sent, MASTER_ADDR) == [TP_CM_RTS]
+    assert [f.data[0] for f in sent[1:]] == [1, 2, 3]
+    assert master.sessions_aborted == 0 and len(master._tx_tasks) == 0
+
+    # the hold expires after T4 on the injected clock -> abort instead of data
+    master, sent = asyncio.run(run(T4 + 0.05))
+    assert controls(sent, MASTER_ADDR) == [TP_CM_RTS, TP_CM_ABORT]
+    assert sent[-1].data[1] == ABORT_TIMEOUT
+    assert master.sessions_aborted == 1
+
+
+def test_abort_bad_sequence():
+    loop = Loopback()
+    loop.master.feed(cm_frame(TP_CM_RTS, 20, 0, 3, 0xFF, PGN, NODE_ADDR, MASTER_ADDR))
+    assert (NODE_ADDR, MASTER_ADDR) in loop.master.rx_sessions
+
+    # packet 2 before packet 1
+    loop.master.feed(dt_frames(bytes(20), NODE_ADDR, MASTER_ADDR, 2, 1)[0])
+    assert len(loop.master.rx_sessions) == 0 and loop.master.sessions_aborted == 1
+    assert controls(loop.frames, MASTER_ADDR) == [TP_CM_CTS, TP_CM_ABORT]
+    assert loop.frames[-1].data[1] == ABORT_BAD_SEQUENCE
+
+
+def test_abort_by_receiver():
+    async def run():
+        # the node drops the first data packet -> it aborts, the sender gives up without waiting for a timeout
+        loop = Loopback(drop=lambda frame: frame.arbitration_id & 0x00FF0000 == 0x00EB0000 and frame.data[0] == 1)
+        loop.master.send_message(message(MASTER_ADDR, NODE_ADDR, 20))
+        await loop.run(0.05)
+        return loop
+
+    loop = asyncio.run(run())
+    assert controls(loop.frames, NODE_ADDR) == [TP_CM_CTS, TP_CM_ABORT]
+    assert loop.master.sessions_aborted == 1 and loop.node.sessions_aborted == 1
+    assert len(loop.master._tx_tasks) == 0 and len(loop.received[NODE_ADDR]) == 0
+
+
+def test_expire():
+    loop = Loopback()
+    now = loop.clock.time()
+    loop.master.feed(cm_frame(TP_CM_RTS, 20, 0, 3, 0xFF, PGN, NODE_ADDR, MASTER_ADDR))
+    loop.master.feed(cm_frame(TP_CM_BAM, 20, 0, 3, 0xFF, PGN, NODE_ADDR + 1, 0xFF))
+    assert len(loop.master.rx_sessions) == 2
+
+    # the RTS session waits T2 after its CTS, the BAM session T1
+    loop.master.expire(now + T1 + 0.01)
+    assert list(loop.master.rx_sessions) == [(NODE_ADDR, MASTER_ADDR)]
+    loop.master.expire(now + T2 + 0.01)
+    assert len(loop.master.rx_sessions) == 0 and loop.master.sessions_aborted == 2
+
+    # only the RTS / CTS sender is told
+    assert controls(loop.frames, MASTER_ADDR) == [TP_CM_CTS, TP_CM_ABORT]
+    assert loop.frames[-1].data[1] == ABORT_TIMEOUT